@@ -0,0 +1,389 @@
+'''
+This module contains the scheduler of all Alpha Vantage requests.
+
+Requests are paced by a token bucket sized to the requests per minute of the
+API plan, and a persistent counter stops them once the daily quota is used
+up. Concurrent requests for the same function and symbol are sent once and
+share the response. Throttled requests (HTTP 429 and 5xx, connection errors,
+and the JSON "Note" or "Information" payloads Alpha Vantage answers with when
+a limit is hit) are retried with exponential backoff, and are never returned
+to the caller, so they cannot end up in the cache.
+
+A refresh can queue all its requests first with ``Scheduler.batch``. The
+response of every queued request is kept in the queue database until the
+whole batch is done, so a refresh that is interrupted and run again only sends
+the requests that had not been answered. Kept responses belong to the batch
+that queued them, identified by its requests, and expire after
+``RESUME_SECONDS``: other batches, requests outside a batch and a batch
+resumed too late fetch the data again.
+
+The plan and the endpoint are read from the ALPHA_VANTAGE_PLAN and
+ALPHA_VANTAGE_URL environment variables by ``stock_utils.scheduler``, which
+lets the pipeline run against a local stub server.
+'''
+
+from __future__ import annotations
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from typing import Iterable, Optional
+
+import cache_store
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_URL = "https://www.alphavantage.co/query"
+QUEUE_DB = os.path.join(cache_store.CACHE_DIR, "alpha_vantage_queue.sqlite")
+
+# Requests per minute and per day of every plan, None for no daily limit
+PLANS = {
+    'free': (5, 25),
+    '75': (75, None),
+    '150': (150, None),
+    '300': (300, None),
+    '600': (600, None),
+    '1200': (1200, None),
+}
+DEFAULT_PLAN = 'free'
+
+MAX_RETRIES = 5
+BACKOFF_SECONDS = 2.0
+MAX_BACKOFF_SECONDS = 60.0
+REQUEST_TIMEOUT = 30
+
+# Age after which the responses kept for an interrupted batch are fetched again
+RESUME_SECONDS = 3 * 24 * 3600
+
+# Payload keys of the throttle responses, and HTTP statuses worth retrying
+THROTTLE_KEYS = ('Note', 'Information')
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AlphaVantageError(RuntimeError):
+    '''Raised when Alpha Vantage answers with an error, e.g. for an unknown symbol.'''
+
+
+class ThrottledError(AlphaVantageError):
+    '''Raised when a request is still throttled after all retries.'''
+
+
+class QuotaExceededError(ThrottledError):
+    '''Raised when the daily request quota of the plan is used up.'''
+
+
+def is_throttle(payload) -> bool:
+    '''Return True if a decoded response is a throttle message instead of data.'''
+    return isinstance(payload, dict) and bool(payload) and set(payload) <= set(THROTTLE_KEYS)
+
+
+def _is_daily_limit(message: str) -> bool:
+    return 'per day' in message.lower()
+
+
+def plan_limits(plan: Optional[str] = None) -> tuple:
+    '''
+    Return the (per minute, per day) request limits of a plan name, or of a
+    number of requests per minute for plans not listed in PLANS.
+    '''
+    plan = str(plan or DEFAULT_PLAN)
+    if plan in PLANS:
+        return PLANS[plan]
+    try:
+        return int(plan), None
+    except ValueError:
+        raise ValueError(f"Unknown Alpha Vantage plan '{plan}', expected one of {list(PLANS)} "
+                         f"or a number of requests per minute") from None
+
+
+class TokenBucket:
+    '''
+    Thread-safe token bucket refilled at ``rate_per_minute``, holding at most ``capacity`` tokens.
+
+    A caller that finds the bucket empty reserves the next token and sleeps
+    until it is due, so waiting callers are served in order.
+    '''
+
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60
+        self.capacity = rate_per_minute if capacity is None else capacity
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        '''Take a token, sleeping until one is available. Returns the seconds waited.'''
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+            self._updated_at = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+_thread_local = threading.local()
+
+
+def http_session():
+    '''
+    Return the HTTP session of the current thread.
+
+    Sessions keep their connections open between requests, and each worker
+    thread of a concurrent build reuses its own.
+    '''
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        import requests
+        session = requests.Session()
+        _thread_local.session = session
+    return session
+
+
+class Scheduler:
+    '''
+    Rate-limited, deduplicating and retrying client of the Alpha Vantage API.
+
+    Parameters
+    ----------
+    api_key : str
+        The Alpha Vantage API key.
+    base_url : str, optional
+        Endpoint of the API, DEFAULT_URL by default.
+    plan : str, optional
+        Plan name of PLANS or a number of requests per minute, DEFAULT_PLAN by default.
+    queue_path : str
+        Location of the SQLite database of the request queue and the daily usage.
+    max_retries : int
+        Retries of a throttled or failed request before giving up.
+    backoff : float
+        Seconds before the first retry, doubled after each one.
+    resume_seconds : float
+        Age after which the responses kept for an interrupted batch are not reused.
+    '''
+
+    def __init__(self, api_key: Optional[str], base_url: Optional[str] = None, plan: Optional[str] = None,
+                 queue_path: str = QUEUE_DB, max_retries: int = MAX_RETRIES, backoff: float = BACKOFF_SECONDS,
+                 resume_seconds: float = RESUME_SECONDS):
+        self.api_key = api_key
+        self.base_url = base_url or DEFAULT_URL
+        self.per_minute, self.per_day = plan_limits(plan)
+        self.bucket = TokenBucket(self.per_minute)
+        self.queue_path = queue_path
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.resume_seconds = resume_seconds
+        # Identifier of the batch being run, requests outside a batch are not queued
+        self._batch = None
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._in_flight = {}
+
+        directory = os.path.dirname(queue_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(queue)")]
+            if columns and 'batch' not in columns:
+                # Responses queued before batches were told apart cannot be attributed to one
+                conn.execute("DROP TABLE queue")
+            conn.execute("CREATE TABLE IF NOT EXISTS queue ("
+                         "batch TEXT NOT NULL, function TEXT NOT NULL, symbol TEXT NOT NULL, status TEXT NOT NULL, "
+                         "payload TEXT, attempts INTEGER NOT NULL DEFAULT 0, updated_at REAL NOT NULL, "
+                         "PRIMARY KEY (batch, function, symbol))")
+            conn.execute("CREATE TABLE IF NOT EXISTS usage (day TEXT PRIMARY KEY, count INTEGER NOT NULL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.queue_path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    # Requests
+
+    def query(self, function: str, symbol: str) -> dict:
+        '''
+        Return the decoded JSON response of an endpoint for a symbol.
+
+        Raises
+        ------
+        AlphaVantageError
+            If Alpha Vantage answers with an error message.
+        ThrottledError
+            If the request is still throttled or failing after all retries.
+        QuotaExceededError
+            If the daily quota of the plan is used up.
+        '''
+        stored = self._stored_payload(function, symbol)
+        if stored is not None:
+            return stored
+
+        key = (function, symbol)
+        with self._lock:
+            future = self._in_flight.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = Future()
+                self._in_flight[key] = future
+        if not is_owner:
+            # The same request is already being sent by another thread
+            return future.result()
+
+        try:
+            payload = self._send(function, symbol)
+            self._complete(function, symbol, payload)
+            future.set_result(payload)
+        except BaseException as exc:
+            future.set_exception(exc)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+        return payload
+
+    def _send(self, function: str, symbol: str) -> dict:
+        import requests
+
+        params = {"function": function, "symbol": symbol, "apikey": self.api_key}
+        for attempt in range(self.max_retries + 1):
+            self.bucket.acquire()
+            self._use_quota()
+            try:
+                response = http_session().get(self.base_url, params=params, timeout=REQUEST_TIMEOUT)
+                if response.status_code in RETRY_STATUSES:
+                    reason = f"HTTP {response.status_code}"
+                else:
+                    response.raise_for_status()
+                    payload = response.json()
+                    if isinstance(payload, dict) and 'Error Message' in payload:
+                        raise AlphaVantageError(f"{function} {symbol}: {payload['Error Message']}")
+                    if not is_throttle(payload):
+                        return payload
+                    reason = next(iter(payload.values()))
+                    if _is_daily_limit(str(reason)):
+                        raise QuotaExceededError(f"{function} {symbol}: {reason}")
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                reason = str(exc)
+            self._record_attempt(function, symbol)
+
+            if attempt == self.max_retries:
+                break
+            delay = min(self.backoff * 2 ** attempt, MAX_BACKOFF_SECONDS) * random.uniform(0.5, 1.0)
+            logger.warning("Alpha Vantage %s %s throttled (%s), retrying in %.1fs", function, symbol, reason, delay)
+            time.sleep(delay)
+        raise ThrottledError(f"{function} {symbol} still throttled after {self.max_retries} retries: {reason}")
+
+    def _use_quota(self) -> None:
+        if self.per_day is None:
+            return
+        day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        with self._connection() as conn:
+            conn.execute("INSERT OR IGNORE INTO usage (day, count) VALUES (?, 0)", (day,))
+            updated = conn.execute("UPDATE usage SET count = count + 1 WHERE day = ? AND count < ?",
+                                   (day, self.per_day)).rowcount
+        if not updated:
+            raise QuotaExceededError(f"The daily quota of {self.per_day} Alpha Vantage requests is used up")
+
+    def requests_today(self) -> int:
+        '''Return the number of requests sent today (UTC), as counted against the daily quota.'''
+        day = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        row = self._connection().execute("SELECT count FROM usage WHERE day = ?", (day,)).fetchone()
+        return 0 if row is None else row[0]
+
+    # Persistent queue
+
+    @staticmethod
+    def batch_id(requests: Iterable[tuple]) -> str:
+        '''Return the identifier of a batch, the same for the same (function, symbol) requests.'''
+        payload = json.dumps(sorted({(function, symbol) for function, symbol in requests}))
+        return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+    def enqueue(self, requests: Iterable[tuple], batch: str) -> int:
+        '''
+        Add (function, symbol) requests to the queue of a batch, keeping those already in it.
+
+        Returns
+        -------
+        int
+            The number of requests of the batch without a response yet.
+        '''
+        now = time.time()
+        with self._connection() as conn:
+            # Responses kept for too long are fetched again
+            conn.execute("DELETE FROM queue WHERE updated_at < ?", (now - self.resume_seconds,))
+            conn.executemany("INSERT OR IGNORE INTO queue (batch, function, symbol, status, updated_at) "
+                             "VALUES (?, ?, ?, 'pending', ?)",
+                             [(batch, function, symbol, now) for function, symbol in requests])
+        return len(self.pending(batch))
+
+    def pending(self, batch: str) -> list:
+        '''Return the queued (function, symbol) requests of a batch without a response, oldest first.'''
+        return self._connection().execute(
+            "SELECT function, symbol FROM queue WHERE batch = ? AND status = 'pending' ORDER BY rowid",
+            (batch,)).fetchall()
+
+    def finish(self, batch: str) -> None:
+        '''Drop the queue of a batch and the responses it kept.'''
+        with self._connection() as conn:
+            conn.execute("DELETE FROM queue WHERE batch = ?", (batch,))
+
+    @contextlib.contextmanager
+    def batch(self, requests: Iterable[tuple]):
+        '''
+        Queue the requests of a refresh for the duration of the block.
+
+        Responses of queued requests are kept until the block completes, and the
+        queue of the batch is dropped then. If the block fails, the queue is
+        kept, and the next batch of the same requests reuses the responses it
+        holds instead of sending them again, unless they are older than
+        ``resume_seconds``.
+        '''
+        requests = list(requests)
+        batch = self.batch_id(requests)
+        remaining = self.enqueue(requests, batch)
+        if remaining < len(requests):
+            logger.info("Resuming a batch of Alpha Vantage requests, %d of %d left", remaining, len(requests))
+        self._batch = batch
+        try:
+            yield self
+        finally:
+            self._batch = None
+        self.finish(batch)
+
+    def _stored_payload(self, function: str, symbol: str) -> Optional[dict]:
+        if self._batch is None:
+            return None
+        row = self._connection().execute(
+            "SELECT payload FROM queue WHERE batch = ? AND function = ? AND symbol = ? AND status = 'done' "
+            "AND updated_at >= ?", (self._batch, function, symbol, time.time() - self.resume_seconds)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def _complete(self, function: str, symbol: str, payload: dict) -> None:
+        # Only requests queued by the running batch keep their response
+        if self._batch is None:
+            return
+        with self._connection() as conn:
+            conn.execute("UPDATE queue SET status = 'done', payload = ?, updated_at = ? "
+                         "WHERE batch = ? AND function = ? AND symbol = ?",
+                         (json.dumps(payload), time.time(), self._batch, function, symbol))
+
+    def _record_attempt(self, function: str, symbol: str) -> None:
+        if self._batch is None:
+            return
+        with self._connection() as conn:
+            conn.execute("UPDATE queue SET attempts = attempts + 1, updated_at = ? "
+                         "WHERE batch = ? AND function = ? AND symbol = ?",
+                         (time.time(), self._batch, function, symbol))
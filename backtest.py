@@ -0,0 +1,258 @@
+'''
+This module contains the vectorized quarterly backtest of the selected stocks.
+
+The forward return of every (quarter, ticker) cell is computed once into a
+matrix from the price store, and portfolio returns are a single weighted
+matrix product over it.
+'''
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+import instrumentation
+import price_store
+import risk_model
+
+# Days of the return window of one quarter
+QUARTER_DAYS = 90
+
+# Quarters before this year are not backtested
+START_YEAR = 2013
+
+ALLOCATION_SCHEMES = ['equal', 'score', 'inverse_volatility', 'min_variance', 'risk_parity', 'mean_variance']
+
+# Schemes optimized over the shrunk covariance of the daily returns, see risk_model.py
+COVARIANCE_SCHEMES = {'min_variance', 'risk_parity', 'mean_variance'}
+
+
+def quarter_key(quarter: str) -> tuple:
+    '''
+    Turn a quarter label such as 2024_q3 into a sortable (year, quarter) tuple.
+    '''
+    year, q = map(int, quarter.split('_q'))
+    return year, q
+
+
+def previous_quarter(quarter: str) -> str:
+    year, q = map(int, quarter.split('_q'))
+    if q == 1:
+        return f"{year - 1}_q4"
+    return f"{year}_q{q - 1}"
+
+
+def next_quarter(quarter: str) -> str:
+    year, q = map(int, quarter.split('_q'))
+    if q == 4:
+        return f"{year + 1}_q1"
+    return f"{year}_q{q + 1}"
+
+
+def quarter_start_date(quarter: str) -> datetime:
+    '''
+    Convert a quarter label to the date its return window ends on.
+    '''
+    year, q = map(int, quarter.split('_q'))
+    if q == 1:
+        return datetime(year, 1, 31)
+    elif q == 2:
+        return datetime(year, 4, 30)
+    elif q == 3:
+        return datetime(year, 7, 31)
+    return datetime(year, 10, 31)
+
+
+def holdings(selected_stocks: dict, start_year: int = START_YEAR) -> dict:
+    '''
+    Return the stocks held in every quarter, which are the ones selected in the previous quarter.
+    '''
+    previous_quarter_stocks = {}
+    for date in selected_stocks:
+        year, _ = map(int, date.split('_q'))
+        if year < start_year:
+            continue  # Skip any data before start_year
+        previous_quarter_stocks[date] = selected_stocks.get(previous_quarter(date), [])
+    return previous_quarter_stocks
+
+
+@instrumentation.timed('forward_return_matrix')
+def forward_return_matrix(quarters: list, tickers: list, days: int = QUARTER_DAYS) -> pd.DataFrame:
+    '''
+    Compute the return of every ticker over every quarter.
+
+    The return of a quarter is compounded over the ``days + 1`` calendar days
+    before its ``quarter_start_date``, one extra day as two closes are needed for one return.
+
+    Returns
+    -------
+    pd.DataFrame
+        quarter x ticker returns, NaN where the ticker has no prices.
+    '''
+    start_dates = [quarter_start_date(quarter) for quarter in quarters]
+    returns = np.full((len(quarters), len(tickers)), np.nan)
+    for t, ticker in enumerate(tickers):
+        returns[:, t] = price_store.compound_returns(ticker, start_dates, days + 1)
+    return pd.DataFrame(returns, index=quarters, columns=tickers)
+
+
+@instrumentation.timed('trailing_volatility')
+def trailing_volatility(tickers: list, end_dates: list, days: int = QUARTER_DAYS) -> pd.DataFrame:
+    '''
+    Compute the standard deviation of daily log returns over the ``days`` calendar days before each date.
+
+    Returns
+    -------
+    pd.DataFrame
+        date x ticker volatilities, NaN with fewer than two daily returns in the window.
+    '''
+    volatility = np.full((len(end_dates), len(tickers)), np.nan)
+    for t, ticker in enumerate(tickers):
+        volatility[:, t] = price_store.trailing_volatility(price_store.load_prices(ticker), end_dates, days)
+    return pd.DataFrame(volatility, index=list(end_dates), columns=tickers)
+
+
+def holding_window_start(quarter: str) -> datetime:
+    '''Return the first day of the return window the stocks selected in a quarter are held over.'''
+    # The stocks selected in a quarter are held over the next one, whose window starts QUARTER_DAYS + 1 days earlier
+    return quarter_start_date(next_quarter(quarter)) - timedelta(days=QUARTER_DAYS + 1)
+
+
+def _risk_weights(covariance_model: risk_model.RollingCovariance, stocks: list, scheme: str,
+                  max_weight: float) -> np.ndarray:
+    # Optimize over the stocks with enough daily returns in the window, the others get no weight
+    mean, covariance, observations = covariance_model.moments(stocks)
+    usable = (observations >= risk_model.MIN_OBSERVATIONS) & (np.nan_to_num(np.diag(covariance)) > 0)
+    raw = np.zeros(len(stocks))
+    if not usable.any():
+        return raw
+    rows = np.flatnonzero(usable)
+    shrunk = risk_model.shrink_covariance(covariance[np.ix_(rows, rows)], int(observations[rows].min()))
+    if scheme == 'min_variance':
+        raw[rows] = risk_model.min_variance_weights(shrunk, max_weight)
+    elif scheme == 'risk_parity':
+        raw[rows] = risk_model.risk_parity_weights(shrunk)
+    else:
+        raw[rows] = risk_model.mean_variance_weights(shrunk, mean[rows], max_weight=max_weight)
+    return raw
+
+
+def allocate(selected_stocks: dict, scheme: str = 'equal', scores: Optional[pd.DataFrame] = None,
+             lookback_days: Optional[int] = None, max_weight: float = risk_model.MAX_WEIGHT,
+             covariance_model: Optional[risk_model.RollingCovariance] = None) -> dict:
+    '''
+    Compute the portfolio weights of the stocks selected in every quarter.
+
+    Parameters
+    ----------
+    selected_stocks : dict
+        quarter -> list of selected tickers.
+    scheme : str, default 'equal'
+        'equal' gives every stock the same weight, 'score' weights stocks by
+        their selection score and 'inverse_volatility' by the inverse of the
+        volatility of their daily returns before the holding quarter.
+        'min_variance', 'risk_parity' and 'mean_variance' optimize the weights
+        over the shrunk covariance of the daily returns before the holding
+        quarter, see risk_model.py.
+    scores : pd.DataFrame, optional
+        quarter x ticker selection scores, required by the 'score' scheme.
+    lookback_days : int, optional
+        Window of the 'inverse_volatility' scheme, QUARTER_DAYS by default, and
+        of the covariance schemes, ``risk_model.COVARIANCE_DAYS`` by default.
+    max_weight : float
+        Weight cap of the 'min_variance' and 'mean_variance' schemes.
+    covariance_model : risk_model.RollingCovariance, optional
+        Rolling covariance of the covariance schemes, moved forward quarter
+        after quarter. Passing the same one to calls on successive quarters,
+        as the walk-forward backtest does, keeps its window sums.
+
+    Returns
+    -------
+    dict
+        quarter -> {ticker: weight}, with weights summing to 1.
+    '''
+    if scheme not in ALLOCATION_SCHEMES:
+        raise ValueError(f"Unknown allocation scheme '{scheme}', expected one of {ALLOCATION_SCHEMES}")
+    if scheme == 'score' and scores is None:
+        raise ValueError("The 'score' allocation scheme needs the selection scores")
+
+    volatility = None
+    if scheme == 'inverse_volatility':
+        quarters = list(selected_stocks)
+        tickers = sorted({ticker for stocks in selected_stocks.values() for ticker in stocks})
+        volatility = trailing_volatility(tickers, [holding_window_start(quarter) for quarter in quarters],
+                                         lookback_days or QUARTER_DAYS)
+        volatility.index = quarters
+    if scheme in COVARIANCE_SCHEMES and covariance_model is None:
+        covariance_model = risk_model.RollingCovariance(lookback_days or risk_model.COVARIANCE_DAYS)
+
+    allocation = {}
+    # The covariance window only moves forward, so quarters are visited in chronological order
+    for date in sorted(selected_stocks, key=quarter_key):
+        stocks = selected_stocks[date]
+        if not stocks:
+            allocation[date] = {}
+            continue
+        if scheme == 'equal':
+            raw = np.ones(len(stocks))
+        elif scheme == 'score':
+            raw = scores.loc[date, stocks].to_numpy(dtype=float)
+        elif scheme == 'inverse_volatility':
+            raw = 1 / volatility.loc[date, stocks].to_numpy(dtype=float)
+        else:
+            covariance_model.advance(holding_window_start(date))
+            raw = _risk_weights(covariance_model, stocks, scheme, max_weight)
+        raw = np.where(np.isfinite(raw) & (raw > 0), raw, 0)
+        if raw.sum() == 0:
+            # Fall back to equal weights without usable scores, volatilities or covariances
+            raw = np.ones(len(stocks))
+        allocation[date] = dict(zip(stocks, (raw / raw.sum()).tolist()))
+    return {date: allocation[date] for date in selected_stocks}
+
+
+def portfolio_returns(selected_stocks: dict, weights: Optional[dict] = None,
+                      returns: Optional[pd.DataFrame] = None, start_year: int = START_YEAR) -> pd.DataFrame:
+    '''
+    Backtest the selected stocks, holding each selection over the next quarter.
+
+    Parameters
+    ----------
+    selected_stocks : dict
+        quarter -> list of selected tickers.
+    weights : dict, optional
+        quarter -> {ticker: weight} of each selection, as returned by ``allocate``.
+        Without it, every held stock has a weight of 1 and the portfolio return
+        is the sum of their returns, as ``calculate_portfolio_return`` always did.
+        That is not the return of an invested portfolio, so there is no 'nav' then.
+    returns : pd.DataFrame, optional
+        Precomputed ``forward_return_matrix``.
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by quarter, with the portfolio 'return' and, with weights, the cumulative 'nav' starting from 1.
+    '''
+    held = holdings(selected_stocks, start_year)
+    quarters = list(held)
+    tickers = sorted({ticker for stocks in held.values() for ticker in stocks})
+    if returns is None:
+        returns = forward_return_matrix(quarters, tickers)
+    returns = returns.reindex(index=quarters, columns=tickers)
+
+    weight_matrix = np.zeros((len(quarters), len(tickers)))
+    column = {ticker: t for t, ticker in enumerate(tickers)}
+    for q, date in enumerate(quarters):
+        selection_weights = (weights or {}).get(previous_quarter(date))
+        for ticker in held[date]:
+            weight_matrix[q, column[ticker]] = 1 if selection_weights is None else selection_weights.get(ticker, 0)
+
+    # Stocks without a price over the quarter do not contribute
+    portfolio_return = (weight_matrix * np.nan_to_num(returns.to_numpy())).sum(axis=1)
+    result = pd.DataFrame({'return': portfolio_return}, index=pd.Index(quarters, name='date'))
+    result = result.sort_index(key=lambda index: index.map(quarter_key))
+    if weights is not None:
+        result['nav'] = (1 + result['return']).cumprod()
+    return result
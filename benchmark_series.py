@@ -0,0 +1,144 @@
+'''
+This module contains the benchmark index series and the relative-performance analytics.
+
+Benchmark indices are kept in the local price store like any ticker: their
+full history is downloaded once and only the new days are fetched afterwards.
+Index levels and returns for whole arrays of dates are read from the stored
+series, and the portfolio is compared with a benchmark by vectorized
+statistics over all periods (and all strategies) at once.
+'''
+
+from __future__ import annotations
+
+from typing import Optional, Union
+
+import numpy as np
+import pandas as pd
+
+import backtest
+import price_store
+
+# Benchmark indices by name
+BENCHMARKS = {'nasdaq_100': '^NDX', 'sp_500': '^GSPC', 'dow_jones': '^DJI', 'semiconductors': '^SOX'}
+DEFAULT_BENCHMARK = BENCHMARKS['nasdaq_100']
+
+PERFORMANCE_COLUMNS = ['total_return', 'benchmark_return', 'excess_return', 'alpha', 'beta',
+                       'tracking_error', 'information_ratio', 'max_drawdown', 'benchmark_max_drawdown']
+
+
+def load_benchmark(symbol: str = DEFAULT_BENCHMARK, until=None) -> price_store.PriceSeries:
+    '''
+    Return the stored history of a benchmark index, fetching the days missing before ``until`` first.
+    '''
+    return price_store.load_prices(BENCHMARKS.get(symbol, symbol), until=until)
+
+
+def index_levels(dates, symbol: str = DEFAULT_BENCHMARK, max_days_back: Optional[int] = None) -> pd.Series:
+    '''
+    Return the close of a benchmark on the last session on or before each date.
+
+    Parameters
+    ----------
+    dates : array-like of dates
+        The dates to look up.
+    symbol : str
+        Index symbol or a name of BENCHMARKS.
+    max_days_back : int, optional
+        Give up on a date whose last session is more than this many days before it.
+
+    Returns
+    -------
+    pd.Series
+        Close of each date, indexed by the session it was taken from, NaN (and
+        NaT) where there is none.
+    '''
+    days = np.atleast_1d(price_store.to_days(dates))
+    series = load_benchmark(symbol, until=days.max() if len(days) else None)
+    i = np.searchsorted(series.dates, days, side='right') - 1
+    found = i >= 0
+    if max_days_back is not None:
+        found &= days - series.dates[np.maximum(i, 0)] <= np.timedelta64(max_days_back, 'D')
+    levels = np.where(found, np.asarray(series.close)[np.maximum(i, 0)], np.nan)
+    sessions = np.where(found, series.dates[np.maximum(i, 0)], np.datetime64('NaT'))
+    return pd.Series(levels, index=pd.DatetimeIndex(sessions, name='Date'), name='Price')
+
+
+def quarterly_returns(quarters: list, symbol: str = DEFAULT_BENCHMARK, days: int = backtest.QUARTER_DAYS) -> pd.Series:
+    '''
+    Return the benchmark's return over the window every quarter is backtested on.
+
+    The windows are those of ``backtest.forward_return_matrix``, so the result
+    lines up with ``PrimeModel.backtest``.
+    '''
+    start_dates = [backtest.quarter_start_date(quarter) for quarter in quarters]
+    returns = price_store.compound_returns(BENCHMARKS.get(symbol, symbol), start_dates, days + 1)
+    return pd.Series(returns, index=pd.Index(quarters, name='date'), name=symbol)
+
+
+def daily_returns(dates: pd.DatetimeIndex, symbol: str = DEFAULT_BENCHMARK) -> pd.Series:
+    '''
+    Return the benchmark's close-to-close return on each of the given trading days.
+    '''
+    levels = index_levels(dates, symbol)
+    levels.index = pd.DatetimeIndex(dates, name='date')
+    return levels.pct_change().rename(symbol)
+
+
+def _max_drawdown(returns: np.ndarray) -> np.ndarray:
+    # Largest fall from a running NAV peak, the NAV starting from 1 before the first period
+    nav = np.cumprod(1 + returns, axis=0)
+    peak = np.maximum.accumulate(np.vstack([np.ones((1, returns.shape[1])), nav]), axis=0)[1:]
+    return (1 - nav / peak).max(axis=0, initial=0)
+
+
+def relative_performance(returns: Union[pd.Series, pd.DataFrame], benchmark_returns: pd.Series,
+                         periods_per_year: int = 4) -> pd.DataFrame:
+    '''
+    Compare the returns of one or more strategies with a benchmark.
+
+    Periods where the benchmark has no return are left out of every statistic,
+    and missing strategy returns count as 0.
+
+    Parameters
+    ----------
+    returns : pd.Series or pd.DataFrame
+        Periodic returns of a strategy, or of one strategy per column.
+    benchmark_returns : pd.Series
+        Benchmark returns of the same periods.
+    periods_per_year : int, default 4
+        4 for quarterly and 252 for daily returns.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per strategy with PERFORMANCE_COLUMNS: the total compounded
+        'total_return' and 'benchmark_return', the annualized mean
+        'excess_return', the annualized Jensen 'alpha' and the 'beta' of the
+        regression on the benchmark, the annualized 'tracking_error' and
+        'information_ratio', and the 'max_drawdown' of both.
+    '''
+    frame = returns.to_frame() if isinstance(returns, pd.Series) else returns
+    benchmark = benchmark_returns.reindex(frame.index)
+    valid = benchmark.notna().to_numpy()
+    r = np.nan_to_num(frame.to_numpy(dtype=np.float64)[valid])
+    b = benchmark.to_numpy(dtype=np.float64)[valid][:, None]
+
+    excess = r - b
+    stats = np.full((frame.shape[1], len(PERFORMANCE_COLUMNS)), np.nan)
+    if len(r):
+        stats[:, 0] = np.prod(1 + r, axis=0) - 1
+        stats[:, 1] = np.prod(1 + b[:, 0]) - 1
+        stats[:, 2] = excess.mean(axis=0) * periods_per_year
+        stats[:, 7] = _max_drawdown(r)
+        stats[:, 8] = _max_drawdown(b)[0]
+    if len(r) > 1:
+        b_centered = b - b.mean()
+        variance = (b_centered ** 2).sum()
+        beta = (b_centered * (r - r.mean(axis=0))).sum(axis=0) / variance if variance > 0 else np.full(r.shape[1], np.nan)
+        tracking_error = excess.std(axis=0, ddof=1) * np.sqrt(periods_per_year)
+        stats[:, 3] = (r.mean(axis=0) - beta * b.mean()) * periods_per_year
+        stats[:, 4] = beta
+        stats[:, 5] = tracking_error
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats[:, 6] = np.where(tracking_error > 0, stats[:, 2] / tracking_error, np.nan)
+    return pd.DataFrame(stats, index=frame.columns, columns=PERFORMANCE_COLUMNS)
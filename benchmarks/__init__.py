@@ -0,0 +1,3 @@
+'''
+Offline benchmarks of the PRIME pipeline against synthetic market data.
+'''
@@ -0,0 +1,140 @@
+'''
+Benchmark the pipeline stages on synthetic universes, fully offline.
+
+Usage:
+    python -m benchmarks.run --tickers 10 100 1000 --quarters 40 --output bench_results.json
+
+Every universe runs in its own temporary directory against a SyntheticMarket,
+so caches start cold. Each stage is timed and, unless --no-memory is given,
+its peak traced allocation is recorded with tracemalloc. Tracing slows the
+stages down, so compare timings taken with the same setting only.
+'''
+
+from __future__ import annotations
+
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import time
+import tracemalloc
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+import data_model
+import instrumentation
+from main import PrimeModel
+from benchmarks.synthetic import SyntheticMarket, install
+
+DEFAULT_TICKERS = [10, 100, 500]
+DEFAULT_QUARTERS = 40
+
+
+class StageTimer:
+    '''
+    Record the wall time and peak traced memory of named stages.
+    '''
+
+    def __init__(self, memory: bool = True):
+        self.memory = memory
+        self.stages = {}
+
+    def run(self, name: str, func, *args, **kwargs):
+        if self.memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - start
+            stage = {'seconds': seconds}
+            if self.memory:
+                stage['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            self.stages[name] = stage
+            logging.getLogger(__name__).info("%s: %.3fs", name, seconds)
+
+
+def benchmark_universe(num_tickers: int, num_quarters: int, seed: int = 0, memory: bool = True,
+                       instrument: bool = False) -> dict:
+    '''
+    Run every pipeline stage once on a synthetic universe.
+
+    With ``instrument``, the instrumentation report of the run (inner stages,
+    provider calls and cache hit rates) is included in the result.
+    '''
+    market = SyntheticMarket(num_tickers, num_quarters, seed)
+    timer = StageTimer(memory)
+    if instrument:
+        instrumentation.reset()
+        instrumentation.enable()
+    original_stock_list = data_model.stock_list
+    data_model.stock_list = market.tickers
+    try:
+        with install(market):
+            timer.run('merge_indicator_data', lambda: [data_model.merge_indicator_data(ticker) for ticker in market.tickers])
+            timer.run('compose_stock_data_by_date', data_model.compose_stock_data_by_date)
+            data = timer.run('load_stock_data', data_model.load_stock_data)
+            model = PrimeModel(data)
+            timer.run('rank_stocks', model.rank_stocks)
+            selected_stocks = timer.run('select_stocks', model.select_stocks)
+            timer.run('calculate_portfolio_return', model.calculate_portfolio_return, selected_stocks)
+    finally:
+        data_model.stock_list = original_stock_list
+        if instrument:
+            instrumentation.disable()
+
+    result = {'tickers': num_tickers, 'quarters': num_quarters, 'seed': seed, 'stages': timer.stages}
+    if instrument:
+        result['instrumentation'] = instrumentation.report()
+    return result
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except Exception:
+        return None
+
+
+def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description="Benchmark the PRIME pipeline on synthetic universes.")
+    parser.add_argument('--tickers', type=int, nargs='+', default=DEFAULT_TICKERS, help="universe sizes to run")
+    parser.add_argument('--quarters', type=int, default=DEFAULT_QUARTERS, help="fiscal quarters per ticker")
+    parser.add_argument('--seed', type=int, default=0, help="seed of the synthetic market")
+    parser.add_argument('--no-memory', action='store_true', help="skip tracemalloc memory profiling")
+    parser.add_argument('--instrument', action='store_true', help="include the instrumentation report of every run")
+    parser.add_argument('--output', default='bench_results.json', help="JSON file the results are written to")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    logging.getLogger(__name__).setLevel(logging.INFO)
+    output = os.path.abspath(args.output)
+
+    report = {
+        'metadata': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_revision': _git_revision(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'memory_profiled': not args.no_memory,
+        },
+        'results': [benchmark_universe(num_tickers, args.quarters, args.seed, not args.no_memory, args.instrument)
+                    for num_tickers in args.tickers],
+    }
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Wrote {output}")
+    return report
+
+
+if __name__ == "__main__":
+    main()
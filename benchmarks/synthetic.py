@@ -0,0 +1,150 @@
+'''
+This module contains a deterministic, offline stand-in for the market-data providers.
+
+SyntheticMarket generates prices, quarterly earnings and annual income
+statements for N tickers over Q quarters. ``install`` routes the Alpha Vantage
+queries of stock_utils and the Yahoo Finance downloads of price_store to it,
+so the whole pipeline runs without network access.
+'''
+
+from __future__ import annotations
+
+import contextlib
+import os
+import tempfile
+import zlib
+
+import numpy as np
+import pandas as pd
+
+import cache_store
+import price_store
+import stock_utils
+import trading_calendar
+
+# First fiscal quarter end of the synthetic universe
+START_DATE = pd.Timestamp('2010-01-31')
+
+# Years of prices before the first fiscal quarter, for the trailing returns
+PRICE_HISTORY_YEARS = 2
+
+
+class SyntheticMarket:
+    '''
+    Deterministic synthetic prices, earnings and income statements.
+
+    Parameters
+    ----------
+    num_tickers : int
+        Size of the universe. Tickers are named T0000, T0001, ...
+    num_quarters : int
+        Number of fiscal quarters reported by every ticker.
+    seed : int
+        Seed of all generated data. The same seed always gives the same market.
+    '''
+
+    def __init__(self, num_tickers: int, num_quarters: int, seed: int = 0):
+        self.num_tickers = num_tickers
+        self.num_quarters = num_quarters
+        self.seed = seed
+        self.tickers = [f"T{i:04d}" for i in range(num_tickers)]
+        self.end_date = START_DATE + pd.offsets.MonthEnd(3 * num_quarters)
+        self.sessions = pd.bdate_range(START_DATE - pd.DateOffset(years=PRICE_HISTORY_YEARS),
+                                       self.end_date + pd.offsets.MonthEnd(3))
+
+    def _rng(self, ticker: str, kind: str) -> np.random.Generator:
+        return np.random.default_rng([self.seed, zlib.crc32(f"{ticker}:{kind}".encode())])
+
+    def _fiscal_dates(self, ticker: str) -> pd.DatetimeIndex:
+        # Fiscal years of the tickers end in different months
+        offset = zlib.crc32(ticker.encode()) % 3
+        first = START_DATE + pd.offsets.MonthEnd(offset)
+        return pd.DatetimeIndex([first + pd.offsets.MonthEnd(3 * q) for q in range(self.num_quarters)])
+
+    def history(self, ticker: str, start=None) -> pd.DataFrame:
+        '''Daily OHLCV history in the format of ``price_store.download_history``.'''
+        rng = self._rng(ticker, 'prices')
+        drift, volatility = rng.normal(0.0003, 0.0003), rng.uniform(0.01, 0.04)
+        close = 50 * np.exp(np.cumsum(rng.normal(drift, volatility, len(self.sessions))))
+        spread = rng.uniform(0, 0.01, len(self.sessions))
+        hist = pd.DataFrame({
+            'Open': close * (1 - spread / 2),
+            'High': close * (1 + spread),
+            'Low': close * (1 - spread),
+            'Close': close,
+            'Volume': rng.integers(100_000, 10_000_000, len(self.sessions)).astype(float),
+        }, index=self.sessions)
+        if start is not None:
+            hist = hist[hist.index >= pd.Timestamp(start)]
+        return hist
+
+    def earnings(self, ticker: str) -> dict:
+        '''Alpha Vantage EARNINGS payload.'''
+        rng = self._rng(ticker, 'earnings')
+        dates = self._fiscal_dates(ticker)
+        eps = np.round(np.cumsum(rng.normal(0.02, 0.15, len(dates))) + rng.uniform(0.2, 2), 2)
+        return {'symbol': ticker, 'quarterlyEarnings': [
+            {'fiscalDateEnding': date.strftime('%Y-%m-%d'), 'reportedEPS': str(value)}
+            for date, value in zip(dates[::-1], eps[::-1])
+        ]}
+
+    def income_statement(self, ticker: str) -> dict:
+        '''Alpha Vantage INCOME_STATEMENT payload with annual and quarterly reports.'''
+        rng = self._rng(ticker, 'income')
+        dates = self._fiscal_dates(ticker)[3::4]
+        # Starting one year before the first quarter, so every quarter has a yoy return
+        dates = dates.insert(0, dates[0] - pd.DateOffset(years=1)) if len(dates) else dates
+        revenue = 1e9 * np.exp(np.cumsum(rng.normal(0.08, 0.15, len(dates))))
+        quarters = self._fiscal_dates(ticker)
+        quarterly = 2.5e8 * np.exp(np.cumsum(self._rng(ticker, 'quarterly_income').normal(0.02, 0.08, len(quarters))))
+        return {'symbol': ticker, 'annualReports': [
+            {'fiscalDateEnding': date.strftime('%Y-%m-%d'), 'totalRevenue': str(int(value))}
+            for date, value in zip(dates[::-1], revenue[::-1])
+        ], 'quarterlyReports': [
+            {'fiscalDateEnding': date.strftime('%Y-%m-%d'), 'totalRevenue': str(int(value))}
+            for date, value in zip(quarters[::-1], quarterly[::-1])
+        ]}
+
+    def alpha_vantage_query(self, function: str, symbol: str) -> dict:
+        '''Stand-in for ``stock_utils.alpha_vantage_query``.'''
+        if function == 'EARNINGS':
+            return self.earnings(symbol)
+        if function == 'INCOME_STATEMENT':
+            return self.income_statement(symbol)
+        return {'Error Message': f"Unsupported function {function}"}
+
+
+def reset_state() -> None:
+    '''Forget the in-process caches, which point at the previous working directory.'''
+    cache_store._default_store = None
+    price_store._series.clear()
+    trading_calendar._calendar = None
+
+
+@contextlib.contextmanager
+def install(market: SyntheticMarket, directory: str = None):
+    '''
+    Run the pipeline against ``market`` inside an empty working directory.
+
+    All caches and outputs are relative to the working directory, so they are
+    written to ``directory`` (a temporary directory by default) and never
+    touch the real ones.
+    '''
+    original_query = stock_utils.alpha_vantage_query
+    original_download = price_store.download_history
+    original_cwd = os.getcwd()
+    with contextlib.ExitStack() as stack:
+        if directory is None:
+            directory = stack.enter_context(tempfile.TemporaryDirectory(prefix='prime_bench_'))
+        os.makedirs(directory, exist_ok=True)
+        os.chdir(directory)
+        reset_state()
+        stock_utils.alpha_vantage_query = market.alpha_vantage_query
+        price_store.download_history = market.history
+        try:
+            yield market
+        finally:
+            stock_utils.alpha_vantage_query = original_query
+            price_store.download_history = original_download
+            reset_state()
+            os.chdir(original_cwd)
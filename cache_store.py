@@ -0,0 +1,392 @@
+'''
+This module contains the consolidated cache store.
+
+All cached datasets (EPS, income statements, provider responses...)
+live in a single SQLite database keyed by (dataset, key) instead of one CSV
+file per query. Parsed frames are kept in an in-process LRU, every dataset can
+have a TTL after which its entries are considered stale, and the least
+recently used entries are evicted once the database grows past a size bound.
+'''
+
+from __future__ import annotations
+
+import io
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+import pandas as pd
+
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+CACHE_DIR = "cache"
+DB_FILE = os.path.join(CACHE_DIR, "cache.sqlite")
+
+DEFAULT_MAX_BYTES = 1 << 30
+DEFAULT_LRU_SIZE = 4096
+
+# Share of max_bytes the store is shrunk to when it outgrows it
+EVICTION_TARGET = 0.9
+
+# Legacy per-query CSV files and the dataset/key they are imported as
+LEGACY_PATTERNS = [
+    (re.compile(r"^(?P<ticker>.+)_eps_cache\.csv$"), 'eps'),
+    (re.compile(r"^(?P<ticker>.+)_income_statement_cache\.csv$"), 'income_statement'),
+]
+
+# Datasets of derived values that are now computed from the raw inputs by factors.py, dropped from existing stores
+RETIRED_DATASETS = ['pe_ratio', 'quarterly_return']
+
+# Seconds after which the cached company reports are fetched again: a new quarter is reported by then
+REPORT_TTL = 91 * 24 * 3600
+DEFAULT_TTLS = {'eps': REPORT_TTL, 'income_statement': REPORT_TTL, 'quarterly_income_statement': REPORT_TTL}
+
+# Version of the store layout, kept in the SQLite user_version so that upgrades run once per database
+SCHEMA_VERSION = 1
+
+
+class CacheStore:
+    '''
+    Keyed cache of DataFrames and raw payloads backed by SQLite.
+
+    Parameters
+    ----------
+    path : str
+        Location of the SQLite database.
+    max_bytes : int
+        Size bound of the stored payloads. Least recently used entries are evicted beyond it.
+    lru_size : int
+        Number of parsed frames kept in memory.
+    '''
+
+    def __init__(self, path: str = DB_FILE, max_bytes: int = DEFAULT_MAX_BYTES, lru_size: int = DEFAULT_LRU_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lru_size = lru_size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._lru = OrderedDict()
+        self._ttls = None
+        self._total_bytes = None
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "dataset TEXT NOT NULL, key TEXT NOT NULL, payload BLOB NOT NULL, "
+                         "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+                         "PRIMARY KEY (dataset, key))")
+            conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            conn.execute("CREATE TABLE IF NOT EXISTS datasets (dataset TEXT PRIMARY KEY, ttl REAL)")
+
+    def _connection(self) -> sqlite3.Connection:
+        # SQLite connections cannot be shared between threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=60)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # TTL / staleness metadata
+
+    def set_ttl(self, dataset: str, ttl: Optional[float]) -> None:
+        '''Set the number of seconds after which entries of ``dataset`` are stale, ``None`` for never.'''
+        with self._connection() as conn:
+            conn.execute("INSERT OR REPLACE INTO datasets (dataset, ttl) VALUES (?, ?)", (dataset, ttl))
+        self._ttls = None
+        self.clear_memory()
+
+    def ttl(self, dataset: str) -> Optional[float]:
+        if self._ttls is None:
+            self._ttls = dict(self._connection().execute("SELECT dataset, ttl FROM datasets").fetchall())
+        return self._ttls.get(dataset)
+
+    def _is_fresh(self, dataset: str, created_at: float) -> bool:
+        ttl = self.ttl(dataset)
+        return ttl is None or time.time() - created_at <= ttl
+
+    def upgrade(self) -> bool:
+        '''
+        Bring a store written by an older version up to SCHEMA_VERSION.
+
+        Drops the RETIRED_DATASETS and sets the DEFAULT_TTLS of the datasets
+        without a TTL. Returns False without writing anything if the store is
+        already up to date.
+        '''
+        conn = self._connection()
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= SCHEMA_VERSION:
+            return False
+        with conn:
+            conn.executemany("DELETE FROM entries WHERE dataset = ?", [(dataset,) for dataset in RETIRED_DATASETS])
+            conn.executemany("INSERT OR IGNORE INTO datasets (dataset, ttl) VALUES (?, ?)", DEFAULT_TTLS.items())
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._ttls = None
+        with self._lock:
+            self._lru.clear()
+            self._total_bytes = None
+        return True
+
+    def is_stale(self, dataset: str, key: str) -> bool:
+        '''Return True if the entry is missing or older than the TTL of its dataset.'''
+        row = self._connection().execute("SELECT created_at FROM entries WHERE dataset = ? AND key = ?",
+                                         (dataset, key)).fetchone()
+        return row is None or not self._is_fresh(dataset, row[0])
+
+    # Raw payloads
+
+    def get_blobs(self, dataset: str, keys: Iterable[str], include_stale: bool = False) -> dict:
+        '''
+        Read the fresh payloads of several keys of a dataset in one query.
+
+        Returns
+        -------
+        dict
+            key -> bytes for the keys that are stored and not stale, or stored
+            at all with ``include_stale``.
+        '''
+        return {key: payload for key, (payload, _) in self._get_rows(dataset, keys, include_stale).items()}
+
+    def _get_rows(self, dataset: str, keys: Iterable[str], include_stale: bool) -> dict:
+        # key -> (payload, created_at) of the stored keys
+        keys = list(keys)
+        payloads = {}
+        conn = self._connection()
+        # Stay below the SQLite limit of bound parameters
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            placeholders = ", ".join("?" * len(chunk))
+            rows = conn.execute(f"SELECT key, payload, created_at FROM entries WHERE dataset = ? AND key IN ({placeholders})",
+                                [dataset, *chunk]).fetchall()
+            payloads.update({key: (payload, created_at) for key, payload, created_at in rows
+                             if include_stale or self._is_fresh(dataset, created_at)})
+
+        if payloads:
+            with conn:
+                conn.executemany("UPDATE entries SET accessed_at = ? WHERE dataset = ? AND key = ?",
+                                 [(time.time(), dataset, key) for key in payloads])
+        return payloads
+
+    def get_blob(self, dataset: str, key: str, include_stale: bool = False) -> Optional[bytes]:
+        return self.get_blobs(dataset, [key], include_stale).get(key)
+
+    def put_blobs(self, dataset: str, items: dict) -> None:
+        '''Store several key -> bytes payloads of a dataset in one transaction.'''
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            keys = list(items)
+            previous = 0
+            for i in range(0, len(keys), 500):
+                chunk = keys[i:i + 500]
+                placeholders = ", ".join("?" * len(chunk))
+                previous += conn.execute(f"SELECT COALESCE(SUM(size), 0) FROM entries WHERE dataset = ? AND key IN ({placeholders})",
+                                         [dataset, *chunk]).fetchone()[0]
+            conn.executemany("INSERT OR REPLACE INTO entries (dataset, key, payload, size, created_at, accessed_at) "
+                             "VALUES (?, ?, ?, ?, ?, ?)",
+                             [(dataset, key, payload, len(payload), now, now) for key, payload in items.items()])
+
+        with self._lock:
+            for key in items:
+                self._forget(dataset, key)
+            if self._total_bytes is not None:
+                self._total_bytes += sum(len(payload) for payload in items.values()) - previous
+        if self.total_bytes() > self.max_bytes:
+            self.evict()
+
+    def put_blob(self, dataset: str, key: str, payload: bytes) -> None:
+        self.put_blobs(dataset, {key: payload})
+
+    def delete(self, dataset: str, key: str) -> None:
+        with self._connection() as conn:
+            conn.execute("DELETE FROM entries WHERE dataset = ? AND key = ?", (dataset, key))
+        with self._lock:
+            self._forget(dataset, key)
+            self._total_bytes = None
+
+    def clear(self, dataset: Optional[str] = None) -> None:
+        '''Delete every entry, or every entry of ``dataset``.'''
+        with self._connection() as conn:
+            if dataset is None:
+                conn.execute("DELETE FROM entries")
+            else:
+                conn.execute("DELETE FROM entries WHERE dataset = ?", (dataset,))
+        with self._lock:
+            self._lru.clear()
+            self._total_bytes = None
+
+    # DataFrames, stored as CSV so that they read back exactly like the legacy cache files
+
+    def get_frames(self, dataset: str, keys: Iterable[str], include_stale: bool = False, **read_csv_kwargs) -> dict:
+        '''
+        Read several cached frames of a dataset, from memory when possible.
+
+        Entries older than the TTL of the dataset are left out, unless
+        ``include_stale`` is True. Other keyword arguments are passed to
+        ``pd.read_csv``. The returned frames are copies, callers are free to
+        modify them.
+        '''
+        options = tuple(sorted(read_csv_kwargs.items()))
+        frames = {}
+        missing = []
+        with self._lock:
+            for key in keys:
+                cached = self._lru.get((dataset, key))
+                # Frames are kept in memory past their TTL, so that include_stale reads still hit
+                if cached is None or cached[0] != options or not (include_stale or self._is_fresh(dataset, cached[2])):
+                    missing.append(key)
+                else:
+                    self._lru.move_to_end((dataset, key))
+                    frames[key] = cached[1]
+        if instrumentation.is_enabled():
+            for key in frames:
+                instrumentation.record_cache(f"memory:{dataset}", True)
+            for key in missing:
+                instrumentation.record_cache(f"memory:{dataset}", False)
+
+        rows = self._get_rows(dataset, missing, include_stale)
+        if instrumentation.is_enabled():
+            for key in missing:
+                instrumentation.record_cache(f"sqlite:{dataset}", key in rows, len(rows.get(key, (b'',))[0]))
+
+        for key, (payload, created_at) in rows.items():
+            try:
+                with instrumentation.stage('cache.parse_csv'):
+                    frame = pd.read_csv(io.BytesIO(payload), **read_csv_kwargs)
+            except Exception as exc:
+                logger.warning("Failed to parse cached %s for %s: %s", dataset, key, exc)
+                continue
+            frames[key] = frame
+            with self._lock:
+                self._lru[(dataset, key)] = (options, frame, created_at)
+                while len(self._lru) > self.lru_size:
+                    self._lru.popitem(last=False)
+
+        return {key: frame.copy() for key, frame in frames.items()}
+
+    def get_frame(self, dataset: str, key: str, include_stale: bool = False, **read_csv_kwargs) -> Optional[pd.DataFrame]:
+        return self.get_frames(dataset, [key], include_stale, **read_csv_kwargs).get(key)
+
+    def put_frame(self, dataset: str, key: str, df: pd.DataFrame, index: bool = False) -> None:
+        self.put_frames(dataset, {key: df}, index=index)
+
+    def put_frames(self, dataset: str, frames: dict, index: bool = False) -> None:
+        with instrumentation.stage('cache.write_csv'):
+            payloads = {key: df.to_csv(index=index).encode('utf-8') for key, df in frames.items()}
+        self.put_blobs(dataset, payloads)
+
+    # Size bound
+
+    def total_bytes(self) -> int:
+        if self._total_bytes is None:
+            self._total_bytes = self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        return self._total_bytes
+
+    def evict(self, max_bytes: Optional[int] = None) -> int:
+        '''
+        Delete the least recently used entries until the store is below ``max_bytes``.
+
+        Returns
+        -------
+        int
+            The number of deleted entries.
+        '''
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        conn = self._connection()
+        # Other processes may have written to the store as well
+        self._total_bytes = None
+        excess = self.total_bytes() - int(max_bytes * EVICTION_TARGET)
+        if self.total_bytes() <= max_bytes or excess <= 0:
+            return 0
+
+        evicted = []
+        for dataset, key, size in conn.execute("SELECT dataset, key, size FROM entries ORDER BY accessed_at"):
+            if excess <= 0:
+                break
+            evicted.append((dataset, key))
+            excess -= size
+        with conn:
+            conn.executemany("DELETE FROM entries WHERE dataset = ? AND key = ?", evicted)
+
+        with self._lock:
+            for dataset, key in evicted:
+                self._forget(dataset, key)
+            self._total_bytes = None
+        logger.info("Evicted %d cache entries", len(evicted))
+        return len(evicted)
+
+    def _forget(self, dataset: str, key: str) -> None:
+        self._lru.pop((dataset, key), None)
+
+    def clear_memory(self) -> None:
+        '''Drop the in-process LRU of parsed frames.'''
+        with self._lock:
+            self._lru.clear()
+
+    # Migration of the legacy cache directory
+
+    def migrate_csv_cache(self, cache_dir: str = CACHE_DIR, remove: bool = False) -> int:
+        '''
+        Import the legacy per-query CSV cache files found under ``cache_dir``.
+
+        Parameters
+        ----------
+        cache_dir : str
+            The legacy cache directory.
+        remove : bool, default False
+            If True, delete every file once it is imported.
+
+        Returns
+        -------
+        int
+            The number of imported files.
+        '''
+        imported = {}
+        names = sorted(os.listdir(cache_dir)) if os.path.isdir(cache_dir) else []
+        for name in names:
+            for pattern, dataset in LEGACY_PATTERNS:
+                match = pattern.match(name)
+                if match is None:
+                    continue
+                path = os.path.join(cache_dir, name)
+                with open(path, 'rb') as f:
+                    imported.setdefault(dataset, {})[match['ticker']] = (f.read(), path)
+                break
+
+        for dataset, items in imported.items():
+            self.put_blobs(dataset, {key: payload for key, (payload, _) in items.items()})
+            if remove:
+                for _, path in items.values():
+                    os.remove(path)
+
+        count = sum(len(items) for items in imported.values())
+        logger.info("Imported %d legacy cache files from %s", count, cache_dir)
+        return count
+
+
+_default_store = None
+_default_store_lock = threading.Lock()
+
+
+def default_store() -> CacheStore:
+    '''
+    Return the shared cache store, importing the legacy CSV cache the first time it is created.
+    '''
+    global _default_store
+    with _default_store_lock:
+        if _default_store is None:
+            is_new = not os.path.exists(DB_FILE)
+            _default_store = CacheStore(DB_FILE)
+            if is_new:
+                _default_store.migrate_csv_cache(CACHE_DIR)
+            _default_store.upgrade()
+    return _default_store
@@ -0,0 +1,225 @@
+'''
+Command-line entry point of the PRIME model.
+
+Usage:
+    python cli.py refresh [--full] [--workers N] [--executor thread|process] [--top-n N] [--output selected_stocks.csv]
+    python cli.py --universe NAME refresh --full --shards N [--resume]
+    python cli.py select [--top-n N] [--output selected_stocks.csv]
+    python cli.py backtest [--top-n N] [--scheme equal | --summed] [--output FILE] [--plot]
+    python cli.py backtest --walk-forward [--checkpoint FILE]
+    python cli.py export [--format json|csv] [--output FILE]
+    python cli.py serve [--host HOST] [--port PORT | --socket PATH]
+
+Every subcommand imports only the modules it needs, so selecting from the
+cached stock data never loads the network or plotting libraries. With
+--offline they cannot be loaded at all: everything must come from the local
+caches, and the first piece of missing data stops the run.
+'''
+
+from __future__ import annotations
+
+import argparse
+import logging
+import os
+import sys
+
+logger = logging.getLogger(__name__)
+
+
+def _universe(args):
+    if args.universe is None:
+        return None
+    import universe
+    return universe.load_universe(args.universe)
+
+
+def refresh(args) -> int:
+    import data_model
+
+    members = _universe(args)
+    tickers = None if members is None else members.tickers
+    if args.full and args.shards > 1:
+        date_dict = data_model.build_universe_data(tickers or data_model.stock_list, args.shards,
+                                                   workers=args.workers, resume=args.resume)
+        print(f"Built {len(date_dict)} quarters")
+    elif args.full:
+        date_dict = data_model.compose_stock_data_by_date(args.workers, args.executor, tickers)
+        print(f"Built {len(date_dict)} quarters")
+    else:
+        changed_quarters = data_model.refresh_stock_data(workers=args.workers, tickers=tickers)
+        print(f"Refreshed {len(changed_quarters)} quarters: {', '.join(changed_quarters)}")
+        _reselect(args, members, changed_quarters)
+    return 0
+
+
+def _reselect(args, members, changed_quarters: list) -> None:
+    # Rank only the refreshed quarters again and patch them into the selection written by 'select'
+    if not changed_quarters or not os.path.exists(args.output):
+        return
+    import data_model
+    from main import PrimeModel, read_selected_stocks, visualize_portfolio
+
+    model = PrimeModel(data_model.load_stock_data(args.workers), members)
+    selected_stocks = model.reselect_stocks(read_selected_stocks(args.output), changed_quarters, args.top_n)
+    if visualize_portfolio(selected_stocks, args.output):
+        print(f"Updated {args.output}")
+
+
+def _select(args) -> tuple:
+    import data_model
+    from main import PrimeModel
+
+    import result_cache
+
+    cache = None if args.no_result_cache else result_cache.ResultCache()
+    model = PrimeModel(data_model.load_stock_data(args.workers), _universe(args), cache)
+    return model, model.select_stocks(args.top_n)
+
+
+def select(args) -> int:
+    from main import visualize_portfolio
+
+    _, selected_stocks = _select(args)
+    if visualize_portfolio(selected_stocks, args.output):
+        print(f"Wrote {args.output}")
+    else:
+        print(f"{args.output} is up to date")
+    return 0
+
+
+def backtest(args) -> int:
+    if args.walk_forward:
+        return _walk_forward(args)
+    model, selected_stocks = _select(args)
+    result = model.backtest(selected_stocks, scheme=args.scheme, summed=args.summed)
+
+    if args.output:
+        result.to_csv(args.output)
+        print(f"Wrote {args.output}")
+    else:
+        print(result.to_string())
+    if args.plot:
+        import matplotlib.pyplot as plt
+        from main import plot_portfolio_return
+        plot_portfolio_return(result['return'].to_dict())
+        plt.show()
+    return 0
+
+
+def _walk_forward(args) -> int:
+    import data_model
+    import walk_forward
+
+    # Each quarter is printed as soon as it is backtested
+    scheme = None if args.summed else args.scheme
+    for record in walk_forward.walk_forward(data_model.load_stock_data(args.workers), args.top_n, scheme,
+                                            checkpoint=args.checkpoint, universe=_universe(args)):
+        nav = '' if record['nav'] is None else f"  nav {record['nav']:.6f}"
+        print(f"{record['quarter']}  return {record['return']: .6f}{nav}  held {', '.join(record['held'])}", flush=True)
+    return 0
+
+
+def export(args) -> int:
+    import data_model
+    import snapshot
+
+    data = data_model.load_stock_data(args.workers)
+    if args.format == 'json':
+        output = args.output or 'stock_data_by_date.json'
+        snapshot.export_json(data.path, output)
+    else:
+        output = args.output or 'stock_data_by_quarter.csv'
+        data.to_frame().to_csv(output, index=False)
+    print(f"Wrote {output}")
+    return 0
+
+
+def serve(args) -> int:
+    import service
+
+    service.serve(args.host, args.port, args.socket, _universe(args), args.cache_size, args.reload_interval)
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(prog='cli.py', description="PRIME stock selection model.")
+    parser.add_argument('--offline', action='store_true',
+                        help="use the local caches only, never load the network libraries")
+    parser.add_argument('--instrument', metavar='REPORT',
+                        help="record timings and cache statistics and write them to REPORT (.json or .prom)")
+    parser.add_argument('-v', '--verbose', action='store_true', help="log progress")
+    parser.add_argument('--workers', type=int, default=1, help="tickers built concurrently when data is missing")
+    parser.add_argument('--no-result-cache', action='store_true',
+                        help="select and backtest every quarter again instead of reusing the unchanged results")
+    parser.add_argument('--universe', help="universe name or file (see universe.py), the default stock list if not given")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_refresh = subparsers.add_parser('refresh', help="add newly reported quarters to the stock data")
+    parser_refresh.add_argument('--full', action='store_true', help="rebuild the stock data of every quarter")
+    parser_refresh.add_argument('--executor', choices=['thread', 'process'], default='thread')
+    parser_refresh.add_argument('--shards', type=int, default=1,
+                                help="with --full, build the universe in this many worker processes")
+    parser_refresh.add_argument('--resume', action='store_true', help="with --shards, keep the shards already built")
+    parser_refresh.add_argument('--top-n', type=int, default=3, help="stocks selected in the refreshed quarters")
+    parser_refresh.add_argument('--output', default='selected_stocks.csv',
+                                help="selection written by 'select', updated for the refreshed quarters if it exists")
+    parser_refresh.set_defaults(func=refresh)
+
+    parser_select = subparsers.add_parser('select', help="select the top stocks of every quarter")
+    parser_select.add_argument('--top-n', type=int, default=3)
+    parser_select.add_argument('--output', default='selected_stocks.csv')
+    parser_select.set_defaults(func=select)
+
+    parser_backtest = subparsers.add_parser('backtest', help="backtest the selected stocks")
+    parser_backtest.add_argument('--top-n', type=int, default=3)
+    parser_backtest.add_argument('--scheme', default='equal',
+                                 help="allocation scheme, one of backtest.ALLOCATION_SCHEMES (default: equal)")
+    parser_backtest.add_argument('--summed', action='store_true',
+                                 help="legacy output: sum the returns of the selected stocks, without weights or NAV")
+    parser_backtest.add_argument('--output', help="CSV file for the quarterly returns, printed if not given")
+    parser_backtest.add_argument('--plot', action='store_true', help="plot the quarterly returns")
+    parser_backtest.add_argument('--walk-forward', action='store_true',
+                                 help="stream the backtest one quarter at a time instead")
+    parser_backtest.add_argument('--checkpoint', help="with --walk-forward, resume from and save progress to this file")
+    parser_backtest.set_defaults(func=backtest)
+
+    parser_export = subparsers.add_parser('export', help="export the stock data")
+    parser_export.add_argument('--format', choices=['json', 'csv'], default='json')
+    parser_export.add_argument('--output')
+    parser_export.set_defaults(func=export)
+
+    parser_serve = subparsers.add_parser('serve', help="answer selection, ranking and backtest queries over HTTP/JSON")
+    parser_serve.add_argument('--host', default='127.0.0.1')
+    parser_serve.add_argument('--port', type=int, default=8765)
+    parser_serve.add_argument('--socket', help="listen on this Unix socket instead of a TCP port")
+    parser_serve.add_argument('--cache-size', type=int, default=256, help="responses kept in the LRU cache")
+    parser_serve.add_argument('--reload-interval', type=float, default=2.0,
+                              help="seconds between two checks of the stock data files for changes")
+    parser_serve.set_defaults(func=serve)
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    import alpha_vantage
+    import offline
+    if args.offline:
+        offline.enable()
+    if args.instrument:
+        import instrumentation
+        instrumentation.enable(args.instrument)
+
+    try:
+        return args.func(args)
+    except offline.OfflineError as exc:
+        print(f"error: {exc}", file=sys.stderr)
+        return 2
+    except alpha_vantage.QuotaExceededError as exc:
+        print(f"error: {exc}, run the refresh again to resume it", file=sys.stderr)
+        return 3
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,257 @@
+'''
+This module contains the daily-resolution backtest of the selected stocks.
+
+The portfolio is rebalanced to the weights of each quarter's selection on a
+rebalance date and held, drifting with prices, until the next one. The NAV of
+every trading day is computed in one pass over a dense date x ticker price
+matrix: each day's value is its segment's starting NAV times the weighted
+price growth since the segment started, and segment starting NAVs are a
+cumulative product of segment growths net of transaction costs.
+
+Transaction costs are charged on the traded weight at every rebalance, that is
+the difference between the target weights and the weights the previous
+holdings drifted to. Cost models are functions of the traded weights and of
+the trailing daily volatility of every ticker, see ``proportional_costs`` and
+``volatility_slippage``.
+'''
+
+from __future__ import annotations
+
+from datetime import datetime, timedelta
+from typing import Callable, Optional
+
+import numpy as np
+import pandas as pd
+
+import backtest
+import price_store
+import trading_calendar
+
+# Trading days of the trailing volatility handed to cost models
+VOLATILITY_LOOKBACK = 20
+
+REBALANCE_RULES = ['window', 'quarter_end']
+
+
+def proportional_costs(commission_bps: float = 0.0, slippage_bps: float = 0.0) -> Callable:
+    '''
+    Cost model charging a fixed number of basis points on every traded weight.
+    '''
+    rate = (commission_bps + slippage_bps) / 1e4
+
+    def costs(traded: np.ndarray, volatility: np.ndarray) -> np.ndarray:
+        return rate * traded.sum(axis=1)
+    return costs
+
+
+def volatility_slippage(multiplier: float = 0.1, commission_bps: float = 0.0) -> Callable:
+    '''
+    Cost model whose slippage on a ticker is ``multiplier`` times its trailing daily volatility.
+
+    Volatile stocks have wider spreads and move more while an order is worked,
+    so a 2% daily volatility with the default multiplier costs 20 basis points.
+    Tickers without a volatility estimate are charged the commission only.
+    '''
+    rate = commission_bps / 1e4
+
+    def costs(traded: np.ndarray, volatility: np.ndarray) -> np.ndarray:
+        return (traded * (rate + multiplier * np.nan_to_num(volatility))).sum(axis=1)
+    return costs
+
+
+def rebalance_dates(quarters: list, rule: str = 'window', lag_days: int = 0) -> dict:
+    '''
+    Return the date the selection of every quarter is traded on.
+
+    Parameters
+    ----------
+    quarters : list
+        Quarter labels of the selections.
+    rule : str, default 'window'
+        'window' trades at the start of the return window the quarterly
+        backtest holds the selection over, ``backtest.QUARTER_DAYS + 1`` days
+        before the ``quarter_start_date`` of the next quarter. 'quarter_end'
+        trades on the first day after the selected quarter ends.
+    lag_days : int, default 0
+        Days added to every date, e.g. to wait for the earnings reports.
+
+    Returns
+    -------
+    dict
+        quarter -> datetime. Trades happen at the close of the first trading
+        session on or after it.
+    '''
+    if rule not in REBALANCE_RULES:
+        raise ValueError(f"Unknown rebalance rule '{rule}', expected one of {REBALANCE_RULES}")
+    dates = {}
+    for quarter in quarters:
+        if rule == 'window':
+            date = backtest.quarter_start_date(backtest.next_quarter(quarter)) - timedelta(days=backtest.QUARTER_DAYS + 1)
+        else:
+            year, q = backtest.quarter_key(quarter)
+            date = (pd.Timestamp(year=year, month=3 * q, day=1) + pd.offsets.MonthEnd(0) + pd.Timedelta(days=1)).to_pydatetime()
+        dates[quarter] = date + timedelta(days=lag_days)
+    return dates
+
+
+def price_matrix(tickers: list, start, end) -> pd.DataFrame:
+    '''
+    Build the dense date x ticker matrix of daily closes from the price store.
+
+    Rows are the trading sessions of the calendar in ``[start, end]``. A ticker
+    that did not trade on a session keeps its previous close, and is NaN before
+    its first trade.
+    '''
+    calendar = trading_calendar.get_calendar(until=end)
+    sessions = calendar.sessions[(calendar.sessions >= price_store.to_days(start)) &
+                                 (calendar.sessions <= price_store.to_days(end))]
+    closes = np.full((len(sessions), len(tickers)), np.nan)
+    for t, ticker in enumerate(tickers):
+        closes[:, t] = price_store.load_prices(ticker, until=end).close_on(sessions)
+    return pd.DataFrame(closes, index=pd.DatetimeIndex(sessions.astype('datetime64[ns]'), name='date'),
+                        columns=tickers).ffill()
+
+
+def _trailing_volatility(log_prices: np.ndarray, rows: np.ndarray, lookback: int) -> np.ndarray:
+    # Standard deviation of the daily log returns of the lookback sessions up to each row, from running sums
+    daily = np.diff(log_prices, axis=0, prepend=np.nan)
+    valid = ~np.isnan(daily)
+    daily = np.where(valid, daily, 0)
+    zeros = np.zeros((1, daily.shape[1]))
+    cumsum = np.concatenate([zeros, np.cumsum(daily, axis=0)])
+    cumsum_sq = np.concatenate([zeros, np.cumsum(daily ** 2, axis=0)])
+    counts = np.concatenate([zeros, np.cumsum(valid, axis=0)])
+    hi = rows + 1
+    lo = np.maximum(hi - lookback, 0)
+    count = counts[hi] - counts[lo]
+    total = cumsum[hi] - cumsum[lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = (cumsum_sq[hi] - cumsum_sq[lo] - total ** 2 / count) / (count - 1)
+    return np.where(count > 1, np.sqrt(np.maximum(variance, 0)), np.nan)
+
+
+def _quarter_sequence(selected_stocks: dict, start_year: int) -> list:
+    # Every quarter from the first to the last selection held from start_year on, including those without one
+    quarters = sorted((quarter for quarter in selected_stocks
+                       if backtest.quarter_key(backtest.next_quarter(quarter))[0] >= start_year), key=backtest.quarter_key)
+    sequence = quarters[:1]
+    while quarters and sequence[-1] != quarters[-1]:
+        sequence.append(backtest.next_quarter(sequence[-1]))
+    return sequence
+
+
+def daily_nav(selected_stocks: dict, prices: pd.DataFrame, weights: Optional[dict] = None,
+              rebalance: Optional[dict] = None, cost_model: Optional[Callable] = None,
+              start_year: int = backtest.START_YEAR, end=None) -> pd.DataFrame:
+    '''
+    Backtest the selected stocks day by day.
+
+    Parameters
+    ----------
+    selected_stocks : dict
+        quarter -> list of selected tickers, as returned by ``select_stocks``.
+        Selections held over a quarter before ``start_year`` are skipped, and a
+        quarter without a selection is held in cash.
+    prices : pd.DataFrame
+        Dense date x ticker daily closes, see ``price_matrix``.
+    weights : dict, optional
+        quarter -> {ticker: weight} as returned by ``backtest.allocate``, equal
+        weights by default. Weights summing to less than 1 leave the rest in cash.
+    rebalance : dict, optional
+        quarter -> date the selection is traded on, ``rebalance_dates`` with the
+        'window' rule by default.
+    cost_model : callable, optional
+        ``cost_model(traded, volatility)`` returns the cost of every rebalance
+        as a fraction of NAV, from the (rebalance, ticker) absolute traded
+        weights and trailing daily volatilities. No costs by default.
+    end : datetime, optional
+        Last day of the backtest, the date the quarter after the last one would
+        be traded on by default.
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by trading day from the first rebalance, with the 'nav'
+        starting from 1 before costs, the daily 'return', the 'drawdown' from
+        the running NAV peak, and the 'turnover' and 'cost' of the rebalance
+        traded that day (0 on other days).
+    '''
+    sequence = _quarter_sequence(selected_stocks, start_year)
+    columns = ['nav', 'return', 'drawdown', 'turnover', 'cost']
+    if not sequence:
+        return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name='date'))
+    rebalance = rebalance or rebalance_dates(sequence + [backtest.next_quarter(sequence[-1])])
+    if end is None:
+        end = rebalance.get(backtest.next_quarter(sequence[-1]), prices.index[-1])
+
+    tickers = sorted({ticker for quarter in sequence for ticker in selected_stocks.get(quarter, [])})
+    dates = prices.index
+    close = prices.reindex(columns=tickers).to_numpy(dtype=np.float64)
+    last_row = np.searchsorted(dates.values, np.datetime64(pd.Timestamp(end)), side='right')
+
+    # Target weights of every rebalance, traded at the close of the first session on or after its date
+    rows = np.searchsorted(dates.values, np.array([np.datetime64(pd.Timestamp(rebalance[quarter])) for quarter in sequence]))
+    target = np.zeros((len(sequence), len(tickers)))
+    column = {ticker: t for t, ticker in enumerate(tickers)}
+    for k, quarter in enumerate(sequence):
+        stocks = selected_stocks.get(quarter, [])
+        quarter_weights = (weights or {}).get(quarter)
+        for ticker in stocks:
+            target[k, column[ticker]] = 1 / len(stocks) if quarter_weights is None else quarter_weights.get(ticker, 0)
+    # Rebalances falling on the same session or after the end: the last one traded that session wins
+    keep = (rows < min(last_row, len(dates))) & np.append(rows[1:] != rows[:-1], True)
+    rows, target = rows[keep], target[keep]
+    if not len(rows):
+        return pd.DataFrame(columns=columns, index=pd.DatetimeIndex([], name='date'))
+
+    # Price growth of every held ticker since the start of the segment each day falls in
+    days = np.arange(rows[0], last_row)
+    segment = np.searchsorted(rows, days, side='right') - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = close[days] / close[rows[segment]]
+        end_growth = close[rows[1:]] / close[rows[:-1]]
+    # A ticker without a price when it is bought cannot be held, its weight stays in cash
+    growth = np.where(np.isfinite(growth), growth, 1.0)
+    end_growth = np.where(np.isfinite(end_growth), end_growth, 1.0)
+    cash = 1 - target.sum(axis=1)
+    day_growth = (target[segment] * growth).sum(axis=1) + cash[segment]
+    segment_growth = (target[:-1] * end_growth).sum(axis=1) + cash[:-1]
+
+    # Weights the previous holdings drifted to right before each rebalance
+    drifted = np.zeros_like(target)
+    drifted[1:] = target[:-1] * end_growth / segment_growth[:, None]
+    traded = np.abs(target - drifted)
+    costs = np.zeros(len(rows))
+    if cost_model is not None:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            volatility = _trailing_volatility(np.log(close), rows, VOLATILITY_LOOKBACK)
+        costs = np.asarray(cost_model(traded, volatility), dtype=np.float64)
+
+    # NAV right after each rebalance, net of its costs
+    segment_nav = np.cumprod(np.concatenate([[1.0], segment_growth]) * (1 - costs))
+    nav = segment_nav[segment] * day_growth
+
+    result = pd.DataFrame({'nav': nav}, index=dates[days])
+    result['return'] = result['nav'].pct_change().fillna(result['nav'].iloc[0] - 1)
+    result['drawdown'] = 1 - result['nav'] / result['nav'].cummax()
+    result['turnover'] = 0.0
+    result['cost'] = 0.0
+    result.iloc[rows - rows[0], result.columns.get_loc('turnover')] = traded.sum(axis=1)
+    result.iloc[rows - rows[0], result.columns.get_loc('cost')] = costs
+    return result
+
+
+def run(selected_stocks: dict, weights: Optional[dict] = None, rule: str = 'window', lag_days: int = 0,
+        cost_model: Optional[Callable] = None, start_year: int = backtest.START_YEAR) -> pd.DataFrame:
+    '''
+    Run ``daily_nav`` on the closes of the price store, rebalancing with ``rebalance_dates(rule, lag_days)``.
+    '''
+    sequence = _quarter_sequence(selected_stocks, start_year)
+    if not sequence:
+        return daily_nav(selected_stocks, pd.DataFrame(), weights, start_year=start_year)
+    rebalance = rebalance_dates(sequence + [backtest.next_quarter(sequence[-1])], rule, lag_days)
+    tickers = sorted({ticker for quarter in sequence for ticker in selected_stocks.get(quarter, [])})
+    # The price store cannot know the future, a backtest reaching past today ends today
+    end = min(max(rebalance.values()), datetime.now())
+    prices = price_matrix(tickers, min(rebalance.values()), end)
+    return daily_nav(selected_stocks, prices, weights, rebalance, cost_model, start_year, end)
@@ -1,78 +1,264 @@
 import pandas as pd
 import numpy as np
+import alpha_vantage
+import backtest
 import data_utils
+import factors
+import instrumentation
+import offline
+import price_store
+import ranking
+import snapshot
+import stock_utils
 from datetime import datetime
+import hashlib
 import json
+import logging
 import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+
+logger = logging.getLogger(__name__)
 
 stock_list = ["NVDA", "AMD", "AVGO", "MRVL", "ADSK", "QCOM", "MU", "ASML"]
 
-def merge_indicator_data(ticker: str) -> pd.DataFrame:
+# Partitions written by the shards of build_universe_data
+PARTITION_DIR = "stock_data_partitions"
+
+def fetch_indicator_inputs(ticker: str, since: datetime = None, refresh: bool = False) -> dict:
+    '''
+    Fetch the raw inputs the active factors need for a ticker, see factors.py.
+    The 'rows' to compute are the fiscal dates of the reported earnings, after since if it is given.
+    If refresh is True, the earnings and income statements are fetched again instead of read from the cache.
+    Returns None if the ticker has no fiscal dates to compute.
+    '''
+    needed = factors.required_inputs()
+    eps = data_utils.get_stock_eps(ticker, refresh)
+    rows = eps if since is None or eps.empty else eps[pd.to_datetime(eps['date']) > since]
+    if rows.empty:
+        return None
+
+    inputs = {'rows': rows, 'earnings': eps}
+    if 'income_statement' in needed:
+        inputs['income_statement'] = stock_utils.get_stock_revenue(ticker, refresh)
+    if 'quarterly_income_statement' in needed:
+        # Answered by the same INCOME_STATEMENT response as the annual reports
+        inputs['quarterly_income_statement'] = stock_utils.get_stock_quarterly_revenue(
+            ticker, refresh and 'income_statement' not in needed)
+    if 'prices' in needed:
+        # The price history is loaded once and shared by every price factor
+        inputs['prices'] = price_store.load_prices(ticker, until=pd.to_datetime(rows['date']).max())
+    return inputs
+
+@instrumentation.timed('assemble_indicator_data')
+def assemble_indicator_data(inputs: dict) -> pd.DataFrame:
+    '''
+    Compute the active factors of many tickers into one long-format frame.
+
+    The inputs of all tickers are stacked first, so every factor is computed in
+    one pass over the whole universe instead of per ticker.
+
+    Parameters
+    ----------
+    inputs : dict
+        ticker -> output of fetch_indicator_inputs.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per (ticker, fiscal date) with a complete set of factors,
+        columns 'date', 'ticker' and the metrics, sorted by the order of the
+        tickers in ``inputs`` and then by date.
+    '''
+    frame = factors.compute(inputs)
+    return frame.dropna(subset=factors.METRICS).reset_index(drop=True)
+
+@instrumentation.timed('merge_indicator_data')
+def merge_indicator_data(ticker: str, since: datetime = None, refresh: bool = False) -> pd.DataFrame:
     '''
     Merge the indicator data for a given ticker.
+    If since is given, only the fiscal dates after it are computed.
+    If refresh is True, the earnings and income statements are fetched again instead of read from the cache.
     '''
-    eps = data_utils.get_stock_eps(ticker)
-    pe_ratio = data_utils.p_e_ratio(ticker)
-    yoy_return = data_utils.get_yoy_return(ticker)
-    quarterly_returns = []
-
-    for index, row in eps.iterrows():
-        date = row['date'] if isinstance(row['date'], datetime) else datetime.strptime(row['date'], "%Y-%m-%d")
-        quarterly_return_six_month = data_utils.quarterly_return(ticker, date, 180)
-        quarterly_return_one_year = data_utils.quarterly_return(ticker, date, 360)
-        
-        quarterly_returns.append({
-            'date': row['date'],
-            'quarterly_return_six_month': quarterly_return_six_month.iloc[0, 0],
-            'quarterly_return_one_year': quarterly_return_one_year.iloc[0, 0]
-        })
-
-    quarterly_returns_df = pd.DataFrame(quarterly_returns)
-
-    # Merge the dataframes
-    # Ensure 'date' columns are of datetime type for both DataFrames
-    eps['date'] = pd.to_datetime(eps['date'])
-    pe_ratio['date'] = pd.to_datetime(pe_ratio['date'])
-    quarterly_returns_df['date'] = pd.to_datetime(quarterly_returns_df['date'])
-
-    merged_data = pd.merge(eps, pe_ratio, on='date', how='left')
-    merged_data = pd.merge(merged_data, quarterly_returns_df, on='date', how='left')
-    # Convert 'date' column to datetime for proper merging
-    merged_data['date'] = pd.to_datetime(merged_data['date'])
-
-    # Prepare the yoy_return data
-    yoy_return['date'] = pd.to_datetime(yoy_return['date'])
+    inputs = fetch_indicator_inputs(ticker, since, refresh)
+    if inputs is None:
+        return pd.DataFrame()
+    return assemble_indicator_data({ticker: inputs}).drop(columns='ticker')
 
-    
-    # Set the date as index for both dataframes to enable proper merging
-    yoy_return_indexed = yoy_return.set_index('date')
-    merged_data_indexed = merged_data.set_index('date')
-    
-    # Sort both dataframes in ascending order (oldest to newest) as required by merge_asof
-    yoy_return_indexed = yoy_return_indexed.sort_index()
-    merged_data_indexed = merged_data_indexed.sort_index()
-    
-    # Use merge_asof to get the last recorded yoy_return for each quarterly data point
-    # This will use the last available yoy_return that is <= the quarterly date
-    merged_data_indexed = pd.merge_asof(
-        merged_data_indexed, 
-        yoy_return_indexed[['yoy_return']], 
-        left_index=True, 
-        right_index=True, 
-        direction='backward'
-    )
-    
-    # Reset the index to get the date column back
-    merged_data = merged_data_indexed.reset_index()
-    merged_data.dropna(inplace=True)
-    return merged_data
-
-def compose_stock_data() -> pd.DataFrame:
-    ticker_dataframes = {}
-    for ticker in stock_list:
-        merged_data = merge_indicator_data(ticker)
-        ticker_dataframes[ticker] = merged_data
-    return ticker_dataframes
+# Errors that stop a build instead of skipping the ticker, since every other ticker would fail the same way
+FATAL_ERRORS = (offline.OfflineError, alpha_vantage.QuotaExceededError)
+
+def _fetch_indicator_inputs_isolated(ticker: str, since: datetime = None, refresh: bool = False):
+    try:
+        return fetch_indicator_inputs(ticker, since, refresh)
+    except FATAL_ERRORS:
+        raise
+    except Exception as exc:
+        logger.warning("Failed to build indicator data for %s: %s", ticker, exc)
+        return None
+
+@instrumentation.timed('fetch_ticker_inputs')
+def fetch_ticker_inputs(tickers: list, workers: int = 1, executor: str = 'thread', since: dict = None,
+                        refresh: bool = False) -> dict:
+    '''
+    Run fetch_indicator_inputs for every ticker, optionally on a thread or process pool.
+
+    Parameters
+    ----------
+    tickers : list
+        The ticker symbols to build.
+    workers : int, default 1
+        Number of tickers built concurrently. 1 builds them one after another.
+    executor : str, default 'thread'
+        'thread' or 'process'. Builds are mostly waiting on the network, so
+        threads are usually enough.
+    since : dict, optional
+        ticker -> date after which the fiscal dates of that ticker are kept.
+    refresh : bool, default False
+        Fetch the earnings and income statements again instead of reading them from the cache.
+
+    Returns
+    -------
+    dict
+        ticker -> fetched inputs, in the order of ``tickers``. A ticker that
+        fails or has nothing to compute is left out without stopping the others.
+    '''
+    since = since or {}
+    results = {}
+    if workers <= 1:
+        for done, ticker in enumerate(tickers, start=1):
+            results[ticker] = _fetch_indicator_inputs_isolated(ticker, since.get(ticker), refresh)
+            logger.info("Built %d/%d tickers (%s)", done, len(tickers), ticker)
+    else:
+        if executor == 'thread':
+            pool = ThreadPoolExecutor(max_workers=workers)
+        elif executor == 'process':
+            pool = ProcessPoolExecutor(max_workers=workers)
+        else:
+            raise ValueError(f"Unknown executor '{executor}', expected 'thread' or 'process'")
+        with pool:
+            futures = {pool.submit(_fetch_indicator_inputs_isolated, ticker, since.get(ticker), refresh): ticker
+                       for ticker in tickers}
+            for done, future in enumerate(as_completed(futures), start=1):
+                ticker = futures[future]
+                try:
+                    results[ticker] = future.result()
+                except FATAL_ERRORS:
+                    raise
+                except Exception as exc:
+                    # A worker process died
+                    logger.warning("Failed to build indicator data for %s: %s", ticker, exc)
+                    results[ticker] = None
+                logger.info("Built %d/%d tickers (%s)", done, len(tickers), ticker)
+
+    return {ticker: results[ticker] for ticker in tickers if results[ticker] is not None}
+
+def assemble_stock_data(tickers: list = None, workers: int = 1, executor: str = 'thread') -> pd.DataFrame:
+    '''
+    Build the long-format indicator data of a universe, stock_list by default.
+    See fetch_ticker_inputs and assemble_indicator_data.
+    '''
+    return assemble_indicator_data(fetch_ticker_inputs(stock_list if tickers is None else tickers, workers, executor))
+
+def build_ticker_data(tickers: list, workers: int = 1, executor: str = 'thread') -> dict:
+    '''
+    Return the merged indicator data of every ticker, as merge_indicator_data would.
+    See fetch_ticker_inputs for the parameters.
+    '''
+    inputs = fetch_ticker_inputs(tickers, workers, executor)
+    frame = assemble_indicator_data(inputs)
+    groups = dict(list(frame.groupby('ticker', sort=False)))
+    empty = frame.iloc[:0]
+    return {ticker: groups.get(ticker, empty).drop(columns='ticker').reset_index(drop=True) for ticker in inputs}
+
+def compose_stock_data(workers: int = 1, executor: str = 'thread') -> pd.DataFrame:
+    return build_ticker_data(stock_list, workers, executor)
+
+def _partition_path(directory: str, shard: int, shards: int, tickers: list) -> str:
+    # The name holds a hash of the shard's tickers, so a resumed build never keeps a shard of another partition
+    digest = hashlib.blake2b('\n'.join(tickers).encode('utf-8'), digest_size=8).hexdigest()
+    return os.path.join(directory, f"part-{shard:05d}-of-{shards:05d}-{digest}.csv")
+
+def _build_partition(tickers: list, path: str, workers: int = 1) -> str:
+    # Runs in a worker process: build one shard of the universe and write it to its own file
+    frame = assemble_indicator_data(fetch_ticker_inputs(tickers, workers))
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    if frame.empty:
+        # An empty file marks a finished shard without data
+        open(tmp_path, 'w').close()
+    else:
+        frame.to_csv(tmp_path, index=False)
+    os.replace(tmp_path, path)
+    return path
+
+@instrumentation.timed('build_partitions')
+def build_partitions(tickers: list, shards: int, directory: str = PARTITION_DIR, workers: int = 1,
+                     resume: bool = False) -> list:
+    '''
+    Build the long-format indicator data of a universe in shards on a process pool.
+
+    The tickers are split into ``shards`` contiguous chunks, and every shard is
+    built by its own worker process and written to its own partition file, so
+    shards never contend for a shared output and a failed run can be resumed.
+
+    Parameters
+    ----------
+    tickers : list
+        The ticker symbols of the universe.
+    shards : int
+        Number of shards, and of worker processes.
+    directory : str
+        Directory of the partition files.
+    workers : int, default 1
+        Tickers built concurrently on threads within every shard.
+    resume : bool, default False
+        Keep the partitions a previous run finished for the same shards of the same tickers.
+
+    Returns
+    -------
+    list
+        The partition files, in ticker order.
+    '''
+    os.makedirs(directory, exist_ok=True)
+    chunks = [list(chunk) for chunk in np.array_split(np.asarray(tickers, dtype=object), shards)]
+    paths = [_partition_path(directory, shard, shards, chunks[shard]) for shard in range(shards)]
+    pending = [shard for shard in range(shards) if chunks[shard] and not (resume and os.path.exists(paths[shard]))]
+
+    # Shards of other partitions, e.g. from before the universe changed, are never merged
+    current = {os.path.basename(path) for path in paths}
+    for name in os.listdir(directory):
+        if name.startswith('part-') and name.endswith('.csv') and name not in current:
+            os.remove(os.path.join(directory, name))
+
+    if len(pending) == 1:
+        _build_partition(chunks[pending[0]], paths[pending[0]], workers)
+    elif pending:
+        with ProcessPoolExecutor(max_workers=len(pending)) as pool:
+            futures = {pool.submit(_build_partition, chunks[shard], paths[shard], workers): shard for shard in pending}
+            for done, future in enumerate(as_completed(futures), start=1):
+                future.result()
+                logger.info("Built %d/%d shards (%s)", done, len(pending), paths[futures[future]])
+    return [path for shard, path in enumerate(paths) if chunks[shard]]
+
+def merge_partitions(paths: list) -> pd.DataFrame:
+    '''
+    Concatenate partition files into the long-format frame of the whole universe.
+    '''
+    frames = [pd.read_csv(path, parse_dates=['date'], float_precision='round_trip')
+              for path in paths if os.path.getsize(path) > 0]
+    if not frames:
+        return assemble_indicator_data({})
+    return pd.concat(frames, ignore_index=True)
+
+def build_universe_data(tickers: list, shards: int = 1, directory: str = PARTITION_DIR, workers: int = 1,
+                        resume: bool = False) -> dict:
+    '''
+    Build the stock data of a universe with build_partitions, then merge the
+    partitions and save the by-date data like compose_stock_data_by_date does.
+    '''
+    frame = merge_partitions(build_partitions(tickers, shards, directory, workers, resume))
+    date_dict = stock_data_by_date(frame)
+    save_stock_data(date_dict, frame)
+    return date_dict
 
 def format_quarter(date: datetime) -> str:
     month = date.month
@@ -87,24 +273,152 @@ def format_quarter(date: datetime) -> str:
         quarter = 4
     return f"{year}_q{quarter}"
 
-def compose_stock_data_by_date() -> pd.DataFrame:
+def format_quarters(dates: pd.Series) -> pd.Series:
+    '''
+    Vectorized format_quarter of a datetime Series.
+    '''
+    return dates.dt.year.astype(str) + '_q' + ((dates.dt.month - 1) // 3 + 1).astype(str)
+
+def _by_quarter(frame: pd.DataFrame) -> pd.DataFrame:
+    # Latest fiscal date of every ticker in every quarter, in the order the nested dict is built in:
+    # quarters by first appearance, tickers in frame order within a quarter
+    frame = frame.assign(quarter=format_quarters(frame['date']))
+    quarters = pd.unique(frame['quarter'])
+    frame = frame.drop_duplicates(['quarter', 'ticker'], keep='last')
+    position = pd.Series(np.arange(len(quarters)), index=quarters)
+    return frame.sort_values('quarter', key=lambda column: column.map(position), kind='stable')
+
+def stock_data_by_date(frame: pd.DataFrame) -> dict:
+    '''
+    Convert the long-format indicator data into the ``date -> ticker -> metric`` dict.
+    '''
+    frame = _by_quarter(frame)
+    metrics = [column for column in frame.columns if column not in ('date', 'ticker', 'quarter')]
+    return {quarter: group.set_index('ticker')[metrics].to_dict('index')
+            for quarter, group in frame.groupby('quarter', sort=False)}
+
+def stock_data_panel(frame: pd.DataFrame) -> ranking.FactorPanel:
+    '''
+    Convert the long-format indicator data into the FactorPanel of stock_data_by_date(frame).
+    '''
+    frame = _by_quarter(frame)
+    metrics = [column for column in frame.columns if column not in ('date', 'ticker', 'quarter')]
+    quarters = list(pd.unique(frame['quarter']))
+    tickers = list(pd.unique(frame['ticker']))
+    q = pd.Index(quarters).get_indexer(frame['quarter'])
+    t = pd.Index(tickers).get_indexer(frame['ticker'])
 
-    date_dict = {}
+    values = np.full((len(quarters), len(tickers), len(metrics)), np.nan)
+    values[q, t] = frame[metrics].to_numpy(dtype=np.float64)
+    order = np.full((len(quarters), len(tickers)), len(tickers), dtype=np.int64)
+    order[q, t] = frame.groupby('quarter', sort=False).cumcount().to_numpy()
+    return ranking.FactorPanel(quarters, tickers, metrics, values, order)
 
-    for ticker in stock_list:
-        merged_data = merge_indicator_data(ticker)
-        merged_data['date'] = merged_data['date'].apply(format_quarter)
+def quarter_end(quarter: str) -> datetime:
+    '''
+    Return the last day of a quarter label such as 2024_q3.
+    '''
+    year, quarter = backtest.quarter_key(quarter)
+    return (pd.Timestamp(year=year, month=3 * quarter, day=1) + pd.offsets.MonthEnd(0)).to_pydatetime()
 
-        for _, row in merged_data.iterrows():
-            date = row['date']
-            if date not in date_dict:
-                date_dict[date] = {}
-            date_dict[date][ticker] = {k: v for k, v in row.to_dict().items() if k not in ['ticker', 'date']}
+@instrumentation.timed('compose_stock_data_by_date')
+def compose_stock_data_by_date(workers: int = 1, executor: str = 'thread', tickers: list = None) -> pd.DataFrame:
 
+    # One long frame for the whole universe, reshaped into the by-date dict and the snapshot panel
+    frame = assemble_stock_data(tickers, workers, executor)
+    date_dict = stock_data_by_date(frame)
+
+    save_stock_data(date_dict, frame)
+    return date_dict
+
+@instrumentation.timed('save_stock_data')
+def save_stock_data(date_dict: dict, frame: pd.DataFrame = None) -> None:
+    '''
+    Save the stock data to stock_data_by_date.json and the columnar snapshot.
+    If the long-format frame it was built from is given, it is saved to
+    combined_stock_data.csv and the snapshot is written straight from it.
+    '''
     # Save the date_dict to a JSON file
     with open('stock_data_by_date.json', 'w') as json_file:
         json.dump(date_dict, json_file, indent=4)
-    return date_dict
+    # and to the columnar snapshot that load_stock_data opens
+    if frame is None:
+        snapshot.write_snapshot(date_dict)
+    else:
+        snapshot.write_panel(stock_data_panel(frame))
+        frame.to_csv('combined_stock_data.csv', index=False)
+
+@instrumentation.timed('refresh_stock_data')
+def refresh_stock_data(date_dict: dict = None, workers: int = 1, tickers: list = None) -> list:
+    '''
+    Add the fiscal quarters reported since the last build to the stock data.
+
+    The earnings and income statements of every ticker are fetched again, and
+    only the quarters that are newer than the latest quarter the snapshot holds
+    for that ticker are computed and patched in. The snapshot file is updated
+    in place.
+
+    Parameters
+    ----------
+    date_dict : dict, optional
+        The stock data to update, loaded from stock_data_by_date.json if not given.
+    workers : int, default 1
+        Number of tickers refreshed concurrently on a thread pool.
+    tickers : list, optional
+        The universe to refresh, stock_list by default.
+
+    Returns
+    -------
+    list
+        The quarters whose data changed, to be ranked again.
+    '''
+    tickers = stock_list if tickers is None else tickers
+    if date_dict is None:
+        if not os.path.exists('stock_data_by_date.json'):
+            return list(compose_stock_data_by_date(workers, tickers=tickers))
+        date_dict = load_stock_data()
+    if isinstance(date_dict, snapshot.Snapshot):
+        date_dict = date_dict.to_dict()
+
+    latest_quarters = {}
+    for date, stocks in date_dict.items():
+        for ticker in stocks:
+            if ticker not in latest_quarters or backtest.quarter_key(date) > backtest.quarter_key(latest_quarters[ticker]):
+                latest_quarters[ticker] = date
+
+    since = {ticker: quarter_end(quarter) for ticker, quarter in latest_quarters.items()}
+    # Queued so that a refresh stopped by the daily quota resumes with the tickers it did not get to
+    with stock_utils.refresh_batch(tickers):
+        inputs = fetch_ticker_inputs(tickers, workers, 'thread', since=since, refresh=True)
+    new_data = assemble_indicator_data(inputs)
+
+    new_quarters = stock_data_by_date(new_data)
+    for date, stocks in new_quarters.items():
+        date_dict.setdefault(date, {}).update(stocks)
+    changed_quarters = list(new_quarters)
+
+    # Keep the tickers of every quarter in the order a full rebuild would write them
+    order = {ticker: i for i, ticker in enumerate(tickers)}
+    for date in changed_quarters:
+        date_dict[date] = dict(sorted(date_dict[date].items(), key=lambda item: order.get(item[0], len(order))))
+
+    if changed_quarters:
+        save_stock_data(date_dict)
+        _append_combined_stock_data(new_data, tickers)
+    logger.info("Refreshed %d quarters", len(changed_quarters))
+    return changed_quarters
+
+def _append_combined_stock_data(new_data: pd.DataFrame, tickers: list, path: str = 'combined_stock_data.csv') -> None:
+    # Patch the refreshed rows into the long-format file, keeping it ordered like a full rebuild writes it
+    if os.path.exists(path):
+        combined = pd.read_csv(path, parse_dates=['date'], float_precision='round_trip')
+        combined = pd.concat([combined, new_data], ignore_index=True)
+        combined = combined.drop_duplicates(['ticker', 'date'], keep='last')
+    else:
+        combined = new_data
+    order = {ticker: i for i, ticker in enumerate(tickers)}
+    combined = combined.sort_values(['ticker', 'date'], key=lambda column: column.map(order) if column.name == 'ticker' else column)
+    combined.to_csv(path, index=False)
 
 '''
 def compose_nasdaq_100_data(start_date: datetime = datetime(2025, 4, 30), end_date: datetime = datetime(2025, 4, 30)) -> pd.DataFrame:
@@ -112,10 +426,23 @@ def compose_nasdaq_100_data(start_date: datetime = datetime(2025, 4, 30), end_da
     return nasdaq_100_data
 '''
 
-def load_stock_data() -> dict:
-    if not os.path.exists('stock_data_by_date.json'):
-        return compose_stock_data_by_date()
-    
-    with open('stock_data_by_date.json', 'r') as json_file:
-        return json.load(json_file)
+@instrumentation.timed('load_stock_data')
+def load_stock_data(workers: int = 1, executor: str = 'thread', quarters: list = None, metrics: list = None) -> snapshot.Snapshot:
+    '''
+    Load the stock data by date, building it first if it does not exist.
+
+    The data is opened lazily from the columnar snapshot, which is imported
+    from stock_data_by_date.json whenever the JSON file is newer. The returned
+    snapshot reads like the JSON dict. If quarters or metrics are given, only
+    those are loaded.
+    '''
+    if not os.path.exists('stock_data_by_date.json') and not os.path.exists(snapshot.SNAPSHOT_DIR):
+        compose_stock_data_by_date(workers, executor)
+
+    index_file = os.path.join(snapshot.SNAPSHOT_DIR, snapshot.INDEX_FILE)
+    if not os.path.exists(index_file) or (os.path.exists('stock_data_by_date.json') and
+                                          os.path.getmtime('stock_data_by_date.json') > os.path.getmtime(index_file)):
+        snapshot.import_json('stock_data_by_date.json', snapshot.SNAPSHOT_DIR)
+
+    return snapshot.Snapshot(snapshot.SNAPSHOT_DIR, quarters, metrics)
     
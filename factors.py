@@ -0,0 +1,344 @@
+'''
+This module contains the factor registry of the stock data.
+
+A factor declares the raw inputs it needs (INPUTS) and provides one function
+computing it for every (ticker, fiscal date) row of the whole universe at
+once, from a FactorInputs holding the stacked inputs of all tickers. The
+pipeline fetches the inputs the active factors need once per ticker, and
+``compute`` evaluates every active factor in one pass over them.
+
+The active factors, in registration order, are the metrics the stock data
+holds and ``ranking`` ranks. Each has a direction (ascending factors are
+ranked lowest first with zeros last) and a weight, and ``METRICS``,
+``ASCENDING_METRICS`` and ``METRIC_WEIGHTS`` are kept in sync with them:
+
+    @factors.register('book_to_price', inputs=('prices', 'balance_sheet'), weight=0.5)
+    def book_to_price(data):
+        ...
+
+    factors.configure('volatility', active=True, weight=0.5)
+
+The stock data has to be rebuilt after the active factors change.
+'''
+
+from __future__ import annotations
+
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+import pandas as pd
+
+import price_store
+import trading_calendar
+
+# Raw inputs a factor can declare
+INPUTS = ('earnings', 'income_statement', 'quarterly_income_statement', 'prices')
+
+# Trading days per year, to annualize daily volatilities
+TRADING_DAYS = 252
+
+# Active factors in ranking order, the ascending ones and the weights other than 1
+METRICS = []
+ASCENDING_METRICS = set()
+METRIC_WEIGHTS = {}
+
+_registry = {}
+
+
+class Factor:
+    '''
+    A ranked metric computed from raw inputs over the whole universe.
+
+    Attributes
+    ----------
+    name : str
+        Column name of the factor in the stock data.
+    inputs : tuple of str
+        Raw inputs of INPUTS the factor is computed from.
+    compute : callable
+        ``compute(data: FactorInputs) -> np.ndarray`` with one value per row of ``data.rows``.
+    ascending : bool
+        Rank lowest first, with zeros last.
+    weight : float
+        Multiplier of the ranking points of the factor.
+    active : bool
+        Computed into the stock data and ranked.
+    '''
+
+    def __init__(self, name: str, inputs: Iterable[str], compute: Callable, ascending: bool = False,
+                 weight: float = 1.0, active: bool = True):
+        unknown = set(inputs) - set(INPUTS)
+        if unknown:
+            raise ValueError(f"Unknown inputs {sorted(unknown)} of factor '{name}', expected some of {INPUTS}")
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.compute = compute
+        self.ascending = ascending
+        self.weight = weight
+        self.active = active
+
+    def __repr__(self) -> str:
+        return f"Factor({self.name!r}, inputs={self.inputs}, ascending={self.ascending}, weight={self.weight})"
+
+
+def _sync() -> None:
+    # Update the collections in place, modules holding a reference to them see the change
+    active = [factor for factor in _registry.values() if factor.active]
+    METRICS[:] = [factor.name for factor in active]
+    ASCENDING_METRICS.clear()
+    ASCENDING_METRICS.update(factor.name for factor in active if factor.ascending)
+    METRIC_WEIGHTS.clear()
+    METRIC_WEIGHTS.update({factor.name: factor.weight for factor in active if factor.weight != 1})
+
+
+def register(name: str, inputs: Iterable[str], ascending: bool = False, weight: float = 1.0,
+             active: bool = True) -> Callable:
+    '''
+    Decorator registering a factor function, see Factor. Registering a name again replaces the factor.
+    '''
+    def decorator(compute: Callable) -> Callable:
+        _registry[name] = Factor(name, inputs, compute, ascending, weight, active)
+        _sync()
+        return compute
+    return decorator
+
+
+def configure(name: str, *, ascending: Optional[bool] = None, weight: Optional[float] = None,
+              active: Optional[bool] = None) -> Factor:
+    '''
+    Change the direction, weight or activity of a registered factor.
+    '''
+    factor = get(name)
+    if ascending is not None:
+        factor.ascending = ascending
+    if weight is not None:
+        factor.weight = weight
+    if active is not None:
+        factor.active = active
+    _sync()
+    return factor
+
+
+def get(name: str) -> Factor:
+    if name not in _registry:
+        raise KeyError(f"Unknown factor '{name}', registered: {list(_registry)}")
+    return _registry[name]
+
+
+def registered() -> list:
+    '''Return the names of all registered factors, active or not.'''
+    return list(_registry)
+
+
+def required_inputs(names: Optional[Iterable[str]] = None) -> set:
+    '''Return the raw inputs of the given factors, the active ones by default, and the earnings the rows come from.'''
+    names = METRICS if names is None else names
+    return {'earnings'}.union(*(get(name).inputs for name in names))
+
+
+class FactorInputs:
+    '''
+    The stacked raw inputs of a universe and the rows factors are computed for.
+
+    Attributes
+    ----------
+    rows : pd.DataFrame
+        'ticker' and 'date' of every row, the fiscal dates of the earnings being
+        computed, ordered by ticker and then by date.
+    earnings : pd.DataFrame
+        'ticker', 'date' and 'reportedEPS' of all reported quarters.
+    income_statement, quarterly_income_statement : pd.DataFrame
+        'ticker', 'date' and 'totalRevenue' of the annual and quarterly reports.
+    prices : dict
+        ticker -> price_store.PriceSeries.
+    '''
+
+    def __init__(self, inputs: dict):
+        tickers = list(inputs)
+        self.tickers = tickers
+        self.rows = self._stack(inputs, 'rows', ['date'])
+        self.earnings = self._stack(inputs, 'earnings', ['date', 'reportedEPS'])
+        self.income_statement = self._stack(inputs, 'income_statement', ['date', 'totalRevenue'])
+        self.quarterly_income_statement = self._stack(inputs, 'quarterly_income_statement', ['date', 'totalRevenue'])
+        self.prices = {ticker: parts['prices'] for ticker, parts in inputs.items() if 'prices' in parts}
+
+    def _stack(self, inputs: dict, name: str, columns: list) -> pd.DataFrame:
+        frames = [parts[name][columns].assign(ticker=ticker) for ticker, parts in inputs.items()
+                  if parts.get(name) is not None and not parts[name].empty]
+        if not frames:
+            return pd.DataFrame({'ticker': pd.Series(dtype=object), 'date': pd.Series(dtype='datetime64[ns]'),
+                                 **{column: pd.Series(dtype=np.float64) for column in columns[1:]}})
+        stacked = pd.concat(frames, ignore_index=True)
+        stacked['date'] = pd.to_datetime(stacked['date'])
+        for column in columns[1:]:
+            stacked[column] = pd.to_numeric(stacked[column], errors='coerce')
+        order = {ticker: i for i, ticker in enumerate(self.tickers)}
+        stacked = stacked.sort_values('date', kind='stable')
+        stacked = stacked.sort_values('ticker', key=lambda tickers: tickers.map(order), kind='stable')
+        return stacked[['ticker'] + columns].reset_index(drop=True)
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def ticker_rows(self):
+        '''Yield every ticker with the positions of its rows, which are sorted by date.'''
+        for ticker, positions in self.rows.groupby('ticker', sort=False).indices.items():
+            yield ticker, positions
+
+    def lookup(self, frame: pd.DataFrame, column: str) -> np.ndarray:
+        '''Return the value of ``column`` in ``frame`` of every row's ticker and date, NaN where there is none.'''
+        keys = frame.drop_duplicates(['ticker', 'date'], keep='last').set_index(['ticker', 'date'])[column]
+        index = pd.MultiIndex.from_frame(self.rows[['ticker', 'date']])
+        return keys.reindex(index).to_numpy(dtype=np.float64)
+
+    def asof(self, frame: pd.DataFrame, column: str) -> np.ndarray:
+        '''
+        Return, for every row, the last value of ``column`` the same ticker has
+        in ``frame`` on or before the row's date, NaN where there is none.
+        '''
+        values = np.full(len(self.rows), np.nan)
+        frame = frame.dropna(subset=[column])
+        if frame.empty or self.rows.empty:
+            return values
+        merged = pd.merge_asof(
+            self.rows.reset_index().sort_values('date', kind='stable'),
+            frame.astype({'date': self.rows['date'].dtype}).sort_values('date', kind='stable')[['date', 'ticker', column]],
+            on='date',
+            by='ticker',
+            direction='backward'
+        )
+        values[merged['index'].to_numpy()] = merged[column].to_numpy(dtype=np.float64)
+        return values
+
+    def previous_close(self, max_days_back: int = 3) -> np.ndarray:
+        '''
+        Return the close of every row's ticker on the last session on or before its date.
+
+        A ticker that did not trade on that session of the calendar, e.g. halted
+        or not listed yet, gets its own last close before it instead, as long
+        as it is at most ``max_days_back`` days before the row's date.
+        '''
+        closes = np.full(len(self.rows), np.nan)
+        if self.rows.empty:
+            return closes
+        dates = self.rows['date']
+        days = price_store.to_days(dates)
+        calendar = trading_calendar.get_calendar(until=dates.max())
+        sessions = calendar.previous_session(dates, max_days_back=max_days_back)
+        # Without a calendar session, the ticker's own sessions up to the date are looked at
+        sessions = np.where(np.isnat(sessions), days, sessions)
+        for ticker, positions in self.ticker_rows():
+            series = self.prices[ticker]
+            if not len(series.dates):
+                continue
+            i = np.searchsorted(series.dates, sessions[positions], side='right') - 1
+            traded = series.dates[np.maximum(i, 0)]
+            found = (i >= 0) & (days[positions] - traded <= np.timedelta64(max_days_back, 'D'))
+            closes[positions] = np.where(found, np.asarray(series.close)[np.maximum(i, 0)], np.nan)
+        return closes
+
+    def trailing_returns(self, days: list) -> np.ndarray:
+        '''Return the (row, window) compounded returns over the ``days`` before every row's date.'''
+        returns = np.full((len(self.rows), len(days)), np.nan)
+        for ticker, positions in self.ticker_rows():
+            returns[positions] = price_store.trailing_returns(self.prices[ticker], self.rows['date'].iloc[positions], days)
+        return returns
+
+    def trailing_volatility(self, days: int) -> np.ndarray:
+        '''Return the daily log-return volatility over the ``days`` before every row's date.'''
+        volatility = np.full(len(self.rows), np.nan)
+        for ticker, positions in self.ticker_rows():
+            volatility[positions] = price_store.trailing_volatility(self.prices[ticker], self.rows['date'].iloc[positions], days)
+        return volatility
+
+
+def _growth(frame: pd.DataFrame, column: str, periods: int) -> pd.Series:
+    # Change of a column over the given number of earlier reports of the same ticker, relative to its absolute value
+    previous = frame.groupby('ticker', sort=False)[column].shift(periods)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        growth = (frame[column] - previous) / previous.abs()
+    return growth.where(previous != 0)
+
+
+def compute(inputs: dict, names: Optional[Iterable[str]] = None) -> pd.DataFrame:
+    '''
+    Compute factors for a whole universe in one pass.
+
+    Parameters
+    ----------
+    inputs : dict
+        ticker -> dict of raw inputs, with the 'rows' to compute (a frame with
+        the fiscal 'date' column) and every input the factors declare.
+    names : iterable of str, optional
+        The factors to compute, the active ones by default.
+
+    Returns
+    -------
+    pd.DataFrame
+        'date', 'ticker' and one column per factor, one row per input row,
+        ordered by the tickers of ``inputs`` and then by date.
+    '''
+    names = list(METRICS if names is None else names)
+    data = FactorInputs(inputs)
+    frame = data.rows[['date', 'ticker']].copy()
+    for name in names:
+        frame[name] = np.asarray(get(name).compute(data), dtype=np.float64)
+    return frame
+
+
+# Built-in factors
+
+@register('reportedEPS', inputs=('earnings',))
+def reported_eps(data: FactorInputs) -> np.ndarray:
+    return data.lookup(data.earnings, 'reportedEPS')
+
+
+@register('pe_ratio', inputs=('earnings', 'prices'), ascending=True, weight=0.5)
+def pe_ratio(data: FactorInputs) -> np.ndarray:
+    # Close of the last session up to 3 days before the fiscal date over the reported EPS, negative ratios as 0
+    eps = data.lookup(data.earnings, 'reportedEPS')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratios = data.previous_close(max_days_back=3) / eps
+    ratios[eps == 0] = np.nan
+    return np.clip(ratios, 0, None)
+
+
+@register('quarterly_return_six_month', inputs=('prices',))
+def quarterly_return_six_month(data: FactorInputs) -> np.ndarray:
+    # One extra day, two closes are needed for one return
+    return data.trailing_returns([181])[:, 0]
+
+
+@register('quarterly_return_one_year', inputs=('prices',))
+def quarterly_return_one_year(data: FactorInputs) -> np.ndarray:
+    return data.trailing_returns([361])[:, 0]
+
+
+@register('yoy_return', inputs=('income_statement',), weight=0.5)
+def yoy_return(data: FactorInputs) -> np.ndarray:
+    # Growth of the last annual revenue reported on or before the fiscal date
+    revenue = data.income_statement
+    previous = revenue.groupby('ticker', sort=False)['totalRevenue'].shift(1)
+    return data.asof(revenue.assign(yoy_return=revenue['totalRevenue'] / previous - 1), 'yoy_return')
+
+
+@register('eps_growth', inputs=('earnings',), active=False)
+def eps_growth(data: FactorInputs) -> np.ndarray:
+    # Reported EPS against the same quarter a year earlier
+    earnings = data.earnings
+    return data.lookup(earnings.assign(eps_growth=_growth(earnings, 'reportedEPS', 4)), 'eps_growth')
+
+
+@register('revenue_growth_ttm', inputs=('quarterly_income_statement',), active=False)
+def revenue_growth_ttm(data: FactorInputs) -> np.ndarray:
+    # Revenue of the trailing four quarters against the four quarters before them
+    revenue = data.quarterly_income_statement
+    ttm = revenue.groupby('ticker', sort=False)['totalRevenue'].rolling(4).sum().reset_index(level=0, drop=True)
+    revenue = revenue.assign(ttm_revenue=ttm)
+    return data.asof(revenue.assign(revenue_growth_ttm=_growth(revenue, 'ttm_revenue', 4)), 'revenue_growth_ttm')
+
+
+@register('volatility', inputs=('prices',), ascending=True, active=False)
+def volatility(data: FactorInputs) -> np.ndarray:
+    # Annualized volatility of the daily returns of the quarter before the fiscal date
+    return data.trailing_volatility(90) * np.sqrt(TRADING_DAYS)
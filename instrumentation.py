@@ -0,0 +1,229 @@
+'''
+This module contains the hot-path instrumentation of the pipeline.
+
+It records per-stage wall time, per-endpoint call counts and latency
+histograms, and cache hits, misses and bytes per cache type. Recording is off
+unless enabled with ``enable()`` or the PRIME_INSTRUMENT environment variable;
+while off, every hook returns after a single flag check.
+
+    PRIME_INSTRUMENT=1 PRIME_INSTRUMENT_REPORT=report.json python main.py
+    PRIME_INSTRUMENT=1 PRIME_INSTRUMENT_REPORT=prime.prom python main.py
+
+Report paths ending in ``.prom`` are written in the Prometheus textfile
+format, anything else as JSON.
+'''
+
+from __future__ import annotations
+
+import atexit
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_enabled = False
+_report_path = None
+_lock = threading.Lock()
+_stages = {}
+_endpoints = {}
+_caches = {}
+
+
+class _NullContext:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL = _NullContext()
+
+
+class _Timer:
+    def __init__(self, record, name: str):
+        self.record = record
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.record(self.name, time.perf_counter() - self.start, exc_type is not None)
+        return False
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable(report_path: Optional[str] = None) -> None:
+    '''
+    Start recording. If ``report_path`` is given, the report is exported there when the process exits.
+    '''
+    global _enabled, _report_path
+    _enabled = True
+    if report_path and _report_path is None:
+        atexit.register(_export_at_exit)
+    if report_path:
+        _report_path = report_path
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def reset() -> None:
+    '''Forget everything recorded so far.'''
+    with _lock:
+        _stages.clear()
+        _endpoints.clear()
+        _caches.clear()
+
+
+def _record_stage(name: str, seconds: float, failed: bool = False) -> None:
+    with _lock:
+        stage = _stages.setdefault(name, {'calls': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stage['calls'] += 1
+        stage['seconds'] += seconds
+        stage['max_seconds'] = max(stage['max_seconds'], seconds)
+
+
+def record_call(endpoint: str, seconds: float, failed: bool = False) -> None:
+    '''Record one call to an external endpoint and its latency.'''
+    if not _enabled:
+        return
+    with _lock:
+        stats = _endpoints.setdefault(endpoint, {'calls': 0, 'errors': 0, 'seconds': 0.0,
+                                                 'buckets': [0] * (len(LATENCY_BUCKETS) + 1)})
+        stats['calls'] += 1
+        stats['errors'] += int(failed)
+        stats['seconds'] += seconds
+        stats['buckets'][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+
+def record_cache(cache_type: str, hit: bool, nbytes: int = 0) -> None:
+    '''Record a cache lookup, with the number of bytes read on a hit or written after a miss.'''
+    if not _enabled:
+        return
+    with _lock:
+        stats = _caches.setdefault(cache_type, {'hits': 0, 'misses': 0, 'bytes': 0})
+        stats['hits' if hit else 'misses'] += 1
+        stats['bytes'] += nbytes
+
+
+def stage(name: str):
+    '''Context manager timing a pipeline stage.'''
+    if not _enabled:
+        return _NULL
+    return _Timer(_record_stage, name)
+
+
+def call(endpoint: str):
+    '''Context manager timing a call to an external endpoint, counted as an error if it raises.'''
+    if not _enabled:
+        return _NULL
+    return _Timer(record_call, endpoint)
+
+
+def timed(name: str):
+    '''Decorator timing every call of a function as the stage ``name``.'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with _Timer(_record_stage, name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report() -> dict:
+    '''Return everything recorded so far.'''
+    with _lock:
+        endpoints = {}
+        for endpoint, stats in _endpoints.items():
+            histogram = {str(bound): count for bound, count in zip(LATENCY_BUCKETS, stats['buckets'])}
+            histogram['+Inf'] = stats['buckets'][-1]
+            endpoints[endpoint] = {'calls': stats['calls'], 'errors': stats['errors'],
+                                   'seconds': stats['seconds'], 'latency_histogram': histogram}
+        return {
+            'stages': {name: dict(stats) for name, stats in _stages.items()},
+            'endpoints': endpoints,
+            'caches': {name: dict(stats) for name, stats in _caches.items()},
+        }
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text() -> str:
+    '''Return the report in the Prometheus text exposition format.'''
+    data = report()
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            label_text = ",".join(f'{key}="{_escape(str(val))}"' for key, val in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value}")
+
+    metric('prime_stage_seconds_total', 'counter', "Wall time spent in a pipeline stage.",
+           [({'stage': name}, stats['seconds']) for name, stats in data['stages'].items()])
+    metric('prime_stage_calls_total', 'counter', "Number of runs of a pipeline stage.",
+           [({'stage': name}, stats['calls']) for name, stats in data['stages'].items()])
+    metric('prime_endpoint_errors_total', 'counter', "Failed calls to an external endpoint.",
+           [({'endpoint': name}, stats['errors']) for name, stats in data['endpoints'].items()])
+
+    lines.append("# HELP prime_endpoint_latency_seconds Latency of calls to an external endpoint.")
+    lines.append("# TYPE prime_endpoint_latency_seconds histogram")
+    for name, stats in data['endpoints'].items():
+        cumulative = 0
+        for bound, count in stats['latency_histogram'].items():
+            cumulative += count
+            lines.append(f'prime_endpoint_latency_seconds_bucket{{endpoint="{_escape(name)}",le="{bound}"}} {cumulative}')
+        lines.append(f'prime_endpoint_latency_seconds_sum{{endpoint="{_escape(name)}"}} {stats["seconds"]}')
+        lines.append(f'prime_endpoint_latency_seconds_count{{endpoint="{_escape(name)}"}} {stats["calls"]}')
+
+    for field, help_text in (('hits', "Cache lookups answered from the cache."),
+                             ('misses', "Cache lookups that had to be computed or fetched."),
+                             ('bytes', "Bytes read from or written to the cache.")):
+        metric(f'prime_cache_{field}_total', 'counter', help_text,
+               [({'cache': name}, stats[field]) for name, stats in data['caches'].items()])
+
+    return "\n".join(lines) + "\n"
+
+
+def export(path: str) -> None:
+    '''
+    Write the report to ``path``, as a Prometheus textfile if it ends in .prom and as JSON otherwise.
+    '''
+    if path.endswith('.prom'):
+        content = prometheus_text()
+    else:
+        content = json.dumps(report(), indent=4)
+    # Write to a temporary file first so that a textfile collector never reads half a report
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+
+def _export_at_exit() -> None:
+    if _report_path:
+        export(_report_path)
+
+
+if os.getenv('PRIME_INSTRUMENT', '') not in ('', '0'):
+    enable(os.getenv('PRIME_INSTRUMENT_REPORT'))
@@ -1,25 +1,45 @@
 import data_model
-import data_utils
-from datetime import datetime
-import matplotlib.pyplot as plt
+import backtest
+import benchmark_series
+import daily_backtest
+import instrumentation
+import ranking
+import result_cache
+import robustness
+import walk_forward
+import pandas as pd
 import csv
+import io
+import os
 
 
 class PrimeModel:
-    def __init__(self, data: dict):
+    def __init__(self, data: dict, universe=None, result_cache=None):
+        # With a universe.Universe, each quarter only ranks the tickers that were members at its end
         self.data = data
-
-    def rank_stocks(self):
+        self.universe = universe
+        # With a result_cache.ResultCache, selections and backtests of unchanged quarters are not recomputed
+        self.result_cache = result_cache
+
+    def factor_panel(self, metrics: list = None, quarters: list = None) -> ranking.FactorPanel:
+        panel = ranking.build_panel(self.data, metrics, quarters)
+        if self.universe is None:
+            return panel
+        return panel.restrict(self.universe.membership_mask(panel.dates, panel.tickers))
+
+    @instrumentation.timed('PrimeModel.rank_stocks')
+    def rank_stocks(self, metrics: list = None):
+        panel = self.factor_panel(metrics)
+        positions = ranking.rank_positions(panel)
         ranked_stocks_by_date = {}
-        for date in self.data:
+        for q, date in enumerate(panel.dates):
+            num_stocks = int(panel.present[q].sum())
+            stocks = self.data[date]
             ranked_stocks = {}
-            for metric in ['reportedEPS', 'pe_ratio', 'quarterly_return_six_month', 'quarterly_return_one_year', 'yoy_return']:
-                if metric == 'pe_ratio':
-                    # Sort the stocks based on pe_ratio in ascending order
-                    ranked_stocks[metric] = sorted(self.data[date].items(), key=lambda item: (item[1][metric] == 0, item[1][metric]))
-                else:
-                    # Sort the stocks based on the current metric in descending order
-                    ranked_stocks[metric] = sorted(self.data[date].items(), key=lambda item: item[1][metric], reverse=True)
+            for m, metric in enumerate(panel.metrics):
+                # pe_ratio is sorted in ascending order with zeros last, the other metrics in descending order
+                ranked_stocks[metric] = [(panel.tickers[t], stocks[panel.tickers[t]])
+                                         for t in positions[q, m, :num_stocks]]
             ranked_stocks_by_date[date] = ranked_stocks
 
         '''
@@ -34,74 +54,75 @@ class PrimeModel:
 
         return ranked_stocks_by_date
 
-    def select_stocks(self):
-        selected_stocks = {}
-        ranked_stocks_by_date = self.rank_stocks()
-        for date, ranked_stocks in ranked_stocks_by_date.items():
-            stock_scores = {}
-            for metric, rankings in ranked_stocks.items():
-                num_stocks = len(rankings)
-                for rank, (ticker, _) in enumerate(rankings, start=1):
-                    score = num_stocks - rank + 1  # First place gets the highest score
-                    if metric in ['pe_ratio', 'yoy_return']:
-                        score /= 2  # Cut the score in half for 'pe_ratio' and 'yoy_return'
-                    if ticker not in stock_scores:
-                        stock_scores[ticker] = 0
-                    stock_scores[ticker] += score
-
-            # Sort stocks by their total score in descending order
-            top_stocks = sorted(stock_scores.items(), key=lambda item: item[1], reverse=True)[:3]
-            selected_stocks[date] = [ticker for ticker, _ in top_stocks]
-
+    @instrumentation.timed('PrimeModel.select_stocks')
+    def select_stocks(self, top_n: int = ranking.DEFAULT_TOP_N, quarters: list = None):
+        # Every metric gives the first place the highest score, pe_ratio and yoy_return count for half
+        if self.result_cache is not None:
+            return self.result_cache.select_stocks(self.factor_panel(quarters=quarters), top_n)
+        return ranking.select_stocks(self.factor_panel(quarters=quarters), top_n=top_n)
+
+    def reselect_stocks(self, selected_stocks: dict, changed_quarters: list, top_n: int = ranking.DEFAULT_TOP_N):
+        # Quarters are ranked independently, so only the changed ones need to be ranked again
+        selected_stocks = dict(selected_stocks)
+        selected_stocks.update(self.select_stocks(top_n, changed_quarters))
         return selected_stocks
 
-    def portfolio_allocation(self):
-        pass
-
-    def calculate_portfolio_return(self, selected_stocks: dict):
-        previous_quarter_stocks = {}
-        for date in selected_stocks:
-            # Calculate the previous quarter
-            year, quarter = map(int, date.split('_q'))
-            if year < 2013:
-                continue  # Skip any data before 2013
-            if quarter == 1:
-                previous_quarter = f"{year - 1}_q4"
-            else:
-                previous_quarter = f"{year}_q{quarter - 1}"
-            
-            # Get the selected stocks from the previous quarter
-            if previous_quarter in selected_stocks:
-                previous_quarter_stocks[date] = selected_stocks[previous_quarter]
-            else:
-                previous_quarter_stocks[date] = []
-
-        portfolio_return = {}
-        for date, stocks in previous_quarter_stocks.items():
-            total_compounded_return = 0
-            for stock in stocks:
-                # Convert the quarter date to a real date
-                year, quarter = map(int, date.split('_q'))
-                if quarter == 1:
-                    start_date = datetime(year, 1, 31)
-                elif quarter == 2:
-                    start_date = datetime(year, 4, 30)
-                elif quarter == 3:
-                    start_date = datetime(year, 7, 31)
-                else:
-                    start_date = datetime(year, 10, 31)
-                
-                # Calculate the compounded return for each stock
-                compounded_return_df = data_utils.quarterly_return(stock, start_date, 90)  # Assuming 1 quarter
-                compounded_return = float(compounded_return_df.iloc[0, 0])  # Get the value of Compounded Return
-                total_compounded_return += compounded_return
-            
-            # Store the total compounded return for the portfolio in the dictionary
-            portfolio_return[date] = total_compounded_return
-
-        return portfolio_return
+    @instrumentation.timed('PrimeModel.selection_scores')
+    def selection_scores(self) -> pd.DataFrame:
+        # Total score of every ticker in every quarter, as used by select_stocks
+        panel = self.factor_panel()
+        return pd.DataFrame(ranking.score_panel(panel), index=panel.dates, columns=panel.tickers)
+
+    @instrumentation.timed('PrimeModel.portfolio_allocation')
+    def portfolio_allocation(self, selected_stocks: dict, scheme: str = 'equal'):
+        # Weights of the selected stocks, one of backtest.ALLOCATION_SCHEMES such as 'equal', 'score' or 'min_variance'
+        scores = self.selection_scores() if scheme == 'score' else None
+        return backtest.allocate(selected_stocks, scheme, scores)
+
+    def calculate_portfolio_return(self, selected_stocks: dict, weights: dict = None, scheme: str = 'equal',
+                                   summed: bool = False):
+        # Hold the stocks selected in the previous quarter, allocated by the scheme unless weights are given
+        return self.backtest(selected_stocks, weights, scheme, summed)['return'].to_dict()
+
+    @instrumentation.timed('PrimeModel.backtest')
+    def backtest(self, selected_stocks: dict, weights: dict = None, scheme: str = 'equal', summed: bool = False) -> pd.DataFrame:
+        # Quarterly portfolio return and cumulative NAV, from one quarter x ticker return matrix. The weights are
+        # allocated by the scheme unless given. summed=True is the legacy unweighted sum of the returns, without a NAV
+        if summed:
+            weights = None
+        elif weights is None:
+            weights = self.portfolio_allocation(selected_stocks, scheme)
+        if self.result_cache is not None:
+            return self.result_cache.portfolio_returns(selected_stocks, weights)
+        return backtest.portfolio_returns(selected_stocks, weights)
+
+    def daily_backtest(self, selected_stocks: dict, weights: dict = None, rule: str = 'window', cost_model=None) -> pd.DataFrame:
+        # Daily NAV, drawdown, turnover and costs, rebalancing on the dates of the rule (see daily_backtest.py)
+        return daily_backtest.run(selected_stocks, weights, rule, cost_model=cost_model)
+
+    def relative_performance(self, result: pd.DataFrame, benchmark: str = benchmark_series.DEFAULT_BENCHMARK) -> pd.DataFrame:
+        # Excess return, alpha/beta, tracking error, information ratio and drawdowns of a backtest against an index
+        if 'nav' not in result:
+            raise ValueError("relative_performance needs the backtest of an invested portfolio with a 'nav', "
+                             "the summed returns of backtest(summed=True) are not comparable with an index")
+        if isinstance(result.index, pd.DatetimeIndex):
+            return benchmark_series.relative_performance(result['return'], benchmark_series.daily_returns(result.index, benchmark), 252)
+        return benchmark_series.relative_performance(result['return'], benchmark_series.quarterly_returns(list(result.index), benchmark))
+
+    def walk_forward(self, top_n: int = ranking.DEFAULT_TOP_N, scheme: str = 'equal', checkpoint: str = None):
+        # Select and backtest one quarter at a time, yielding each quarter's result as soon as it is known.
+        # scheme=None sums the returns of the held stocks like backtest(summed=True)
+        return walk_forward.walk_forward(self.data, top_n, scheme, checkpoint=checkpoint, universe=self.universe)
+
+    @instrumentation.timed('PrimeModel.robustness')
+    def robustness(self, tests: list = None, simulations: int = robustness.DEFAULT_SIMULATIONS, top_n: int = ranking.DEFAULT_TOP_N,
+                   workers: int = 1, seed: int = 0) -> pd.DataFrame:
+        # Confidence intervals of the return, Sharpe ratio and drawdown under resampling, noisy factors and random picks
+        return robustness.robustness(self.factor_panel(), tests, simulations, top_n=top_n, workers=workers, seed=seed)
 
 def plot_portfolio_return(portfolio_return: dict):
+    # Imported here so that runs without plots never load matplotlib
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(10, 6))
     plt.plot(portfolio_return.keys(), portfolio_return.values(), label='Portfolio Return')
     plt.xlabel('Date')
@@ -109,27 +130,41 @@ def plot_portfolio_return(portfolio_return: dict):
     plt.title('Portfolio Return')
     plt.legend()
 
-def visualize_portfolio(selected_stocks: dict):
-    # Export the selected stocks dictionary to a CSV file
-    with open('selected_stocks.csv', 'w', newline='') as csvfile:
-        fieldnames = ['Date', 'Stocks']
-        writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-
-        writer.writeheader()
-        def custom_sort_key(item):
-            year, quarter = item[0].split('_q')
-            return year * 10 + quarter
+def read_selected_stocks(path: str = 'selected_stocks.csv') -> dict:
+    # Read back the selection written by visualize_portfolio
+    with open(path, 'r', newline='') as f:
+        return {row['Date']: [stock for stock in row['Stocks'].split(', ') if stock] for row in csv.DictReader(f)}
 
-        sorted_selected_stocks = dict(sorted(selected_stocks.items(), key=custom_sort_key, reverse=True))
-        for date, stocks in sorted_selected_stocks.items():
-            year, _ = map(int, date.split('_q'))
-            if year >= 2013:
-                writer.writerow({'Date': date, 'Stocks': ', '.join(stocks)})
+def visualize_portfolio(selected_stocks: dict, path: str = 'selected_stocks.csv') -> bool:
+    # Export the selected stocks dictionary to a CSV file
+    csvfile = io.StringIO(newline='')
+    fieldnames = ['Date', 'Stocks']
+    writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
+
+    writer.writeheader()
+    def custom_sort_key(item):
+        year, quarter = item[0].split('_q')
+        return year * 10 + quarter
+
+    sorted_selected_stocks = dict(sorted(selected_stocks.items(), key=custom_sort_key, reverse=True))
+    for date, stocks in sorted_selected_stocks.items():
+        year, _ = map(int, date.split('_q'))
+        if year >= 2013:
+            writer.writerow({'Date': date, 'Stocks': ', '.join(stocks)})
+
+    # Leave the file and its modification time alone if the selection did not change
+    if os.path.exists(path):
+        with open(path, 'r', newline='') as f:
+            if f.read() == csvfile.getvalue():
+                return False
+    with open(path, 'w', newline='') as f:
+        f.write(csvfile.getvalue())
+    return True
 
 if __name__ == "__main__":
-    PrimeModel = PrimeModel(data_model.load_stock_data())
+    PrimeModel = PrimeModel(data_model.load_stock_data(), result_cache=result_cache.ResultCache())
     selected_stocks = PrimeModel.select_stocks()
     portfolio_return = PrimeModel.calculate_portfolio_return(selected_stocks)
     visualize_portfolio(selected_stocks)
     #plot_portfolio_return(portfolio_return)
-    #plt.show()
+    #import matplotlib.pyplot as plt; plt.show()
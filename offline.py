@@ -0,0 +1,65 @@
+'''
+This module contains the cache-only mode of the pipeline.
+
+In offline mode the network client libraries cannot be imported at all, and
+any data that the local caches (cache store, price store, snapshot) cannot
+answer raises OfflineError instead of being fetched.
+'''
+
+from __future__ import annotations
+
+import importlib.abc
+import sys
+
+# Client libraries of the data providers, blocked together with their submodules. The standard library's
+# http package is left alone: the local selection service is built on it, and fetching from a provider
+# without one of these clients still stops at require_network
+NETWORK_MODULES = ('yfinance', 'requests', 'urllib3', 'curl_cffi')
+
+_enabled = False
+
+
+class OfflineError(RuntimeError):
+    '''Raised when offline mode needs data that is not cached.'''
+
+
+def _is_network_module(name: str) -> bool:
+    return any(name == module or name.startswith(module + '.') for module in NETWORK_MODULES)
+
+
+class _NetworkBlocker(importlib.abc.MetaPathFinder):
+    def find_spec(self, fullname, path, target=None):
+        if _is_network_module(fullname):
+            raise ImportError(f"{fullname} cannot be imported in offline mode")
+        return None
+
+
+_blocker = _NetworkBlocker()
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def enable() -> None:
+    '''
+    Switch to offline mode for the rest of the process.
+
+    Raises
+    ------
+    OfflineError
+        If a network module has already been imported.
+    '''
+    global _enabled
+    loaded = sorted(name for name in sys.modules if _is_network_module(name))
+    if loaded:
+        raise OfflineError(f"Network modules are already loaded: {', '.join(loaded)}")
+    if _blocker not in sys.meta_path:
+        sys.meta_path.insert(0, _blocker)
+    _enabled = True
+
+
+def require_network(what: str) -> None:
+    '''Raise OfflineError for ``what`` in offline mode, called right before a network fetch.'''
+    if _enabled:
+        raise OfflineError(f"{what} is not cached and offline mode is on")
@@ -0,0 +1,370 @@
+'''
+This module contains the local bulk price store.
+
+The full daily OHLCV history of a ticker is downloaded once from Yahoo Finance
+and kept on disk as NumPy arrays with a sorted date index. Window and return
+lookups are answered from the store with ``searchsorted`` slicing instead of a
+``yf.Ticker(...).history()`` round-trip per query.
+'''
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timedelta
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+import instrumentation
+import offline
+
+logger = logging.getLogger(__name__)
+
+PRICE_DIR = os.path.join("cache", "prices")
+COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+
+# Relative difference between a stored and a re-downloaded close above which the
+# stored history is considered re-adjusted (split or dividend) and fully reloaded
+ADJUSTMENT_TOLERANCE = 1e-6
+
+
+class PriceSeries:
+    '''
+    Daily OHLCV history of a single ticker.
+
+    Attributes
+    ----------
+    ticker : str
+        The stock symbol.
+    dates : np.ndarray
+        Sorted ``datetime64[D]`` trading dates.
+    values : np.ndarray
+        Float array of shape (date, len(COLUMNS)).
+    version : str
+        Time of the last full download of the history. Appending new days keeps
+        it, a re-adjusted history changes it.
+    '''
+
+    def __init__(self, ticker: str, dates: np.ndarray, values: np.ndarray, version: str = ''):
+        self.ticker = ticker
+        self.dates = dates
+        self.values = values
+        self.version = version
+
+    def __len__(self) -> int:
+        return len(self.dates)
+
+    @property
+    def close(self) -> np.ndarray:
+        return self.values[:, COLUMNS.index('Close')]
+
+    @property
+    def last_date(self) -> Optional[np.datetime64]:
+        return self.dates[-1] if len(self.dates) else None
+
+    def bounds(self, start, end) -> tuple:
+        '''Return the index range of the dates in ``[start, end)``.'''
+        lo = np.searchsorted(self.dates, to_days(start), side='left')
+        hi = np.searchsorted(self.dates, to_days(end), side='left')
+        return lo, hi
+
+    def close_on(self, dates) -> np.ndarray:
+        '''Return the close on each of ``dates``, NaN where the ticker did not trade that day.'''
+        days = to_days(dates)
+        close = np.asarray(self.close)
+        i = np.minimum(np.searchsorted(self.dates, days, side='left'), max(len(self.dates) - 1, 0))
+        prices = np.full(len(days), np.nan)
+        if len(self.dates):
+            found = self.dates[i] == days
+            prices[found] = close[i[found]]
+        return prices
+
+    def window(self, start, end) -> pd.DataFrame:
+        '''Return the OHLCV rows in ``[start, end)`` like ``yf.Ticker.history`` does.'''
+        lo, hi = self.bounds(start, end)
+        return pd.DataFrame(np.asarray(self.values[lo:hi]), columns=COLUMNS,
+                            index=pd.DatetimeIndex(self.dates[lo:hi], name='Date'))
+
+
+def to_days(dates) -> np.ndarray:
+    '''Convert a date or an array of dates to ``datetime64[D]``.'''
+    if np.ndim(dates) == 0:
+        return pd.Timestamp(dates).to_datetime64().astype('datetime64[D]')
+    return pd.to_datetime(np.asarray(dates)).values.astype('datetime64[D]')
+
+
+def _paths(ticker: str) -> tuple:
+    return (os.path.join(PRICE_DIR, f"{ticker}_dates.npy"),
+            os.path.join(PRICE_DIR, f"{ticker}_ohlcv.npy"),
+            os.path.join(PRICE_DIR, f"{ticker}_meta.json"))
+
+
+def download_history(ticker: str, start: Optional[datetime] = None) -> pd.DataFrame:
+    '''
+    Download the daily OHLCV history of a ticker, from ``start`` or the first available day.
+    '''
+    # Imported here so that runs answered from the store never load yfinance
+    import yfinance as yf
+    stock = yf.Ticker(ticker)
+    if start is None:
+        hist = stock.history(period="max")
+    else:
+        hist = stock.history(start=start)
+    if hist.empty:
+        return pd.DataFrame(columns=COLUMNS)
+
+    index = hist.index.tz_localize(None) if hist.index.tz is not None else hist.index
+    hist = hist[COLUMNS].copy()
+    hist.index = index.normalize()
+    return hist[~hist.index.duplicated(keep='last')].sort_index()
+
+
+def _download(ticker: str, start: Optional[datetime] = None) -> pd.DataFrame:
+    offline.require_network(f"The price history of {ticker}")
+    with instrumentation.call('yfinance:history'):
+        return download_history(ticker, start)
+
+
+def _frame_to_arrays(hist: pd.DataFrame) -> tuple:
+    dates = hist.index.values.astype('datetime64[D]')
+    values = hist[COLUMNS].to_numpy(dtype=np.float64)
+    return dates, values
+
+
+def _write(ticker: str, dates: np.ndarray, values: np.ndarray, version: str) -> None:
+    os.makedirs(PRICE_DIR, exist_ok=True)
+    dates_file, values_file, meta_file = _paths(ticker)
+    # Write to temporary files first so that readers never see half a history
+    for path, array in ((dates_file, dates), (values_file, values)):
+        tmp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_file, 'wb') as f:
+            np.save(f, array)
+        os.replace(tmp_file, path)
+    with open(meta_file, 'w') as f:
+        json.dump({'refreshed_at': datetime.now().strftime("%Y-%m-%d"), 'version': version}, f)
+
+
+def _read_meta(ticker: str) -> dict:
+    try:
+        with open(_paths(ticker)[2], 'r') as f:
+            return json.load(f)
+    except Exception:
+        return {}
+
+
+def _read(ticker: str) -> Optional[PriceSeries]:
+    dates_file, values_file, _ = _paths(ticker)
+    if not (os.path.exists(dates_file) and os.path.exists(values_file)):
+        return None
+    try:
+        dates = np.load(dates_file, mmap_mode='r')
+        values = np.load(values_file, mmap_mode='r')
+        # Another process may be halfway through appending to the history
+        length = min(len(dates), len(values))
+        return PriceSeries(ticker, dates[:length], values[:length], _read_meta(ticker).get('version', ''))
+    except Exception as exc:
+        logger.warning("Failed to read price store for %s: %s", ticker, exc)
+        return None
+
+
+def _refreshed_at(ticker: str) -> Optional[np.datetime64]:
+    refreshed_at = _read_meta(ticker).get('refreshed_at')
+    return None if refreshed_at is None else np.datetime64(refreshed_at, 'D')
+
+
+_series = {}
+_locks = {}
+_locks_lock = threading.Lock()
+
+
+def _lock(ticker: str) -> threading.RLock:
+    # One lock per ticker so that concurrent builds never download the same history twice
+    with _locks_lock:
+        return _locks.setdefault(ticker, threading.RLock())
+
+
+def refresh_prices(ticker: str) -> PriceSeries:
+    '''
+    Bring the stored history of a ticker up to date.
+
+    Only the days after the last stored date are fetched. The last stored day is
+    fetched again and compared: if its close changed, the provider re-adjusted the
+    history for a split or dividend and the full history is downloaded instead.
+    '''
+    with _lock(ticker):
+        return _refresh_prices(ticker)
+
+
+def _refresh_prices(ticker: str) -> PriceSeries:
+    series = _read(ticker)
+    # A full download starts a new version of the history, e.g. re-adjusted for a split
+    version = datetime.now().isoformat(timespec='microseconds')
+    if series is None or len(series) == 0:
+        hist = _download(ticker)
+        dates, values = _frame_to_arrays(hist)
+    else:
+        last_date = pd.Timestamp(series.last_date)
+        hist = _download(ticker, start=last_date.to_pydatetime())
+        new_dates, new_values = _frame_to_arrays(hist)
+        overlap = new_dates == series.last_date
+        stored_close = float(series.close[-1])
+        if overlap.any() and abs(new_values[overlap][0, COLUMNS.index('Close')] - stored_close) > ADJUSTMENT_TOLERANCE * abs(stored_close):
+            logger.info("Price history of %s was re-adjusted, downloading it again", ticker)
+            dates, values = _frame_to_arrays(_download(ticker))
+        else:
+            newer = new_dates > series.last_date
+            dates = np.concatenate([np.asarray(series.dates), new_dates[newer]])
+            values = np.concatenate([np.asarray(series.values), new_values[newer]])
+            version = series.version
+
+    _write(ticker, dates, values, version)
+    _series[ticker] = _read(ticker)
+    return _series[ticker]
+
+
+def load_prices(ticker: str, until=None) -> PriceSeries:
+    '''
+    Return the stored price history of a ticker, downloading it on first use.
+
+    Parameters
+    ----------
+    ticker : str
+        The stock symbol, e.g. "AAPL".
+    until : datetime, optional
+        If the stored history ends before this date and was not refreshed since,
+        fetch the missing days first.
+    '''
+    series = _series.get(ticker)
+    if series is None:
+        with _lock(ticker):
+            series = _series.get(ticker)
+            if series is None:
+                series = _read(ticker)
+                instrumentation.record_cache('disk:prices', series is not None,
+                                             0 if series is None else series.dates.nbytes + series.values.nbytes)
+            if series is None:
+                return refresh_prices(ticker)
+            _series[ticker] = series
+
+    # Offline, a history that ends early is used as it is
+    if until is not None and len(series) and to_days(until) > series.last_date and not offline.is_enabled():
+        with _lock(ticker):
+            # Another thread may have refreshed the history meanwhile
+            series = _series[ticker]
+            refreshed_at = _refreshed_at(ticker)
+            if to_days(until) > series.last_date and (
+                    refreshed_at is None or refreshed_at < min(to_days(until), np.datetime64(datetime.now().date(), 'D'))):
+                try:
+                    series = refresh_prices(ticker)
+                except Exception as exc:
+                    logger.warning("Failed to refresh prices for %s: %s", ticker, exc)
+    return series
+
+
+def history(ticker: str, start, end) -> pd.DataFrame:
+    '''
+    Return the daily OHLCV rows of a ticker in ``[start, end)``.
+    '''
+    return load_prices(ticker, until=to_days(end) - np.timedelta64(1, 'D')).window(start, end)
+
+
+def trailing_returns(series: PriceSeries, as_of_dates, windows) -> np.ndarray:
+    '''
+    Calculate the compounded return of a price series over several lookback windows before each as-of date.
+
+    The window of ``days`` before an as-of date ``d`` holds the closes in
+    ``[d - days, d)``. Returns are taken as differences of the log closes at the
+    window bounds, so every (date, window) pair costs two index lookups.
+
+    Parameters
+    ----------
+    series : PriceSeries
+        The price history, which should cover the latest as-of date.
+    as_of_dates : array-like of dates
+        The dates the windows end on, excluded.
+    windows : array-like of int
+        Lookback windows in calendar days.
+
+    Returns
+    -------
+    np.ndarray
+        Array of shape (len(as_of_dates), len(windows)), NaN where a window is empty.
+    '''
+    ends = to_days(as_of_dates)
+    windows = np.asarray(windows, dtype=np.int64)
+    starts = ends[:, None] - windows[None, :].astype('timedelta64[D]')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_close = np.log(np.asarray(series.close))
+    lo = np.searchsorted(series.dates, starts, side='left')
+    hi = np.broadcast_to(np.searchsorted(series.dates, ends, side='left')[:, None], lo.shape)
+
+    returns = np.full(lo.shape, np.nan)
+    valid = hi > lo
+    returns[valid] = np.expm1(log_close[hi[valid] - 1] - log_close[lo[valid]])
+    return returns
+
+
+def trailing_volatility(series: PriceSeries, as_of_dates, days: int) -> np.ndarray:
+    '''
+    Calculate the standard deviation of the daily log returns over the ``days`` calendar days before each as-of date.
+
+    The window of an as-of date ``d`` holds the closes in ``[d - days, d)``, and
+    the variance of any window comes from running sums with two index lookups.
+
+    Returns
+    -------
+    np.ndarray
+        One volatility per as-of date, NaN with fewer than two daily returns in the window.
+    '''
+    ends = to_days(as_of_dates)
+    starts = ends - np.timedelta64(days, 'D')
+    daily_returns = np.diff(np.log(np.asarray(series.close)))
+    cumsum = np.concatenate([[0.0], np.cumsum(daily_returns)])
+    cumsum_sq = np.concatenate([[0.0], np.cumsum(daily_returns ** 2)])
+    # daily_returns[i] is the return from series.dates[i] to series.dates[i + 1]
+    last = len(cumsum) - 1
+    lo = np.minimum(np.searchsorted(series.dates, starts, side='left'), last)
+    hi = np.clip(np.searchsorted(series.dates, ends, side='left') - 1, lo, last)
+    count = hi - lo
+    total = cumsum[hi] - cumsum[lo]
+    total_sq = cumsum_sq[hi] - cumsum_sq[lo]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        variance = (total_sq - total ** 2 / count) / (count - 1)
+    return np.where(count > 1, np.sqrt(np.maximum(variance, 0)), np.nan)
+
+
+def compound_returns(ticker: str, start_dates, days: int) -> np.ndarray:
+    '''
+    Calculate the compounded return over the ``days`` calendar days before each start date.
+
+    The window of a start date ``d`` holds the closes in ``[d - days, d)``, which
+    is the window ``stock_utils.compound_return`` used to download.
+
+    Returns
+    -------
+    np.ndarray
+        One compounded return per start date, NaN where the window is empty.
+    '''
+    ends = to_days(start_dates)
+    series = load_prices(ticker, until=ends.max() - np.timedelta64(1, 'D') if len(ends) else None)
+    return trailing_returns(series, ends, [days])[:, 0]
+
+
+def compound_return(ticker: str, days: int, start_date) -> float:
+    '''
+    Calculate the compounded return of a ticker over ``[start_date - days, start_date)``.
+
+    Raises
+    ------
+    ValueError
+        If the store holds no prices in that window.
+    '''
+    if start_date is None:
+        start_date = datetime.now() + timedelta(days=1)
+    value = compound_returns(ticker, [start_date], days)[0]
+    if np.isnan(value):
+        raise ValueError(f"No historical data available for ticker '{ticker}' over the specified period.")
+    return float(value)
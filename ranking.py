@@ -0,0 +1,209 @@
+'''
+This module contains the vectorized ranking and scoring engine used by PrimeModel.
+
+The factor data (date -> ticker -> metric) is turned into a dense
+(quarter x ticker x metric) array so that every quarter is ranked at once.
+'''
+
+from __future__ import annotations
+
+from typing import Iterable, Mapping, Optional
+
+import numpy as np
+
+import factors
+
+# The active factors of the registry, kept up to date by factors.register and factors.configure
+METRICS = factors.METRICS
+
+# Metrics ranked in ascending order (lower is better), with zeros pushed last
+ASCENDING_METRICS = factors.ASCENDING_METRICS
+
+# Score multipliers, metrics not listed here get a weight of 1
+METRIC_WEIGHTS = factors.METRIC_WEIGHTS
+
+DEFAULT_TOP_N = 3
+
+
+class FactorPanel:
+    '''
+    Dense factor data for a set of quarters and tickers.
+
+    Attributes
+    ----------
+    dates : list of str
+        Quarter labels, in the order of the source data.
+    tickers : list of str
+        Union of all tickers seen in any quarter.
+    metrics : list of str
+        Metric names along the last axis of ``values``.
+    values : np.ndarray
+        Array of shape (quarter, ticker, metric), NaN where a ticker has no data.
+    order : np.ndarray
+        Array of shape (quarter, ticker) with the position of each ticker in the
+        source data of that quarter. Used to break ties the same way the
+        original dict-based ranking did. Missing tickers hold ``len(tickers)``.
+    '''
+
+    def __init__(self, dates: list, tickers: list, metrics: list, values: np.ndarray, order: np.ndarray):
+        self.dates = list(dates)
+        self.tickers = list(tickers)
+        self.metrics = list(metrics)
+        self.values = values
+        self.order = order
+
+    @property
+    def present(self) -> np.ndarray:
+        '''Boolean (quarter, ticker) mask of the tickers that have data in each quarter.'''
+        return self.order < len(self.tickers)
+
+    def subset(self, dates: Iterable[str]) -> 'FactorPanel':
+        '''Return a panel restricted to the given quarters.'''
+        index = {date: i for i, date in enumerate(self.dates)}
+        rows = [index[date] for date in dates]
+        return FactorPanel([self.dates[i] for i in rows], self.tickers, self.metrics,
+                           self.values[rows], self.order[rows])
+
+    def restrict(self, members: np.ndarray) -> 'FactorPanel':
+        '''
+        Return a panel where the tickers outside the boolean (quarter, ticker)
+        ``members`` mask have no data, e.g. those that were not in the universe.
+        '''
+        order = np.where(members, self.order, len(self.tickers))
+        values = np.where(members[:, :, None], self.values, np.nan)
+        return FactorPanel(self.dates, self.tickers, self.metrics, values, order)
+
+
+def build_panel(data: Mapping, metrics: Optional[list] = None, quarters: Optional[list] = None) -> FactorPanel:
+    '''
+    Convert a ``date -> ticker -> metric`` mapping into a FactorPanel.
+
+    Columnar snapshots are converted without going through per-quarter dicts.
+    If ``quarters`` is given, only those quarters are included.
+    '''
+    metrics = list(metrics or METRICS)
+    if hasattr(data, 'to_panel'):
+        return data.to_panel(metrics, quarters)
+    dates = list(data) if quarters is None else list(quarters)
+
+    tickers = []
+    ticker_index = {}
+    for date in dates:
+        for ticker in data[date]:
+            if ticker not in ticker_index:
+                ticker_index[ticker] = len(tickers)
+                tickers.append(ticker)
+
+    num_tickers = len(tickers)
+    values = np.full((len(dates), num_tickers, len(metrics)), np.nan)
+    order = np.full((len(dates), num_tickers), num_tickers, dtype=np.int64)
+    for q, date in enumerate(dates):
+        for position, (ticker, row) in enumerate(data[date].items()):
+            t = ticker_index[ticker]
+            order[q, t] = position
+            values[q, t] = [row[metric] for metric in metrics]
+
+    return FactorPanel(dates, tickers, metrics, values, order)
+
+
+def rank_positions(panel: FactorPanel, ascending: Optional[set] = None) -> np.ndarray:
+    '''
+    Sort the tickers of every quarter by every metric.
+
+    Parameters
+    ----------
+    panel : FactorPanel
+        The factor data to rank.
+    ascending : set, optional
+        Metrics ranked lowest first with zeros pushed last. Defaults to ``ASCENDING_METRICS``.
+
+    Returns
+    -------
+    np.ndarray
+        Integer array of shape (quarter, metric, ticker) holding ticker indices
+        in ranked order. Tickers without data in a quarter are sorted last.
+    '''
+    ascending = ASCENDING_METRICS if ascending is None else ascending
+    missing = ~panel.present
+    positions = np.empty((len(panel.dates), len(panel.metrics), len(panel.tickers)), dtype=np.int64)
+
+    for m, metric in enumerate(panel.metrics):
+        column = panel.values[:, :, m]
+        if metric in ascending:
+            # np.lexsort sorts by the last key first
+            keys = (panel.order, column, column == 0, missing)
+        else:
+            keys = (panel.order, -column, missing)
+        positions[:, m, :] = np.lexsort(keys, axis=-1)
+
+    return positions
+
+
+def score_panel(panel: FactorPanel, positions: Optional[np.ndarray] = None,
+                weights: Optional[Mapping] = None, ascending: Optional[set] = None) -> np.ndarray:
+    '''
+    Compute the total score of every ticker in every quarter.
+
+    The first place of each metric gets ``n`` points, the last one gets 1, where
+    ``n`` is the number of tickers with data in that quarter. The points of each
+    metric are multiplied by its weight and summed.
+
+    Returns
+    -------
+    np.ndarray
+        Float array of shape (quarter, ticker), NaN for tickers without data.
+    '''
+    weights = METRIC_WEIGHTS if weights is None else weights
+    if positions is None:
+        positions = rank_positions(panel, ascending)
+
+    num_dates, num_metrics, num_tickers = positions.shape
+    num_stocks = panel.present.sum(axis=1)
+
+    # points[q, m, rank] for the ticker found at that rank
+    points = num_stocks[:, None, None] - np.arange(num_tickers)[None, None, :]
+    points = points * np.array([weights.get(metric, 1) for metric in panel.metrics])[None, :, None]
+
+    scores = np.zeros((num_dates, num_tickers))
+    rows = np.arange(num_dates)[:, None]
+    for m in range(num_metrics):
+        np.add.at(scores, (rows, positions[:, m, :]), points[:, m, :])
+
+    scores[~panel.present] = np.nan
+    return scores
+
+
+def select_top(panel: FactorPanel, scores: np.ndarray, positions: np.ndarray, top_n: int = DEFAULT_TOP_N) -> dict:
+    '''
+    Pick the ``top_n`` highest scoring tickers of every quarter.
+
+    Ties are broken by the ranking of the first metric, which is the order the
+    scores were accumulated in by the original implementation.
+    '''
+    num_tickers = len(panel.tickers)
+    first_metric_rank = np.empty_like(positions[:, 0, :])
+    np.put_along_axis(first_metric_rank, positions[:, 0, :], np.arange(num_tickers)[None, :], axis=-1)
+
+    missing = ~panel.present
+    ordered = np.lexsort((first_metric_rank, -np.nan_to_num(scores), missing), axis=-1)
+    num_selected = np.minimum(panel.present.sum(axis=1), top_n)
+
+    selected_stocks = {}
+    for q, date in enumerate(panel.dates):
+        selected_stocks[date] = [panel.tickers[t] for t in ordered[q, :num_selected[q]]]
+    return selected_stocks
+
+
+def select_stocks(data: Mapping, top_n: int = DEFAULT_TOP_N, metrics: Optional[list] = None,
+                  weights: Optional[Mapping] = None, ascending: Optional[set] = None,
+                  quarters: Optional[list] = None) -> dict:
+    '''
+    Rank and select the top ``top_n`` stocks of every quarter in ``data``, or of ``quarters`` only.
+    '''
+    if isinstance(data, FactorPanel):
+        panel = data if quarters is None else data.subset(quarters)
+    else:
+        panel = build_panel(data, metrics, quarters)
+    positions = rank_positions(panel, ascending)
+    scores = score_panel(panel, positions, weights)
+    return select_top(panel, scores, positions, top_n)
@@ -0,0 +1,157 @@
+'''
+This module contains the result cache of stock selections and backtests.
+
+Selections are memoized per quarter under a key made of the fingerprint of
+the quarter's factor data (the tickers in their order and all their metric
+values) and the fingerprint of the selection rules. A run on unchanged data
+is answered from the cache, and when a refresh changes some quarters only
+those are ranked again.
+
+Backtest returns are memoized per quarter under the held stocks, their
+weights and the versions of their price histories. Only quarters whose return
+window the stored prices of every held stock cover are cached, since the
+prices of an open window still change.
+
+Results live in their own SQLite store next to the data cache, so that they
+are evicted by its least-recently-used size bound without evicting any data.
+'''
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+from typing import Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+import backtest
+import cache_store
+import price_store
+import ranking
+
+logger = logging.getLogger(__name__)
+
+RESULTS_DB = os.path.join(cache_store.CACHE_DIR, "results.sqlite")
+DEFAULT_MAX_BYTES = 64 << 20
+
+SELECTION_DATASET = 'selection'
+RETURN_DATASET = 'quarter_return'
+
+
+def _digest(payload: bytes) -> str:
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def config_fingerprint(config: Mapping) -> str:
+    '''Return the fingerprint of a JSON-serializable configuration.'''
+    return _digest(json.dumps(config, sort_keys=True, default=str).encode('utf-8'))
+
+
+def quarter_fingerprints(panel: ranking.FactorPanel) -> dict:
+    '''
+    Return the fingerprint of every quarter of a panel.
+
+    It covers the tickers with data in their source order, which breaks ranking
+    ties, and the values of every metric, so any change that could change the
+    selection of a quarter changes its fingerprint.
+    '''
+    fingerprints = {}
+    metrics = '\n'.join(panel.metrics).encode('utf-8')
+    for q, quarter in enumerate(panel.dates):
+        present = np.flatnonzero(panel.present[q])
+        present = present[np.argsort(panel.order[q, present], kind='stable')]
+        tickers = '\n'.join(panel.tickers[t] for t in present).encode('utf-8')
+        values = np.ascontiguousarray(panel.values[q, present], dtype=np.float64).tobytes()
+        fingerprints[quarter] = _digest(b'\0'.join([quarter.encode('utf-8'), metrics, tickers, values]))
+    return fingerprints
+
+
+class ResultCache:
+    '''
+    Memoized ``ranking.select_stocks`` and ``backtest.portfolio_returns``.
+
+    Parameters
+    ----------
+    path : str
+        Location of the SQLite store of the results.
+    max_bytes : int
+        Size bound of the stored results, beyond which the least recently used are evicted.
+    '''
+
+    def __init__(self, path: str = RESULTS_DB, max_bytes: int = DEFAULT_MAX_BYTES):
+        self.store = cache_store.CacheStore(path, max_bytes=max_bytes)
+
+    def select_stocks(self, panel: ranking.FactorPanel, top_n: int = ranking.DEFAULT_TOP_N,
+                      weights: Optional[Mapping] = None, ascending: Optional[set] = None) -> dict:
+        '''
+        Return ``ranking.select_stocks(panel, top_n, weights=weights, ascending=ascending)``,
+        ranking only the quarters that are not cached.
+        '''
+        config = config_fingerprint({
+            'top_n': top_n,
+            'weights': dict(ranking.METRIC_WEIGHTS if weights is None else weights),
+            'ascending': sorted(ranking.ASCENDING_METRICS if ascending is None else ascending),
+        })
+        keys = {quarter: f"{config}:{fingerprint}" for quarter, fingerprint in quarter_fingerprints(panel).items()}
+        cached = self.store.get_blobs(SELECTION_DATASET, keys.values())
+
+        missing = [quarter for quarter in panel.dates if keys[quarter] not in cached]
+        selected = {}
+        if missing:
+            selected = ranking.select_stocks(panel.subset(missing), top_n, weights=weights, ascending=ascending)
+            self.store.put_blobs(SELECTION_DATASET, {keys[quarter]: json.dumps(selected[quarter]).encode('utf-8')
+                                                     for quarter in missing})
+        logger.info("Selected %d quarters, %d from the result cache", len(panel.dates), len(panel.dates) - len(missing))
+        return {quarter: selected[quarter] if quarter in selected else json.loads(cached[keys[quarter]])
+                for quarter in panel.dates}
+
+    def portfolio_returns(self, selected_stocks: dict, weights: Optional[dict] = None,
+                          start_year: int = backtest.START_YEAR) -> pd.DataFrame:
+        '''
+        Return ``backtest.portfolio_returns(selected_stocks, weights, start_year=start_year)``,
+        computing the forward returns of the quarters that are not cached only.
+        '''
+        held = backtest.holdings(selected_stocks, start_year)
+        cached_series = {ticker: price_store.load_prices(ticker) for ticker in sorted(set().union(*held.values()))}
+        keys = {quarter: self._return_key(quarter, stocks, weights, cached_series) for quarter, stocks in held.items()}
+        cached = self.store.get_blobs(RETURN_DATASET, keys.values())
+
+        missing = [quarter for quarter in held if keys[quarter] not in cached]
+        returns = {quarter: float(cached[keys[quarter]]) for quarter in held if quarter not in missing}
+        if missing:
+            tickers = sorted({ticker for quarter in missing for ticker in held[quarter]})
+            matrix = backtest.forward_return_matrix(missing, tickers)
+            computed = backtest.portfolio_returns(selected_stocks, weights, matrix, start_year)['return']
+            returns.update({quarter: float(computed[quarter]) for quarter in missing})
+
+            # Only returns of windows every held price history covers are final: the return of an open window
+            # changes with every new close, and an offline run or a failed refresh may stop short of its end
+            series = {ticker: price_store.load_prices(ticker) for ticker in tickers}
+            final = {}
+            for quarter in missing:
+                end = price_store.to_days(backtest.quarter_start_date(quarter))
+                if all(series[ticker].last_date is not None and series[ticker].last_date >= end
+                       for ticker in held[quarter]):
+                    final[self._return_key(quarter, held[quarter], weights, series)] = repr(returns[quarter]).encode('utf-8')
+            self.store.put_blobs(RETURN_DATASET, final)
+
+        result = pd.DataFrame({'return': [returns[quarter] for quarter in held]}, index=pd.Index(list(held), name='date'))
+        result = result.sort_index(key=lambda index: index.map(backtest.quarter_key))
+        if weights is not None:
+            result['nav'] = (1 + result['return']).cumprod()
+        return result
+
+    @staticmethod
+    def _return_key(quarter: str, stocks: list, weights: Optional[dict], series: dict) -> str:
+        # The price versions change when a history is re-adjusted for a split or dividend
+        selection_weights = (weights or {}).get(backtest.previous_quarter(quarter))
+        return config_fingerprint({'quarter': quarter, 'days': backtest.QUARTER_DAYS, 'held': stocks,
+                                   'weights': selection_weights,
+                                   'prices': [series[ticker].version for ticker in stocks]})
+
+    def clear(self) -> None:
+        '''Delete every cached result.'''
+        self.store.clear()
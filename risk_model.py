@@ -0,0 +1,261 @@
+'''
+This module contains the covariance estimates and risk-based optimizers of the portfolio allocation.
+
+Covariances are estimated from the daily log returns ending in a rolling
+window of calendar days. ``RollingCovariance`` keeps the pairwise sums of the
+returns in the window (counts, sums and cross products of every pair of
+tickers over the days both have a return), and moving the window adds the
+days entering it and subtracts the days leaving it. A walk through the
+quarters therefore reads every daily return twice in total instead of once
+per window, whatever the length of the window.
+
+Sample covariances of a few names over a few months are noisy, so they are
+shrunk towards a scaled identity with the Oracle Approximating Shrinkage
+intensity, which only needs the sample covariance itself.
+
+The optimizers are long-only and fully invested:
+
+- ``min_variance_weights``: lowest portfolio variance;
+- ``risk_parity_weights``: every name contributes the same share of the variance;
+- ``mean_variance_weights``: highest mean return less ``risk_aversion / 2``
+  times the variance.
+
+The minimum variance and mean-variance weights are capped by ``max_weight``.
+'''
+
+from __future__ import annotations
+
+from typing import Callable, Iterable, Optional
+
+import numpy as np
+
+import price_store
+
+# Calendar days of the covariance window, one year of daily returns
+COVARIANCE_DAYS = 365
+
+# Names with fewer daily returns in the window are left out of the optimization
+MIN_OBSERVATIONS = 20
+
+# Default weight cap and risk aversion of the optimizers
+MAX_WEIGHT = 0.6
+RISK_AVERSION = 5.0
+
+MAX_ITERATIONS = 10_000
+TOLERANCE = 1e-10
+
+
+class RollingCovariance:
+    '''
+    Pairwise moments of the daily log returns of tracked tickers over a moving window.
+
+    The window holds the returns ending on a day in ``[end - days, end)``.
+    Tickers are tracked from the first time they are asked for and stay
+    tracked, so that their sums move with the window.
+
+    Parameters
+    ----------
+    days : int
+        Calendar days of the window.
+    loader : callable
+        ``loader(ticker) -> price_store.PriceSeries``, ``price_store.load_prices`` by default.
+    '''
+
+    def __init__(self, days: int = COVARIANCE_DAYS, loader: Optional[Callable] = None):
+        self.days = days
+        self.loader = loader or price_store.load_prices
+        self.tickers = []
+        self.start = None
+        self.end = None
+        self._index = {}
+        self._dates = []
+        self._returns = []
+        # count[i, j], total[i, j] (sum of the returns of i on the days j has one) and cross[i, j]
+        self._count = np.zeros((0, 0))
+        self._total = np.zeros((0, 0))
+        self._cross = np.zeros((0, 0))
+
+    def _block(self, start, end, columns=None) -> tuple:
+        # Returns of the tracked tickers ending in [start, end), one row per day: values with 0 for missing and the mask
+        columns = range(len(self.tickers)) if columns is None else columns
+        slices = [(np.searchsorted(self._dates[c], start, side='left'), np.searchsorted(self._dates[c], end, side='left'))
+                  for c in columns]
+        days = np.unique(np.concatenate([self._dates[c][lo:hi] for c, (lo, hi) in zip(columns, slices)] or [[]]))
+        values = np.zeros((len(days), len(slices)))
+        mask = np.zeros((len(days), len(slices)))
+        for k, (c, (lo, hi)) in enumerate(zip(columns, slices)):
+            rows = np.searchsorted(days, self._dates[c][lo:hi])
+            returns = self._returns[c][lo:hi]
+            valid = np.isfinite(returns)
+            values[rows[valid], k] = returns[valid]
+            mask[rows[valid], k] = 1
+        return values, mask
+
+    def _update(self, values: np.ndarray, mask: np.ndarray, sign: float) -> None:
+        self._count += sign * (mask.T @ mask)
+        self._total += sign * (values.T @ mask)
+        self._cross += sign * (values.T @ values)
+
+    def track(self, tickers: Iterable[str]) -> None:
+        '''Start tracking tickers, adding their sums over the current window.'''
+        new = [ticker for ticker in dict.fromkeys(tickers) if ticker not in self._index]
+        if not new:
+            return
+        for ticker in new:
+            series = self.loader(ticker)
+            self._index[ticker] = len(self.tickers)
+            self.tickers.append(ticker)
+            # The return from one close to the next is dated on the later one
+            self._dates.append(np.asarray(series.dates)[1:])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                self._returns.append(np.diff(np.log(np.asarray(series.close, dtype=np.float64))))
+
+        size = len(self.tickers)
+        for name in ('_count', '_total', '_cross'):
+            grown = np.zeros((size, size))
+            old = getattr(self, name)
+            grown[:len(old), :len(old)] = old
+            setattr(self, name, grown)
+        if self.end is None:
+            return
+
+        # Only the pairs involving a new ticker need the returns of the window
+        values, mask = self._block(self.start, self.end)
+        added = [self._index[ticker] for ticker in new]
+        for name, (left, right) in (('_count', (mask, mask)), ('_total', (values, mask)), ('_cross', (values, values))):
+            matrix = getattr(self, name)
+            matrix[added, :] = left[:, added].T @ right
+            matrix[:, added] = left.T @ right[:, added]
+
+    def advance(self, end) -> None:
+        '''
+        Move the window to end before ``end``.
+
+        Moving it forward only reads the returns entering and leaving the
+        window. Moving it back or past the whole current window recomputes it.
+        '''
+        end = price_store.to_days([end])[0]
+        start = end - np.timedelta64(self.days, 'D')
+        if self.end is None or end < self.end or start >= self.end:
+            self._count[:] = 0
+            self._total[:] = 0
+            self._cross[:] = 0
+            if self.tickers:
+                self._update(*self._block(start, end), 1)
+        elif end > self.end:
+            self._update(*self._block(self.end, end), 1)
+            self._update(*self._block(self.start, start), -1)
+        self.start, self.end = start, end
+
+    def moments(self, tickers: list) -> tuple:
+        '''
+        Return the sample statistics of the daily returns of tickers in the current window.
+
+        Returns
+        -------
+        tuple
+            (mean, covariance, observations): the mean daily return and the
+            number of returns of every ticker, and the covariance of every pair
+            over the days both have a return, NaN with fewer than two.
+        '''
+        self.track(tickers)
+        index = [self._index[ticker] for ticker in tickers]
+        grid = np.ix_(index, index)
+        count, total, cross = self._count[grid], self._total[grid], self._cross[grid]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            covariance = (cross - total * total.T / count) / (count - 1)
+            mean = np.diag(total) / np.diag(count)
+        covariance[count < 2] = np.nan
+        return mean, covariance, np.diag(count).astype(np.int64)
+
+
+def shrink_covariance(covariance: np.ndarray, observations: int) -> np.ndarray:
+    '''
+    Shrink a sample covariance towards the identity scaled by its mean variance.
+
+    The intensity is the Oracle Approximating Shrinkage estimate of Chen et al.
+    (2010). Missing covariances are taken as 0 and the result is made positive
+    semidefinite.
+    '''
+    sample = np.nan_to_num(covariance)
+    sample = (sample + sample.T) / 2
+    size = len(sample)
+    if size == 0:
+        return sample
+    mu = np.trace(sample) / size
+    alpha = np.mean(sample ** 2)
+    denominator = (observations + 1) * (alpha - mu ** 2 / size)
+    intensity = 1.0 if denominator <= 0 else min((alpha + mu ** 2) / denominator, 1.0)
+    shrunk = (1 - intensity) * sample + intensity * mu * np.eye(size)
+
+    eigenvalues, eigenvectors = np.linalg.eigh(shrunk)
+    if eigenvalues.min() < 0:
+        shrunk = (eigenvectors * np.maximum(eigenvalues, 0)) @ eigenvectors.T
+    return shrunk
+
+
+def _project(weights: np.ndarray, cap: float) -> np.ndarray:
+    # Euclidean projection onto {0 <= w <= cap, sum(w) = 1}: the weights are clip(weights - shift, 0, cap), and
+    # their sum is piecewise linear in the shift with breakpoints at weights and weights - cap
+    breakpoints = np.sort(np.concatenate([weights, weights - cap]))
+    sums = np.clip(weights[None, :] - breakpoints[:, None], 0, cap).sum(axis=1)
+    # sums decrease with the shift, find the segment where they cross 1 and interpolate
+    i = min(np.searchsorted(-sums, -1, side='left'), len(sums) - 1)
+    if i == 0 or sums[i - 1] == sums[i]:
+        shift = breakpoints[i]
+    else:
+        shift = breakpoints[i - 1] + (sums[i - 1] - 1) / (sums[i - 1] - sums[i]) * (breakpoints[i] - breakpoints[i - 1])
+    return np.clip(weights - shift, 0, cap)
+
+
+def _capped_quadratic(covariance: np.ndarray, mean: np.ndarray, risk_aversion: float, cap: float) -> np.ndarray:
+    # Minimize risk_aversion / 2 * w'Cw - mean'w over the capped simplex by accelerated projected gradient descent
+    size = len(covariance)
+    cap = max(cap, 1 / size)
+    lipschitz = risk_aversion * np.linalg.eigvalsh(covariance).max()
+    step = 1 / lipschitz if lipschitz > 0 else 1.0
+    weights = point = _project(np.full(size, 1 / size), cap)
+    momentum = 1.0
+    for _ in range(MAX_ITERATIONS):
+        gradient = risk_aversion * covariance @ point - mean
+        updated = _project(point - step * gradient, cap)
+        if np.abs(updated - weights).max() < TOLERANCE:
+            return updated
+        next_momentum = (1 + np.sqrt(1 + 4 * momentum ** 2)) / 2
+        point = updated + (momentum - 1) / next_momentum * (updated - weights)
+        weights, momentum = updated, next_momentum
+    return weights
+
+
+def min_variance_weights(covariance: np.ndarray, max_weight: float = MAX_WEIGHT) -> np.ndarray:
+    '''Return the long-only weights of the lowest variance, each at most ``max_weight``.'''
+    return _capped_quadratic(covariance, np.zeros(len(covariance)), 1.0, max_weight)
+
+
+def mean_variance_weights(covariance: np.ndarray, mean: np.ndarray, risk_aversion: float = RISK_AVERSION,
+                          max_weight: float = MAX_WEIGHT) -> np.ndarray:
+    '''
+    Return the long-only weights maximizing ``mean'w - risk_aversion / 2 * w'Cw``, each at most ``max_weight``.
+    '''
+    return _capped_quadratic(covariance, np.asarray(mean, dtype=np.float64), risk_aversion, max_weight)
+
+
+def risk_parity_weights(covariance: np.ndarray) -> np.ndarray:
+    '''
+    Return the long-only weights where every name contributes the same share of the portfolio variance.
+
+    Solved by cyclical coordinate descent (Griveau-Billion, Richard and Roncalli, 2013).
+    '''
+    size = len(covariance)
+    budget = 1 / size
+    variances = np.diag(covariance)
+    weights = 1 / np.sqrt(variances)
+    weights /= weights.sum()
+    for _ in range(MAX_ITERATIONS):
+        previous = weights.copy()
+        for i in range(size):
+            others = covariance[i] @ weights - variances[i] * weights[i]
+            weights[i] = (-others + np.sqrt(others ** 2 + 4 * variances[i] * budget)) / (2 * variances[i])
+        if np.abs(weights / weights.sum() - previous / previous.sum()).max() < TOLERANCE:
+            break
+    return weights / weights.sum()
@@ -0,0 +1,338 @@
+'''
+This module contains the Monte Carlo robustness analysis of the stock selection.
+
+The backtest of the selection is one path, and these tests estimate how much
+of its result could be luck:
+
+- ``bootstrap``: the quarterly returns of the strategy are resampled in
+  circular blocks of consecutive quarters, which keeps short-term
+  autocorrelation;
+- ``perturbation``: every factor value gets Gaussian noise scaled to the
+  cross-sectional dispersion of its metric in its quarter, and the noisy
+  factors are ranked and selected again. Ascending metrics are clamped at 0
+  like the pipeline clamps negative P/E ratios, so they stay ranked last;
+- ``random``: the top-N portfolios are replaced by N stocks drawn at random
+  from the tickers with data in each quarter.
+
+Portfolios are equal-weighted as in ``sweep``. Simulations run in batches of
+NumPy arrays, e.g. a batch of perturbations is ranked with one lexsort per
+metric, and batches are spread over a process pool that reads the panel from
+shared memory. Every batch draws from its own generator seeded by the seed,
+the test and the batch number, so results do not depend on the number of
+workers.
+'''
+
+from __future__ import annotations
+
+import warnings
+from concurrent.futures import ProcessPoolExecutor
+from typing import Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+import backtest
+import ranking
+import sweep
+
+TESTS = ['bootstrap', 'perturbation', 'random']
+
+STATISTICS = ['total_return', 'annual_return', 'sharpe', 'max_drawdown']
+
+# Statistics where lower is better, for the share of simulations that do at least as well
+LOWER_IS_BETTER = {'max_drawdown'}
+
+DEFAULT_SIMULATIONS = 10_000
+BATCH_SIZE = 256
+
+# Quarters per bootstrap block and noise of the perturbation in cross-sectional standard deviations
+BLOCK_SIZE = 4
+NOISE = 0.1
+
+
+def path_statistics(returns: np.ndarray, periods_per_year: int = 4) -> np.ndarray:
+    '''
+    Compute the STATISTICS of return paths.
+
+    Parameters
+    ----------
+    returns : np.ndarray
+        (path, period) returns.
+
+    Returns
+    -------
+    np.ndarray
+        (path, len(STATISTICS)) total and annualized return, Sharpe ratio
+        (without a risk-free rate) and maximum drawdown of every path.
+    '''
+    stats = np.full((len(returns), len(STATISTICS)), np.nan)
+    periods = returns.shape[1]
+    if not periods:
+        return stats
+    nav = np.cumprod(1 + returns, axis=1)
+    peak = np.maximum.accumulate(np.concatenate([np.ones((len(nav), 1)), nav], axis=1), axis=1)[:, 1:]
+    stats[:, 0] = nav[:, -1] - 1
+    with np.errstate(invalid='ignore'):
+        stats[:, 1] = np.where(nav[:, -1] > 0, nav[:, -1] ** (periods_per_year / periods) - 1, -1)
+    stats[:, 3] = (1 - nav / peak).max(axis=1)
+    if periods > 1:
+        std = returns.std(axis=1, ddof=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            stats[:, 2] = np.where(std > 0, returns.mean(axis=1) / std * np.sqrt(periods_per_year), np.nan)
+    return stats
+
+
+def select_batch(values: np.ndarray, present: np.ndarray, ascending: np.ndarray, weights: np.ndarray,
+                 top_n: int) -> np.ndarray:
+    '''
+    Rank and select a batch of factor panels with the same tickers, as ``ranking.select_stocks`` does.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        (batch, quarter, ticker) factor values, with the tickers of every
+        quarter in their source order (see ``source_order``), which breaks ties.
+    present : np.ndarray
+        (quarter, ticker) mask of the tickers with data, in the same order.
+    ascending : np.ndarray
+        Boolean mask of the metrics ranked lowest first, with zeros last.
+    weights : np.ndarray
+        Weight of every metric.
+
+    Returns
+    -------
+    np.ndarray
+        (batch, quarter, ticker) equal weights of the selected stocks.
+    '''
+    shape = values.shape[:3]
+    missing = np.broadcast_to(~present, shape)
+    num_stocks = present.sum(axis=1)
+    positions = np.broadcast_to(np.arange(present.shape[1]), shape)
+
+    scores = np.zeros(shape)
+    first_metric_rank = None
+    for m in range(values.shape[3]):
+        # Missing tickers last, and zeros of ascending metrics just before them
+        column = values[..., m] if ascending[m] else -values[..., m]
+        if ascending[m]:
+            column = np.where(column == 0, np.finfo(np.float64).max, column)
+        column = np.where(missing, np.inf, column)
+        ranks = np.empty(shape, dtype=np.int64)
+        np.put_along_axis(ranks, np.argsort(column, axis=-1, kind='stable'), positions, axis=-1)
+        scores += weights[m] * np.where(missing, 0, num_stocks[None, :, None] - ranks)
+        if first_metric_rank is None:
+            first_metric_rank = ranks
+
+    selection_rank = np.empty(shape, dtype=np.int64)
+    np.put_along_axis(selection_rank, np.lexsort((first_metric_rank, np.where(missing, np.inf, -scores)), axis=-1),
+                      positions, axis=-1)
+    num_selected = np.minimum(num_stocks, top_n)
+    selected = (selection_rank < num_selected[None, :, None]) & ~missing
+    return selected / np.maximum(num_selected, 1)[None, :, None]
+
+
+def source_order(panel: ranking.FactorPanel) -> np.ndarray:
+    '''
+    Return the (quarter, ticker) indices arranging the tickers of every quarter
+    of a panel in their source order, the tickers without data last.
+    '''
+    return np.argsort(panel.order, axis=1, kind='stable')
+
+
+def _holding_returns(holdings: np.ndarray, forward_returns: np.ndarray) -> np.ndarray:
+    # (batch, quarter) returns of the backtested quarters, stocks without a price over the quarter do not contribute
+    realized = ~np.isnan(forward_returns).all(axis=1)
+    return (holdings * np.nan_to_num(forward_returns)[None]).sum(axis=-1)[:, realized]
+
+
+def simulate_batch(test: str, arrays: Mapping, params: Mapping, rng: np.random.Generator, size: int) -> np.ndarray:
+    '''
+    Run ``size`` simulations of a test and return their (simulation, len(STATISTICS)) statistics.
+
+    ``arrays`` holds the 'values', 'present', 'ascending', 'weights', 'scale',
+    'forward_returns' and 'returns' prepared by ``simulate``.
+    '''
+    if test == 'bootstrap':
+        returns = arrays['returns']
+        periods, block = len(returns), min(params['block_size'], max(len(returns), 1))
+        if not periods:
+            return path_statistics(np.empty((size, 0)))
+        starts = rng.integers(0, periods, size=(size, -(-periods // block)))
+        index = (starts[:, :, None] + np.arange(block)[None, None, :]).reshape(size, -1)[:, :periods] % periods
+        return path_statistics(returns[index])
+
+    present = arrays['present']
+    if test == 'perturbation':
+        values = arrays['values']
+        noise = rng.standard_normal((size,) + values.shape) * (params['noise'] * arrays['scale'])[None, :, None, :]
+        ascending = arrays['ascending']
+        # Zeros of ascending metrics mean "no meaningful value" (e.g. a negative P/E) and stay ranked last
+        noise[:, :, :, ascending] *= (values[:, :, ascending] != 0)[None]
+        perturbed = values[None] + noise
+        # Values pushed below zero are clamped to 0 like the pipeline clamps negative ratios, so they rank
+        # last instead of best
+        perturbed[..., ascending] = np.maximum(perturbed[..., ascending], 0)
+        holdings = select_batch(perturbed, present, ascending, arrays['weights'], params['top_n'])
+    elif test == 'random':
+        keys = np.where(present[None], rng.random((size,) + present.shape), 2.0)
+        selection_rank = np.argsort(np.argsort(keys, axis=-1), axis=-1)
+        num_selected = np.minimum(present.sum(axis=1), params['top_n'])
+        holdings = (selection_rank < num_selected[None, :, None]) / np.maximum(num_selected, 1)[None, :, None]
+    else:
+        raise ValueError(f"Unknown robustness test '{test}', expected one of {TESTS}")
+    return path_statistics(_holding_returns(holdings, arrays['forward_returns']))
+
+
+def _simulate_shared(test: str, params: dict, small_arrays: dict, seed: tuple, size: int) -> np.ndarray:
+    arrays = {name: array for name, (_, array) in sweep._shared.items()}
+    arrays.update(small_arrays)
+    return simulate_batch(test, arrays, params, np.random.default_rng(seed), size)
+
+
+def _prepare(panel: ranking.FactorPanel, top_n: int, forward_returns: Optional[pd.DataFrame]) -> dict:
+    panel = panel.subset(sorted(panel.dates, key=backtest.quarter_key))
+
+    # Return realized by the stocks selected in each quarter, held over the next one, as in sweep.sweep
+    holding_quarters = [backtest.next_quarter(date) for date in panel.dates]
+    if forward_returns is None:
+        forward_returns = backtest.forward_return_matrix(holding_quarters, panel.tickers)
+    forward_returns = forward_returns.reindex(index=holding_quarters, columns=panel.tickers).to_numpy(dtype=np.float64, copy=True)
+    backtested = np.array([quarter in panel.dates and backtest.quarter_key(quarter)[0] >= backtest.START_YEAR
+                           for quarter in holding_quarters], dtype=bool)
+    forward_returns[~backtested] = np.nan
+
+    with warnings.catch_warnings():
+        # Quarters without data have no dispersion
+        warnings.simplefilter('ignore', RuntimeWarning)
+        scale = np.nan_to_num(np.nanstd(panel.values, axis=1))
+
+    # Every quarter in the source order of its tickers, so that stable sorts break ties like ranking does
+    arrange = source_order(panel)
+    rows = np.arange(len(panel.dates))[:, None]
+    arrays = {
+        'values': np.ascontiguousarray(panel.values[rows, arrange], dtype=np.float64),
+        'present': panel.present[rows, arrange],
+        'ascending': np.array([metric in ranking.ASCENDING_METRICS for metric in panel.metrics], dtype=bool),
+        'weights': np.array([ranking.METRIC_WEIGHTS.get(metric, 1) for metric in panel.metrics], dtype=np.float64),
+        'scale': scale,
+        'forward_returns': forward_returns[rows, arrange],
+    }
+    holdings = select_batch(arrays['values'][None], arrays['present'], arrays['ascending'], arrays['weights'], top_n)
+    arrays['returns'] = _holding_returns(holdings, arrays['forward_returns'])[0]
+    return arrays
+
+
+def simulate(data: Mapping, tests: Optional[list] = None, simulations: int = DEFAULT_SIMULATIONS, seed: int = 0,
+             top_n: int = ranking.DEFAULT_TOP_N, block_size: int = BLOCK_SIZE, noise: float = NOISE,
+             forward_returns: Optional[pd.DataFrame] = None, workers: int = 1, batch_size: int = BATCH_SIZE) -> tuple:
+    '''
+    Run the robustness tests of the equal-weighted top-N selection.
+
+    Parameters
+    ----------
+    data : Mapping
+        The ``date -> ticker -> metric`` stock data, a snapshot or a FactorPanel,
+        e.g. ``PrimeModel.factor_panel()`` to test over a universe.
+    tests : list, optional
+        Tests of TESTS to run, all by default.
+    simulations : int
+        Simulations of every test.
+    seed : int
+        Seed of the random draws. The same seed gives the same simulations
+        for the same ``batch_size``, whatever the number of workers.
+    block_size : int
+        Quarters of the blocks of the bootstrap.
+    noise : float
+        Standard deviation of the perturbation, relative to the cross-sectional
+        standard deviation of each metric in each quarter.
+    forward_returns : pd.DataFrame, optional
+        quarter x ticker returns from ``backtest.forward_return_matrix``,
+        computed from the price store if not given.
+    workers : int, default 1
+        Number of worker processes. 1 runs the simulations in this process.
+    batch_size : int
+        Simulations computed together in one batch of arrays. The perturbation
+        holds ``batch_size`` copies of the panel.
+
+    Returns
+    -------
+    tuple
+        (observed, samples): the STATISTICS of the actual selection as a
+        Series, and test -> DataFrame of the STATISTICS of every simulation.
+    '''
+    tests = list(TESTS if tests is None else tests)
+    unknown = set(tests) - set(TESTS)
+    if unknown:
+        raise ValueError(f"Unknown robustness tests {sorted(unknown)}, expected some of {TESTS}")
+
+    panel = data if isinstance(data, ranking.FactorPanel) else ranking.build_panel(data)
+    arrays = _prepare(panel, top_n, forward_returns)
+    observed = pd.Series(path_statistics(arrays['returns'][None])[0], index=STATISTICS)
+    params = {'top_n': top_n, 'block_size': block_size, 'noise': noise}
+
+    batches = [(test, (seed, t, b), min(batch_size, simulations - start))
+               for t, test in enumerate(TESTS) if test in tests
+               for b, start in enumerate(range(0, simulations, batch_size))]
+    if workers <= 1:
+        stats = [simulate_batch(test, arrays, params, np.random.default_rng(batch_seed), size)
+                 for test, batch_seed, size in batches]
+    else:
+        # The panel is shared, the small arrays travel with every batch
+        large = ('values', 'present', 'forward_returns')
+        shared = {name: sweep._share(np.ascontiguousarray(arrays[name])) for name in large}
+        small = {name: array for name, array in arrays.items() if name not in large}
+        try:
+            specs = {name: spec for name, (_, spec) in shared.items()}
+            with ProcessPoolExecutor(max_workers=workers, initializer=sweep._attach_worker, initargs=(specs,)) as pool:
+                futures = [pool.submit(_simulate_shared, test, params, small, batch_seed, size)
+                           for test, batch_seed, size in batches]
+                stats = [future.result() for future in futures]
+        finally:
+            for shm, _ in shared.values():
+                shm.close()
+                shm.unlink()
+
+    samples = {}
+    for test in tests:
+        test_stats = [batch_stats for (batch_test, _, _), batch_stats in zip(batches, stats) if batch_test == test]
+        samples[test] = pd.DataFrame(np.concatenate(test_stats) if test_stats else np.empty((0, len(STATISTICS))),
+                                     columns=STATISTICS)
+    return observed, samples
+
+
+def confidence_intervals(observed: pd.Series, samples: Mapping, confidence: float = 0.95) -> pd.DataFrame:
+    '''
+    Summarize the simulations of every test.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per (test, statistic) with the 'observed' value of the actual
+        selection, the 'mean' and the 'lower' and 'upper' percentile bounds of
+        the simulations, and 'p_value', the share of simulations that did at
+        least as well as the actual selection.
+    '''
+    tail = (1 - confidence) / 2 * 100
+    rows = []
+    for test, frame in samples.items():
+        for statistic in STATISTICS:
+            values = frame[statistic].dropna().to_numpy()
+            value = observed[statistic]
+            if len(values):
+                lower, upper = np.percentile(values, [tail, 100 - tail])
+                better = values <= value if statistic in LOWER_IS_BETTER else values >= value
+                rows.append((test, statistic, value, values.mean(), lower, upper, better.mean()))
+            else:
+                rows.append((test, statistic, value, np.nan, np.nan, np.nan, np.nan))
+    return pd.DataFrame(rows, columns=['test', 'statistic', 'observed', 'mean', 'lower', 'upper', 'p_value']
+                        ).set_index(['test', 'statistic'])
+
+
+def robustness(data: Mapping, tests: Optional[list] = None, simulations: int = DEFAULT_SIMULATIONS,
+               confidence: float = 0.95, **kwargs) -> pd.DataFrame:
+    '''
+    Run the robustness tests and return their confidence intervals.
+    See ``simulate`` for the parameters and ``confidence_intervals`` for the result.
+    '''
+    observed, samples = simulate(data, tests, simulations, **kwargs)
+    return confidence_intervals(observed, samples, confidence)
@@ -0,0 +1,445 @@
+'''
+This module contains the long-running selection service.
+
+The service loads the factor panel once and answers selection, ranking and
+backtest queries over HTTP/JSON, on a TCP port or a Unix socket, so callers
+pay neither the interpreter startup nor the loading of the stock data per
+query:
+
+    GET  /health                              quarters, tickers and version of the loaded data
+    GET  /select?quarters=["2025_q2"]&top_n=3 quarter -> selected tickers
+    POST /rank      {"quarters": ["2025_q2"], "weights": {"pe_ratio": 1}}
+    POST /backtest  {"top_n": 3, "scheme": "equal"}
+    POST /reload                              reload the data now, without waiting for the next check
+
+Query parameters of GET requests are JSON values. Every query accepts
+``top_n``, ``weights`` (metric -> weight, the unlisted ones keeping their
+``ranking.METRIC_WEIGHTS`` weight) and ``ascending`` (the metrics ranked
+lowest first), and selections and rankings accept ``quarters``, all of them
+by default.
+
+The loaded data is an immutable ``ServiceState``. A watcher thread checks the
+snapshot and stock_data_by_date.json every few seconds, loads the new data in
+the background when one of them changed and then swaps the state in, so
+requests never wait for a reload: they are answered from the state that was
+current when they arrived. The forward returns of every ticker are computed
+with the load as well, so backtests never fetch prices on a request. Responses
+are kept in an LRU cache keyed by the state version and the query, and every
+state keeps the portfolio weights of the selection rules and allocation
+schemes it was asked for, so queries that only differ in other parameters
+never run the covariance optimizers again.
+'''
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import pandas as pd
+
+import backtest
+import data_model
+import ranking
+import snapshot
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_SIZE = 256
+
+# Seconds between two checks of the data files
+RELOAD_INTERVAL = 2.0
+
+JSON_FILE = 'stock_data_by_date.json'
+
+
+class BadRequest(ValueError):
+    '''Raised for a query the service cannot answer, answered with HTTP 400.'''
+
+
+def _signature() -> tuple:
+    # Modification times of the files the data is loaded from
+    paths = (JSON_FILE, os.path.join(snapshot.SNAPSHOT_DIR, snapshot.INDEX_FILE))
+    return tuple(os.path.getmtime(path) if os.path.exists(path) else None for path in paths)
+
+
+def _to_json(value):
+    # NaN and infinities are not valid JSON
+    if isinstance(value, float) and not np.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {key: _to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_to_json(item) for item in value]
+    return value
+
+
+class ServiceState:
+    '''
+    One version of the loaded data, read-only once built.
+
+    Attributes
+    ----------
+    panel : ranking.FactorPanel
+        Every quarter in chronological order, held in memory, restricted to the universe if there is one.
+    version : int
+        Number of the load, increased by every reload.
+    signature : tuple
+        Modification times of the data files it was loaded from.
+    returns : pd.DataFrame
+        ``backtest.forward_return_matrix`` of every ticker over every quarter
+        of the panel, computed with the load so that backtests never fetch prices.
+    allocations : LRUCache
+        (scheme, top_n, weights, ascending) -> ``backtest.allocate`` weights of
+        that selection, filled by the backtests answered from this state.
+    '''
+
+    def __init__(self, panel: ranking.FactorPanel, version: int, signature: tuple, returns: pd.DataFrame,
+                 cache_size: int = DEFAULT_CACHE_SIZE):
+        self.panel = panel
+        self.version = version
+        self.signature = signature
+        self.returns = returns
+        self.allocations = LRUCache(cache_size)
+        self.loaded_at = time.time()
+
+
+class LRUCache:
+    '''Thread-safe mapping keeping the ``size`` most recently used entries.'''
+
+    def __init__(self, size: int = DEFAULT_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class SelectionService:
+    '''
+    Answers queries from a warm factor panel and reloads it when the data files change.
+
+    Parameters
+    ----------
+    universe : universe.Universe, optional
+        Only the tickers that were members at the end of a quarter are ranked in it.
+    cache_size : int
+        Number of responses kept in the LRU cache.
+    reload_interval : float
+        Seconds between two checks of the data files by ``start_watcher``.
+    '''
+
+    # Query path -> method answering it
+    QUERIES = {'/select': 'select', '/rank': 'rank', '/backtest': 'backtest'}
+    PATHS = {'/health', '/reload', *QUERIES}
+
+    def __init__(self, universe=None, cache_size: int = DEFAULT_CACHE_SIZE, reload_interval: float = RELOAD_INTERVAL):
+        self.universe = universe
+        self.cache = LRUCache(cache_size)
+        self.reload_interval = reload_interval
+        self._reload_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+        self._failed_signature = None
+        self.state = self._load(1)
+
+    # Loading
+
+    def _load(self, version: int) -> ServiceState:
+        data = data_model.load_stock_data()
+        # After load_stock_data, which imports the JSON file into the snapshot when it is newer
+        signature = _signature()
+        panel = data.to_panel()
+        panel = panel.subset(sorted(panel.dates, key=backtest.quarter_key))
+        if self.universe is not None:
+            panel = panel.restrict(self.universe.membership_mask(panel.dates, panel.tickers))
+        # The price histories are brought up to date here, in the loading thread, and never on a request
+        returns = backtest.forward_return_matrix(panel.dates, panel.tickers)
+        logger.info("Loaded %d quarters of %d tickers (version %d)", len(panel.dates), len(panel.tickers), version)
+        return ServiceState(panel, version, signature, returns, self.cache.size)
+
+    def reload(self, force: bool = False) -> bool:
+        '''
+        Load the data again if its files changed, or if ``force``, and swap it in.
+
+        Requests keep being answered from the current state meanwhile. Returns
+        True if a new state was swapped in. A failed load is logged and the
+        current state kept, and it is only tried again once the files change.
+        '''
+        with self._reload_lock:
+            signature = _signature()
+            if not force and signature in (self.state.signature, self._failed_signature):
+                return False
+            try:
+                state = self._load(self.state.version + 1)
+            except Exception as exc:
+                logger.warning("Failed to reload the stock data, still serving version %d: %s", self.state.version, exc)
+                self._failed_signature = signature
+                return False
+            self._failed_signature = None
+            # A single assignment, requests see either the old or the new state
+            self.state = state
+            self.cache.clear()
+            return True
+
+    def start_watcher(self) -> threading.Thread:
+        '''Start the thread reloading the data when its files change.'''
+        def watch():
+            while not self._stop.wait(self.reload_interval):
+                self.reload()
+
+        self._watcher = threading.Thread(target=watch, name='snapshot-watcher', daemon=True)
+        self._watcher.start()
+        return self._watcher
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    # Queries
+
+    def _rules(self, state: ServiceState, params: dict) -> tuple:
+        try:
+            top_n = int(params.get('top_n', ranking.DEFAULT_TOP_N))
+        except (TypeError, ValueError):
+            raise BadRequest(f"top_n must be an integer, not {params.get('top_n')!r}") from None
+        if top_n < 1:
+            raise BadRequest("top_n must be at least 1")
+
+        metrics = state.panel.metrics
+        weights = dict(ranking.METRIC_WEIGHTS)
+        if params.get('weights') is not None:
+            if not isinstance(params['weights'], dict):
+                raise BadRequest("weights must be an object of metric -> weight")
+            unknown = set(params['weights']) - set(metrics)
+            if unknown:
+                raise BadRequest(f"Unknown metrics {sorted(unknown)}, expected some of {metrics}")
+            try:
+                weights.update({metric: float(weight) for metric, weight in params['weights'].items()})
+            except (TypeError, ValueError):
+                raise BadRequest(f"Weights must be numbers, not {params['weights']!r}") from None
+        ascending = ranking.ASCENDING_METRICS
+        if params.get('ascending') is not None:
+            ascending = params['ascending']
+            ascending = {ascending} if isinstance(ascending, str) else set(ascending)
+            if ascending - set(metrics):
+                raise BadRequest(f"Unknown metrics {sorted(ascending - set(metrics))}, expected some of {metrics}")
+        return top_n, weights, ascending
+
+    def _panel(self, state: ServiceState, params: dict) -> ranking.FactorPanel:
+        quarters = params.get('quarters')
+        if quarters is None:
+            return state.panel
+        if isinstance(quarters, str):
+            quarters = [quarters]
+        known = set(state.panel.dates)
+        unknown = [quarter for quarter in quarters if quarter not in known]
+        if unknown:
+            raise BadRequest(f"Unknown quarters {unknown}")
+        return state.panel.subset(quarters)
+
+    def select(self, state: ServiceState, params: dict) -> dict:
+        '''quarter -> selected tickers.'''
+        top_n, weights, ascending = self._rules(state, params)
+        return ranking.select_stocks(self._panel(state, params), top_n, weights=weights, ascending=ascending)
+
+    def rank(self, state: ServiceState, params: dict) -> dict:
+        '''quarter -> every ticker with data, best first, with its score.'''
+        _, weights, ascending = self._rules(state, params)
+        panel = self._panel(state, params)
+        positions = ranking.rank_positions(panel, ascending)
+        scores = ranking.score_panel(panel, positions, weights)
+        ordered = ranking.select_top(panel, scores, positions, len(panel.tickers))
+        column = {ticker: t for t, ticker in enumerate(panel.tickers)}
+        return {quarter: [{'ticker': ticker, 'score': float(scores[q, column[ticker]])} for ticker in ordered[quarter]]
+                for q, quarter in enumerate(panel.dates)}
+
+    def backtest(self, state: ServiceState, params: dict) -> dict:
+        '''
+        The quarterly 'return' of the selection, weighted by the allocation 'scheme' if given, and then its 'nav'.
+        '''
+        top_n, weights, ascending = self._rules(state, params)
+        panel = state.panel
+        selected_stocks = ranking.select_stocks(panel, top_n, weights=weights, ascending=ascending)
+        scheme = params.get('scheme')
+        allocation = None
+        if scheme is not None:
+            if scheme not in backtest.ALLOCATION_SCHEMES:
+                raise BadRequest(f"Unknown allocation scheme '{scheme}', expected one of {backtest.ALLOCATION_SCHEMES}")
+            # The weights only depend on the selection rules and the scheme, e.g. not on start_year
+            key = (scheme, top_n, tuple(sorted(weights.items())), tuple(sorted(ascending)))
+            allocation = state.allocations.get(key)
+            if allocation is None:
+                scores = None
+                if scheme == 'score':
+                    scores = pd.DataFrame(ranking.score_panel(panel, weights=weights, ascending=ascending),
+                                          index=panel.dates, columns=panel.tickers)
+                allocation = backtest.allocate(selected_stocks, scheme, scores)
+                state.allocations.put(key, allocation)
+        try:
+            start_year = int(params.get('start_year', backtest.START_YEAR))
+        except (TypeError, ValueError):
+            raise BadRequest(f"start_year must be an integer, not {params.get('start_year')!r}") from None
+        result = backtest.portfolio_returns(selected_stocks, allocation, state.returns, start_year)
+        return {quarter: {column: float(value) for column, value in row.items()} for quarter, row in result.iterrows()}
+
+    def health(self, state: ServiceState, params: dict) -> dict:
+        return {'status': 'ok', 'version': state.version, 'loaded_at': state.loaded_at,
+                'quarters': len(state.panel.dates), 'tickers': len(state.panel.tickers), 'metrics': state.panel.metrics,
+                'cache': {'entries': len(self.cache), 'hits': self.cache.hits, 'misses': self.cache.misses},
+                'allocations': len(state.allocations)}
+
+    def handle(self, path: str, params: dict) -> dict:
+        '''
+        Answer a query of QUERIES or '/health' from the current state, from the cache if it was answered before.
+
+        Raises
+        ------
+        BadRequest
+            If the parameters are invalid.
+        '''
+        state = self.state
+        if path == '/health':
+            return self.health(state, params)
+
+        key = (state.version, path, json.dumps(params, sort_keys=True))
+        response = self.cache.get(key)
+        if response is None:
+            response = _to_json(getattr(self, self.QUERIES[path])(state, params))
+            self.cache.put(key, response)
+        return response
+
+
+class RequestHandler(BaseHTTPRequestHandler):
+    '''HTTP/JSON front end of the SelectionService of its server.'''
+
+    protocol_version = 'HTTP/1.1'
+
+    def _send(self, status: int, payload) -> None:
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _answer(self, path: str, params: dict) -> None:
+        service = self.server.service
+        if path not in service.PATHS:
+            self._send(404, {'error': f"Unknown path {path}"})
+            return
+        try:
+            if path == '/reload':
+                # Loaded in the background, requests keep being answered meanwhile
+                threading.Thread(target=service.reload, kwargs={'force': True}, daemon=True).start()
+                self._send(202, {'status': 'reloading', 'version': service.state.version})
+                return
+            self._send(200, service.handle(path, params))
+        except BadRequest as exc:
+            self._send(400, {'error': str(exc)})
+        except Exception as exc:
+            logger.exception("Failed to answer %s", path)
+            self._send(500, {'error': str(exc)})
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        params = {}
+        for key, value in parse_qsl(url.query):
+            try:
+                params[key] = json.loads(value)
+            except json.JSONDecodeError:
+                # Plain strings, e.g. quarters=2025_q2
+                params[key] = value
+        self._answer(url.path, params)
+
+    def do_POST(self) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            params = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError as exc:
+            self._send(400, {'error': f"Invalid JSON body: {exc}"})
+            return
+        if not isinstance(params, dict):
+            self._send(400, {'error': "The JSON body must be an object"})
+            return
+        self._answer(urlsplit(self.path).path, params)
+
+    def address_string(self) -> str:
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else 'unix'
+
+    def log_message(self, format: str, *args) -> None:
+        logger.info("%s %s", self.address_string(), format % args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Threaded HTTP server on a Unix socket.'''
+
+    daemon_threads = True
+
+
+def make_server(service: SelectionService, host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                unix_socket: Optional[str] = None):
+    '''
+    Create the HTTP server of a service, on ``unix_socket`` if given, else on ``host:port``.
+    Every request is answered on its own thread.
+    '''
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = UnixHTTPServer(unix_socket, RequestHandler)
+    else:
+        server = ThreadingHTTPServer((host, port), RequestHandler)
+        server.daemon_threads = True
+    server.service = service
+    return server
+
+
+def serve(host: str = DEFAULT_HOST, port: int = DEFAULT_PORT, unix_socket: Optional[str] = None, universe=None,
+          cache_size: int = DEFAULT_CACHE_SIZE, reload_interval: float = RELOAD_INTERVAL) -> None:
+    '''Load the data and answer queries until interrupted.'''
+    service = SelectionService(universe, cache_size, reload_interval)
+    service.start_watcher()
+    server = make_server(service, host, port, unix_socket)
+    logger.info("Serving on %s", unix_socket or f"http://{host}:{server.server_address[1]}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+        server.server_close()
+        if unix_socket is not None and os.path.exists(unix_socket):
+            os.remove(unix_socket)
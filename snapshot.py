@@ -0,0 +1,163 @@
+'''
+This module contains the columnar snapshot format of the factor dataset.
+
+A snapshot is a directory holding one float array of shape (quarter, ticker)
+per metric, saved with ``np.save``, and an ``index.json`` table of the
+quarters, tickers and metrics. Arrays are opened memory-mapped, so loading a
+subset of quarters or metrics never reads the rest of the data.
+
+    stock_data_by_date_snapshot/
+        index.json      {"quarters": [...], "tickers": [...], "metrics": [...]}
+        order.npy       position of each ticker within its quarter, -1 if absent
+        <metric>.npy    metric values, NaN if absent
+'''
+
+from __future__ import annotations
+
+import json
+import os
+import shutil
+from collections.abc import Mapping
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+import ranking
+
+SNAPSHOT_DIR = 'stock_data_by_date_snapshot'
+INDEX_FILE = 'index.json'
+ORDER_FILE = 'order.npy'
+FORMAT_VERSION = 1
+
+
+class Snapshot(Mapping):
+    '''
+    Lazily loaded, read-only view of a snapshot directory.
+
+    It behaves like the ``date -> ticker -> metric`` dict of
+    stock_data_by_date.json, building the dict of a quarter only when that
+    quarter is accessed.
+    '''
+
+    def __init__(self, path: str = SNAPSHOT_DIR, quarters: Optional[list] = None, metrics: Optional[list] = None):
+        self.path = path
+        with open(os.path.join(path, INDEX_FILE), 'r') as f:
+            index = json.load(f)
+        if index.get('version') != FORMAT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {index.get('version')} in {path}")
+
+        self.tickers = index['tickers']
+        all_quarters = index['quarters']
+        rows = {quarter: i for i, quarter in enumerate(all_quarters)}
+        self.quarters = all_quarters if quarters is None else [quarter for quarter in quarters if quarter in rows]
+        self.metrics = index['metrics'] if metrics is None else list(metrics)
+        missing_metrics = set(self.metrics) - set(index['metrics'])
+        if missing_metrics:
+            raise KeyError(f"Metrics not in snapshot: {sorted(missing_metrics)}")
+
+        # Row of every selected quarter in the stored arrays
+        self._rows = np.array([rows[quarter] for quarter in self.quarters], dtype=np.int64)
+        self._quarter_index = {quarter: i for i, quarter in enumerate(self.quarters)}
+        self._order = np.load(os.path.join(path, ORDER_FILE), mmap_mode='r')
+        self._columns = {metric: np.load(os.path.join(path, f"{metric}.npy"), mmap_mode='r') for metric in self.metrics}
+
+    def __getitem__(self, quarter: str) -> dict:
+        row = self._rows[self._quarter_index[quarter]]
+        order = np.asarray(self._order[row])
+        present = np.flatnonzero(order >= 0)
+        present = present[np.argsort(order[present], kind='stable')]
+        values = {metric: np.asarray(column[row]) for metric, column in self._columns.items()}
+        return {self.tickers[t]: {metric: float(values[metric][t]) for metric in self.metrics} for t in present}
+
+    def __iter__(self):
+        return iter(self.quarters)
+
+    def __len__(self) -> int:
+        return len(self.quarters)
+
+    def __contains__(self, quarter) -> bool:
+        return quarter in self._quarter_index
+
+    def subset(self, quarters: Optional[list] = None, metrics: Optional[list] = None) -> 'Snapshot':
+        '''Return a view of some of the quarters and metrics of this snapshot.'''
+        return Snapshot(self.path, self.quarters if quarters is None else quarters,
+                        self.metrics if metrics is None else metrics)
+
+    def to_panel(self, metrics: Optional[list] = None, quarters: Optional[list] = None) -> ranking.FactorPanel:
+        '''
+        Build a ranking.FactorPanel straight from the stored arrays, without going through dicts.
+        '''
+        metrics = list(metrics or self.metrics)
+        view = self if quarters is None and set(metrics) <= set(self.metrics) else self.subset(quarters, metrics)
+
+        order = np.asarray(view._order[view._rows], dtype=np.int64)
+        # Tickers absent from a quarter are sorted after all present ones
+        order = np.where(order < 0, len(view.tickers), order)
+        values = np.stack([np.asarray(view._columns[metric][view._rows]) for metric in metrics], axis=-1)
+        return ranking.FactorPanel(view.quarters, view.tickers, metrics, values, order)
+
+    def to_dict(self) -> dict:
+        '''Load the whole snapshot as a stock_data_by_date.json style dict.'''
+        return {quarter: self[quarter] for quarter in self.quarters}
+
+    def to_frame(self) -> pd.DataFrame:
+        '''Load the whole snapshot in long format, one row per quarter and ticker with data.'''
+        panel = self.to_panel()
+        q, t = np.nonzero(panel.present)
+        # Tickers of a quarter in their stored order
+        rows = np.lexsort((panel.order[q, t], q))
+        q, t = q[rows], t[rows]
+        frame = pd.DataFrame(panel.values[q, t], columns=panel.metrics)
+        frame.insert(0, 'ticker', np.array(panel.tickers, dtype=object)[t])
+        frame.insert(0, 'quarter', np.array(panel.dates, dtype=object)[q])
+        return frame
+
+
+def write_snapshot(date_dict: Mapping, path: str = SNAPSHOT_DIR) -> None:
+    '''
+    Write a ``date -> ticker -> metric`` mapping as a snapshot directory.
+
+    The directory is written next to ``path`` first and then swapped in, so
+    readers never see a half-written snapshot.
+    '''
+    metrics = []
+    for stocks in date_dict.values():
+        for values in stocks.values():
+            metrics.extend(metric for metric in values if metric not in metrics)
+    write_panel(ranking.build_panel(date_dict, metrics), path)
+
+
+def write_panel(panel: ranking.FactorPanel, path: str = SNAPSHOT_DIR) -> None:
+    '''
+    Write a FactorPanel as a snapshot directory, atomically like ``write_snapshot``.
+    '''
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    order = np.where(panel.present, panel.order, -1).astype(np.int32)
+    np.save(os.path.join(tmp_path, ORDER_FILE), order)
+    for m, metric in enumerate(panel.metrics):
+        np.save(os.path.join(tmp_path, f"{metric}.npy"), np.ascontiguousarray(panel.values[:, :, m]))
+    with open(os.path.join(tmp_path, INDEX_FILE), 'w') as f:
+        json.dump({'version': FORMAT_VERSION, 'quarters': panel.dates, 'tickers': panel.tickers,
+                   'metrics': panel.metrics}, f, indent=4)
+
+    old_path = f"{path}.{os.getpid()}.old"
+    if os.path.exists(path):
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def import_json(json_path: str = 'stock_data_by_date.json', path: str = SNAPSHOT_DIR) -> Snapshot:
+    '''Convert a stock_data_by_date.json file into a snapshot.'''
+    with open(json_path, 'r') as json_file:
+        write_snapshot(json.load(json_file), path)
+    return Snapshot(path)
+
+
+def export_json(path: str = SNAPSHOT_DIR, json_path: str = 'stock_data_by_date.json') -> None:
+    '''Write a snapshot back as a stock_data_by_date.json file.'''
+    with open(json_path, 'w') as json_file:
+        json.dump(Snapshot(path).to_dict(), json_file, indent=4)
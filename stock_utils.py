@@ -5,20 +5,82 @@ This module contains functions for fetching data from Yahoo Finance API
 from __future__ import annotations
 
 import logging
+import threading
 from typing import Optional
 
-import yfinance as yf
 import pandas as pd
-import requests
-from dotenv import load_dotenv
 import os
 from datetime import datetime, timedelta
 
+import alpha_vantage
+import cache_store
+import instrumentation
+import offline
+import price_store
+
+# yfinance, requests and python-dotenv are imported on first use, so that
+# runs answered from the caches never load them
+
 logger = logging.getLogger(__name__)
 
-load_dotenv()
 alphavantage_api_key = os.getenv('ALPHA_VANTAGE_API_KEY')
 
+# Alpha Vantage functions fetched for every ticker on a refresh
+REFRESH_FUNCTIONS = ("EARNINGS", "INCOME_STATEMENT")
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def api_key() -> Optional[str]:
+    '''
+    Return the Alpha Vantage API key, reading the .env file the first time it is needed.
+    '''
+    global alphavantage_api_key
+    if alphavantage_api_key is None:
+        from dotenv import load_dotenv
+        load_dotenv()
+        alphavantage_api_key = os.getenv('ALPHA_VANTAGE_API_KEY')
+    return alphavantage_api_key
+
+
+def scheduler() -> alpha_vantage.Scheduler:
+    '''
+    Return the scheduler all Alpha Vantage requests go through.
+
+    It is created on first use from the API key and the ALPHA_VANTAGE_PLAN and
+    ALPHA_VANTAGE_URL environment variables, which may come from the .env file.
+    '''
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            key = api_key()
+            _scheduler = alpha_vantage.Scheduler(key, os.getenv('ALPHA_VANTAGE_URL'), os.getenv('ALPHA_VANTAGE_PLAN'))
+    return _scheduler
+
+
+def alpha_vantage_query(function: str, symbol: str) -> dict:
+    '''
+    Query an Alpha Vantage endpoint for a symbol and return the decoded JSON.
+    Throttled requests are retried by the scheduler and never returned.
+    '''
+    return scheduler().query(function, symbol)
+
+
+def refresh_batch(tickers: list):
+    '''
+    Return a context in which the Alpha Vantage data of the tickers is refreshed.
+    If the refresh is interrupted, the next one skips the requests already answered.
+    '''
+    return scheduler().batch([(function, ticker) for ticker in tickers for function in REFRESH_FUNCTIONS])
+
+
+def _fetch(function: str, symbol: str) -> dict:
+    offline.require_network(f"Alpha Vantage {function} data of {symbol}")
+    # Timed at the call site so that replacing alpha_vantage_query (e.g. by the benchmarks) keeps the accounting
+    with instrumentation.call(f"alphavantage:{function}"):
+        return alpha_vantage_query(function, symbol)
+
 
 def get_pe_ratio(ticker: str, *, forward: bool = False, raise_on_missing: bool = False) -> Optional[float]:
     """Return the price-to-earnings ratio (P/E) for a stock ticker.
@@ -43,10 +105,13 @@ def get_pe_ratio(ticker: str, *, forward: bool = False, raise_on_missing: bool =
 
     if not ticker:
         raise ValueError("`ticker` must be a non-empty string")
+    offline.require_network(f"The P/E ratio of {ticker}")
 
     try:
+        import yfinance as yf
         stock = yf.Ticker(ticker)
-        info = stock.info  # network call to Yahoo Finance API
+        with instrumentation.call('yfinance:info'):
+            info = stock.info  # network call to Yahoo Finance API
     except Exception as exc:
         logger.warning("Failed to fetch data for %s: %s", ticker, exc)
         if raise_on_missing:
@@ -80,52 +145,40 @@ def compound_return(ticker: str, days: int = 30, start_date: datetime = datetime
         A DataFrame containing the compounded return over the specified period.
     '''
     try:
-        stock = yf.Ticker(ticker)
-        
-        if start_date:
-            end_date = start_date - timedelta(days=days)
-            hist = stock.history(start=end_date, end=start_date)
-        else:
-            hist = stock.history(period=f"{days}d")
-        
-        if hist.empty:
-            raise ValueError(f"No historical data available for ticker '{ticker}' over the specified period.")
-        
-        # Calculate daily returns
-        hist['Daily Return'] = hist['Close'].pct_change()
-        
-        # Calculate compounded return
-        compounded_return = (1 + hist['Daily Return']).prod() - 1
+        # Prices come from the local price store, which downloads the full history once
+        compounded_return = price_store.compound_return(ticker, days, start_date)
         
         return pd.DataFrame({'Compounded Return': [compounded_return]})
     
+    except offline.OfflineError:
+        raise
     except Exception as exc:
         logger.warning("Failed to calculate compounded return for %s: %s", ticker, exc)
         return pd.DataFrame()
 
-def get_stock_eps(ticker: str) -> pd.DataFrame:
-    cache_dir = "cache"
-    os.makedirs(cache_dir, exist_ok=True)
-    cache_file = os.path.join(cache_dir, f"{ticker}_eps_cache.csv")
+def _stale_frame(cache: cache_store.CacheStore, dataset: str, ticker: str, refresh: bool) -> Optional[pd.DataFrame]:
+    # Cached reports past their TTL are still better than none when they cannot be fetched again
+    stale = None if refresh else cache.get_frame(dataset, ticker, include_stale=True)
+    if stale is not None:
+        logger.warning("Using the cached %s of %s, which could not be fetched again", dataset, ticker)
+    return stale
+
+def get_stock_eps(ticker: str, refresh: bool = False) -> pd.DataFrame:
+    '''
+    Get the quarterly earnings per share of a stock.
+    If refresh is True, the cached data is ignored and fetched again. Cached
+    data past its TTL is fetched again too, and only used if that fails.
+    '''
+    cache = cache_store.default_store()
     
-    # Check if the cache file exists
-    if os.path.exists(cache_file):
-        try:
-            return pd.read_csv(cache_file)
-        except Exception as exc:
-            logger.warning("Failed to read cache for %s: %s", ticker, exc)
+    # Check if the data is cached
+    cached = None if refresh else cache.get_frame('eps', ticker)
+    if cached is not None:
+        return cached
     
     try:
-        print("Cache miss, Fetching earnings data for %s", ticker)
-        url = f"https://www.alphavantage.co/query"
-        params = {
-            "function": "EARNINGS",
-            "symbol": ticker,
-            "apikey": alphavantage_api_key
-        }
-        response = requests.get(url, params=params)
-        response.raise_for_status()  # Raise an error for bad responses
-        data = response.json()
+        logger.info("Cache miss, fetching earnings data for %s", ticker)
+        data = _fetch("EARNINGS", ticker)
 
         # Extract the earnings data
         earnings = data.get("quarterlyEarnings", [])
@@ -144,96 +197,98 @@ def get_stock_eps(ticker: str) -> pd.DataFrame:
             df = df[df['date'] >= pd.to_datetime('2010-01-01')]
             df = df.sort_values('date', ascending=False)
         
-        # Save the DataFrame to a cache file
-        df.to_csv(cache_file, index=False)
+        # Save the DataFrame to the cache and read it back, so that a cache miss
+        # returns the same types as a cache hit
+        cache.put_frame('eps', ticker, df)
         
-        return df
+        return cache.get_frame('eps', ticker)
+    except (offline.OfflineError, alpha_vantage.QuotaExceededError):
+        stale = _stale_frame(cache, 'eps', ticker, refresh)
+        if stale is None:
+            raise
+        return stale
     except Exception as exc:
         logger.warning("Failed to fetch earnings for %s: %s", ticker, exc)
-        return pd.DataFrame()
-    
-def get_stock_revenue(ticker: str) -> pd.DataFrame:
-    '''
-    Get the revenue of a stock.
-    '''
-    cache_dir = "cache"
-    os.makedirs(cache_dir, exist_ok=True)
-    cache_file = os.path.join(cache_dir, f"{ticker}_income_statement_cache.csv")
-    
-    # Check if the cache file exists
-    if os.path.exists(cache_file):
-        try:
-            return pd.read_csv(cache_file)
-        except Exception as exc:
-            logger.warning("Failed to read cache for %s: %s", ticker, exc)
+        stale = _stale_frame(cache, 'eps', ticker, refresh)
+        return pd.DataFrame() if stale is None else stale
     
+# Cache dataset of the revenue of each report list of an INCOME_STATEMENT response
+INCOME_STATEMENT_REPORTS = {'income_statement': 'annualReports', 'quarterly_income_statement': 'quarterlyReports'}
+
+
+def _revenue_frame(reports: list) -> pd.DataFrame:
+    # Create a DataFrame with date and totalRevenue
+    revenue_data = [
+        {"date": entry.get("fiscalDateEnding"), "totalRevenue": entry.get("totalRevenue")}
+        for entry in reports
+    ]
+
+    df = pd.DataFrame(revenue_data)
+
+    # Filter to only include dates after 2010
+    if not df.empty:
+        df['date'] = pd.to_datetime(df['date'])
+        df = df[df['date'] >= pd.to_datetime('2010-01-01')]
+        df = df.sort_values('date', ascending=False)
+    return df
+
+
+def _get_revenue(ticker: str, dataset: str, refresh: bool = False) -> pd.DataFrame:
+    cache = cache_store.default_store()
+
+    # Check if the data is cached
+    cached = None if refresh else cache.get_frame(dataset, ticker)
+    if cached is not None:
+        return cached
+
     try:
-        url = f"https://www.alphavantage.co/query"
-        params = {
-            "function": "INCOME_STATEMENT",
-            "symbol": ticker,
-            "apikey": alphavantage_api_key
-        }
-        response = requests.get(url, params=params)
-        response.raise_for_status()  # Raise an error for bad responses
-        data = response.json()
-
-        # Extract the income statement data
-        annual_reports = data.get("annualReports", [])
-
-        # Create a DataFrame with date and totalRevenue
-        revenue_data = [
-            {"date": entry.get("fiscalDateEnding"), "totalRevenue": entry.get("totalRevenue")}
-            for entry in annual_reports
-        ]
+        data = _fetch("INCOME_STATEMENT", ticker)
 
-        df = pd.DataFrame(revenue_data)
-        
-        # Filter to only include dates after 2010
-        if not df.empty:
-            df['date'] = pd.to_datetime(df['date'])
-            df = df[df['date'] >= pd.to_datetime('2010-01-01')]
-            df = df.sort_values('date', ascending=False)
-        
-        # Save the DataFrame to a cache file
-        df.to_csv(cache_file, index=False)
-        
-        return df
+        # The response holds the annual and the quarterly reports, cache both.
+        # Save the DataFrames to the cache and read them back, so that a cache
+        # miss returns the same types as a cache hit
+        for name, reports in INCOME_STATEMENT_REPORTS.items():
+            cache.put_frame(name, ticker, _revenue_frame(data.get(reports, [])))
+
+        return cache.get_frame(dataset, ticker)
+    except (offline.OfflineError, alpha_vantage.QuotaExceededError):
+        stale = _stale_frame(cache, dataset, ticker, refresh)
+        if stale is None:
+            raise
+        return stale
     except Exception as exc:
         logger.warning("Failed to fetch income statement for %s: %s", ticker, exc)
-        return pd.DataFrame()
+        stale = _stale_frame(cache, dataset, ticker, refresh)
+        return pd.DataFrame() if stale is None else stale
+
+def get_stock_revenue(ticker: str, refresh: bool = False) -> pd.DataFrame:
+    '''
+    Get the annual revenue of a stock.
+    If refresh is True, the cached data is ignored and fetched again.
+    '''
+    return _get_revenue(ticker, 'income_statement', refresh)
+
+def get_stock_quarterly_revenue(ticker: str, refresh: bool = False) -> pd.DataFrame:
+    '''
+    Get the quarterly revenue of a stock.
+    If refresh is True, the cached data is ignored and fetched again.
+    '''
+    return _get_revenue(ticker, 'quarterly_income_statement', refresh)
     
 def get_nasdaq_100_index(date: datetime) -> pd.DataFrame:
     '''
     Get the NASDAQ 100 index for a given date.
-    '''
 
-    # Define the ticker symbol for NASDAQ 100 index
-    nasdaq_100_ticker = "^NDX"
+    The close of the last session up to 3 days before the date is read from the
+    stored ^NDX history, see benchmark_series.py.
+    '''
+    import benchmark_series
 
-    # Fetch the data using yfinance
     try:
-
-        # Convert string to datetime
-        target_date = pd.to_datetime(date)
-
-        # Download a small range around the target date to ensure we get a trading day
-        index_data = yf.download(nasdaq_100_ticker, start=(target_date - pd.Timedelta(days=3)).strftime("%Y-%m-%d"),
-                                 end=(target_date + pd.Timedelta(days=3)).strftime("%Y-%m-%d"))
-
-        # Find the closest previous trading day
-        if target_date.strftime('%Y-%m-%d') in index_data.index:
-            index_price = index_data.loc[[target_date.strftime('%Y-%m-%d')], ['Close']]
-        else:
-            # Get the previous valid trading day
-            previous_trading_day = index_data.index[index_data.index <= target_date][-1]
-            index_price = index_data.loc[[previous_trading_day], ['Close']]
-        
-        # Set the index to be the date and rename the column to 'Price'
-        index_price.index.name = 'Date'
-        index_price.columns = ['Price']
-        
-        return index_price
+        index_price = benchmark_series.index_levels([date], benchmark_series.BENCHMARKS['nasdaq_100'], max_days_back=3)
+        return index_price.dropna().to_frame()
+    except offline.OfflineError:
+        raise
     except Exception as exc:
         logger.warning("Failed to fetch NASDAQ 100 index for %s: %s", date, exc)
         return pd.DataFrame()
@@ -0,0 +1,240 @@
+'''
+This module contains the parameter sweep of the selection rules.
+
+Every combination of metric weights, top-N and metric subset is evaluated
+against one shared factor panel and one forward-return matrix. The per-metric
+points are computed once, so scoring a batch of configurations is a single
+tensor product, and batches are spread over a process pool that reads the
+shared arrays from shared memory instead of copying them to every worker.
+'''
+
+from __future__ import annotations
+
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+import backtest
+import ranking
+
+# Configurations scored together in one tensor product
+BATCH_SIZE = 16
+
+RESULT_COLUMNS = ['total_return', 'volatility', 'max_drawdown', 'turnover']
+
+
+def metric_points(panel: ranking.FactorPanel, positions: np.ndarray) -> tuple:
+    '''
+    Compute the unweighted points of every ticker for every metric.
+
+    Returns
+    -------
+    tuple
+        (points, ranks): float array (quarter, metric, ticker) of the points
+        ``n - rank`` as in ``ranking.score_panel``, 0 for missing tickers, and
+        integer array (quarter, metric, ticker) of each ticker's rank.
+    '''
+    num_dates, num_metrics, num_tickers = positions.shape
+    ranks = np.empty_like(positions)
+    np.put_along_axis(ranks, positions, np.arange(num_tickers)[None, None, :], axis=-1)
+    num_stocks = panel.present.sum(axis=1)
+    points = (num_stocks[:, None, None] - ranks).astype(np.float64)
+    points[np.broadcast_to(~panel.present[:, None, :], points.shape)] = 0
+    return points, ranks
+
+
+def evaluate_configs(points: np.ndarray, ranks: np.ndarray, present: np.ndarray, forward_returns: np.ndarray,
+                     weights: np.ndarray, top_ns: np.ndarray, first_metrics: np.ndarray,
+                     periods_per_year: int = 4) -> np.ndarray:
+    '''
+    Backtest a batch of selection rules with equal-weighted portfolios.
+
+    Parameters
+    ----------
+    points, ranks : np.ndarray
+        Output of ``metric_points``.
+    present : np.ndarray
+        Boolean (quarter, ticker) mask of the tickers with data.
+    forward_returns : np.ndarray
+        (quarter, ticker) return realized by the stocks selected in each quarter,
+        NaN for quarters that are not backtested.
+    weights : np.ndarray
+        (config, metric) weights, 0 for metrics left out.
+    top_ns : np.ndarray
+        Number of stocks selected by each config.
+    first_metrics : np.ndarray
+        Index of the metric whose ranking breaks score ties in each config.
+
+    Returns
+    -------
+    np.ndarray
+        (config, len(RESULT_COLUMNS)) statistics.
+    '''
+    num_tickers = present.shape[1]
+    scores = np.einsum('cm,qmt->cqt', weights, points)
+    tie_break = np.moveaxis(ranks[:, first_metrics, :], 1, 0)
+    missing = np.broadcast_to(~present, scores.shape)
+    ordered = np.lexsort((tie_break, -scores, missing), axis=-1)
+
+    # Rank of every ticker in the selection order, selected if below top-N
+    selection_rank = np.empty_like(ordered)
+    np.put_along_axis(selection_rank, ordered, np.arange(num_tickers)[None, None, :], axis=-1)
+    num_selected = np.minimum(present.sum(axis=1)[None, :], top_ns[:, None])
+    selected = (selection_rank < num_selected[:, :, None]) & ~missing
+
+    holdings = selected / np.maximum(num_selected, 1)[:, :, None]
+    realized = ~np.isnan(forward_returns).all(axis=1)
+    returns = (holdings * np.nan_to_num(forward_returns)[None]).sum(axis=-1)[:, realized]
+
+    nav = np.cumprod(1 + returns, axis=1)
+    peak = np.maximum.accumulate(np.concatenate([np.ones((len(nav), 1)), nav], axis=1), axis=1)[:, 1:]
+    turnover = np.abs(np.diff(holdings[:, realized], axis=1)).sum(axis=-1) / 2
+
+    stats = np.full((len(weights), len(RESULT_COLUMNS)), np.nan)
+    if returns.shape[1]:
+        stats[:, 0] = nav[:, -1] - 1
+        stats[:, 2] = (1 - nav / peak).max(axis=1)
+    if returns.shape[1] > 1:
+        stats[:, 1] = returns.std(axis=1, ddof=1) * np.sqrt(periods_per_year)
+        stats[:, 3] = turnover.mean(axis=1)
+    return stats
+
+
+_shared = {}
+
+
+def _share(array: np.ndarray) -> tuple:
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def _attach_worker(specs: dict) -> None:
+    for name, (shm_name, shape, dtype) in specs.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _shared[name] = (shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf))
+
+
+def _evaluate_shared(weights: np.ndarray, top_ns: np.ndarray, first_metrics: np.ndarray) -> np.ndarray:
+    arrays = {name: array for name, (_, array) in _shared.items()}
+    return evaluate_configs(arrays['points'], arrays['ranks'], arrays['present'], arrays['forward_returns'],
+                            weights, top_ns, first_metrics)
+
+
+def build_configs(metrics: list, weight_grid: Optional[Mapping] = None, top_ns: Optional[list] = None,
+                  metric_subsets: Optional[list] = None) -> list:
+    '''
+    Expand a parameter grid into a list of selection rules.
+
+    Parameters
+    ----------
+    metrics : list
+        All metrics of the panel.
+    weight_grid : dict, optional
+        metric -> list of weights to try. Metrics not listed keep their
+        ``ranking.METRIC_WEIGHTS`` weight.
+    top_ns : list, optional
+        Numbers of selected stocks to try, ``[ranking.DEFAULT_TOP_N]`` by default.
+    metric_subsets : list of lists, optional
+        Sets of metrics to rank on, all metrics by default.
+
+    Returns
+    -------
+    list
+        One dict per configuration with 'metrics', 'weights' and 'top_n'.
+    '''
+    weight_grid = weight_grid or {}
+    top_ns = top_ns or [ranking.DEFAULT_TOP_N]
+    metric_subsets = metric_subsets or [metrics]
+    grid_metrics = list(weight_grid)
+
+    configs = []
+    for subset, top_n, values in itertools.product(metric_subsets, top_ns,
+                                                   itertools.product(*[weight_grid[m] for m in grid_metrics])):
+        weights = {metric: ranking.METRIC_WEIGHTS.get(metric, 1) for metric in subset}
+        weights.update({metric: value for metric, value in zip(grid_metrics, values) if metric in subset})
+        configs.append({'metrics': list(subset), 'weights': weights, 'top_n': top_n})
+
+    # Different grid values of a metric outside the subset give the same rule
+    unique = {}
+    for config in configs:
+        unique.setdefault((tuple(config['metrics']), tuple(config['weights'].items()), config['top_n']), config)
+    return list(unique.values())
+
+
+def sweep(data: Mapping, weight_grid: Optional[Mapping] = None, top_ns: Optional[list] = None,
+          metric_subsets: Optional[list] = None, forward_returns: Optional[pd.DataFrame] = None,
+          workers: int = 1, batch_size: int = BATCH_SIZE) -> pd.DataFrame:
+    '''
+    Evaluate every combination of selection rules on the same factor data.
+
+    Parameters
+    ----------
+    data : Mapping
+        The ``date -> ticker -> metric`` stock data or a snapshot.
+    weight_grid, top_ns, metric_subsets
+        The parameter grid, see ``build_configs``.
+    forward_returns : pd.DataFrame, optional
+        quarter x ticker returns from ``backtest.forward_return_matrix``,
+        computed from the price store if not given.
+    workers : int, default 1
+        Number of worker processes. 1 evaluates in this process.
+
+    Returns
+    -------
+    pd.DataFrame
+        One row per configuration with its rules and RESULT_COLUMNS, sorted by total return.
+    '''
+    metrics = sorted({metric for subset in (metric_subsets or [ranking.METRICS]) for metric in subset},
+                     key=lambda metric: ranking.METRICS.index(metric) if metric in ranking.METRICS else len(ranking.METRICS))
+    configs = build_configs(metrics, weight_grid, top_ns, metric_subsets)
+
+    panel = ranking.build_panel(data, metrics)
+    panel = panel.subset(sorted(panel.dates, key=backtest.quarter_key))
+    positions = ranking.rank_positions(panel)
+    points, ranks = metric_points(panel, positions)
+
+    # Return realized by the stocks selected in each quarter, held over the next one
+    holding_quarters = [backtest.next_quarter(date) for date in panel.dates]
+    if forward_returns is None:
+        forward_returns = backtest.forward_return_matrix(holding_quarters, panel.tickers)
+    forward_returns = forward_returns.reindex(index=holding_quarters, columns=panel.tickers).to_numpy(dtype=np.float64, copy=True)
+    backtested = np.array([quarter in panel.dates and backtest.quarter_key(quarter)[0] >= backtest.START_YEAR
+                           for quarter in holding_quarters])
+    forward_returns[~backtested] = np.nan
+
+    metric_index = {metric: m for m, metric in enumerate(panel.metrics)}
+    weights = np.zeros((len(configs), len(panel.metrics)))
+    for c, config in enumerate(configs):
+        for metric, weight in config['weights'].items():
+            weights[c, metric_index[metric]] = weight
+    config_top_ns = np.array([config['top_n'] for config in configs])
+    first_metrics = np.array([metric_index[config['metrics'][0]] for config in configs])
+    batches = [slice(i, i + batch_size) for i in range(0, len(configs), batch_size)]
+
+    if workers <= 1:
+        stats = [evaluate_configs(points, ranks, panel.present, forward_returns,
+                                  weights[batch], config_top_ns[batch], first_metrics[batch]) for batch in batches]
+    else:
+        arrays = {'points': points, 'ranks': ranks, 'present': panel.present, 'forward_returns': forward_returns}
+        shared = {name: _share(array) for name, array in arrays.items()}
+        try:
+            specs = {name: spec for name, (_, spec) in shared.items()}
+            with ProcessPoolExecutor(max_workers=workers, initializer=_attach_worker, initargs=(specs,)) as pool:
+                futures = [pool.submit(_evaluate_shared, weights[batch], config_top_ns[batch], first_metrics[batch])
+                           for batch in batches]
+                stats = [future.result() for future in futures]
+        finally:
+            for shm, _ in shared.values():
+                shm.close()
+                shm.unlink()
+
+    results = pd.DataFrame(np.concatenate(stats) if stats else np.empty((0, len(RESULT_COLUMNS))), columns=RESULT_COLUMNS)
+    results.insert(0, 'top_n', config_top_ns)
+    results.insert(0, 'weights', [config['weights'] for config in configs])
+    results.insert(0, 'metrics', [config['metrics'] for config in configs])
+    return results.sort_values('total_return', ascending=False, ignore_index=True)
@@ -0,0 +1,170 @@
+'''
+Run the Alpha Vantage scheduler against a local stub server.
+'''
+
+import json
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+import alpha_vantage
+
+THROTTLE = {'Note': "Thank you for using Alpha Vantage! Our standard API rate limit is 5 requests per minute."}
+DAILY_LIMIT = {'Information': "Our standard API rate limit is 25 requests per day."}
+
+
+class StubServer:
+    '''
+    Answers every (function, symbol) with its scripted responses in turn, then
+    with data. A response is a JSON payload or an HTTP status.
+    '''
+
+    def __init__(self):
+        self.scripts = {}
+        self.calls = Counter()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                params = parse_qs(urlparse(self.path).query)
+                key = (params['function'][0], params['symbol'][0])
+                stub.calls[key] += 1
+                script = stub.scripts.get(key, [])
+                response = script.pop(0) if script else {'symbol': key[1], 'function': key[0]}
+                status = response if isinstance(response, int) else 200
+                body = b'' if isinstance(response, int) else json.dumps(response).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/query"
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.01}, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def stub():
+    server = StubServer()
+    yield server
+    server.close()
+
+
+@pytest.fixture
+def make_scheduler(stub, tmp_path):
+    def make(plan='6000', **kwargs):
+        kwargs.setdefault('backoff', 0.01)
+        return alpha_vantage.Scheduler('demo', stub.url, plan, queue_path=str(tmp_path / 'queue.sqlite'), **kwargs)
+    return make
+
+
+def test_throttled_requests_are_retried(stub, make_scheduler):
+    stub.scripts[('EARNINGS', 'AAA')] = [THROTTLE, 429, 503]
+    payload = make_scheduler().query('EARNINGS', 'AAA')
+    assert payload == {'symbol': 'AAA', 'function': 'EARNINGS'}
+    assert stub.calls[('EARNINGS', 'AAA')] == 4
+
+
+def test_gives_up_after_the_retries(stub, make_scheduler):
+    stub.scripts[('EARNINGS', 'AAA')] = [THROTTLE] * 10
+    with pytest.raises(alpha_vantage.ThrottledError):
+        make_scheduler(max_retries=2).query('EARNINGS', 'AAA')
+    assert stub.calls[('EARNINGS', 'AAA')] == 3
+
+
+def test_error_message(stub, make_scheduler):
+    stub.scripts[('EARNINGS', 'NOPE')] = [{'Error Message': "Invalid API call."}]
+    with pytest.raises(alpha_vantage.AlphaVantageError, match='Invalid API call'):
+        make_scheduler().query('EARNINGS', 'NOPE')
+
+
+def test_requests_are_paced(stub, make_scheduler):
+    scheduler = make_scheduler(plan='600')
+    scheduler.bucket = alpha_vantage.TokenBucket(600, capacity=1)
+    start = time.monotonic()
+    for symbol in ['A', 'B', 'C', 'D']:
+        scheduler.query('EARNINGS', symbol)
+    # The first request takes the only token, the next three wait 0.1s each
+    assert time.monotonic() - start >= 0.3
+
+
+def test_daily_quota(stub, make_scheduler):
+    scheduler = make_scheduler(plan='free')
+    scheduler.bucket = alpha_vantage.TokenBucket(6000)
+    scheduler.per_day = 2
+    scheduler.query('EARNINGS', 'A')
+    scheduler.query('EARNINGS', 'B')
+    with pytest.raises(alpha_vantage.QuotaExceededError):
+        scheduler.query('EARNINGS', 'C')
+    assert stub.calls[('EARNINGS', 'C')] == 0
+    assert scheduler.requests_today() == 2
+
+
+def test_daily_limit_response_is_not_retried(stub, make_scheduler):
+    stub.scripts[('EARNINGS', 'A')] = [DAILY_LIMIT]
+    with pytest.raises(alpha_vantage.QuotaExceededError):
+        make_scheduler().query('EARNINGS', 'A')
+    assert stub.calls[('EARNINGS', 'A')] == 1
+
+
+REQUESTS = [(function, symbol) for symbol in ['A', 'B'] for function in ['EARNINGS', 'INCOME_STATEMENT']]
+
+
+def interrupt_batch(scheduler, answered: int):
+    with pytest.raises(KeyboardInterrupt):
+        with scheduler.batch(REQUESTS):
+            for function, symbol in REQUESTS[:answered]:
+                scheduler.query(function, symbol)
+            raise KeyboardInterrupt
+
+
+def test_interrupted_batch_resumes(stub, make_scheduler):
+    interrupt_batch(make_scheduler(), 3)
+
+    scheduler = make_scheduler()
+    batch = scheduler.batch_id(REQUESTS)
+    assert scheduler.pending(batch) == [REQUESTS[3]]
+    with scheduler.batch(REQUESTS):
+        for function, symbol in REQUESTS:
+            scheduler.query(function, symbol)
+    assert all(stub.calls[request] == 1 for request in REQUESTS)
+    assert scheduler.pending(batch) == []
+
+    # Once the batch is done its responses are dropped
+    with scheduler.batch(REQUESTS):
+        scheduler.query(*REQUESTS[0])
+    assert stub.calls[REQUESTS[0]] == 2
+
+
+def test_kept_responses_belong_to_their_batch(stub, make_scheduler):
+    interrupt_batch(make_scheduler(), 2)
+
+    scheduler = make_scheduler()
+    scheduler.query(*REQUESTS[0])
+    with scheduler.batch(REQUESTS[:2]):
+        scheduler.query(*REQUESTS[1])
+    assert stub.calls[REQUESTS[0]] == 2
+    assert stub.calls[REQUESTS[1]] == 2
+
+
+def test_kept_responses_expire(stub, make_scheduler):
+    interrupt_batch(make_scheduler(), 2)
+    time.sleep(0.01)
+
+    scheduler = make_scheduler(resume_seconds=0.005)
+    with scheduler.batch(REQUESTS):
+        scheduler.query(*REQUESTS[0])
+    assert stub.calls[REQUESTS[0]] == 2
@@ -0,0 +1,89 @@
+'''
+Check the default backtest output of PrimeModel and the command line on a synthetic market.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backtest
+import benchmark_series
+import cli
+import data_model
+import price_store
+import stock_utils
+from benchmarks import synthetic
+from main import PrimeModel, read_selected_stocks
+
+
+@pytest.fixture
+def model(tmp_path):
+    market = synthetic.SyntheticMarket(8, 16)
+    with synthetic.install(market, str(tmp_path)):
+        data_model.compose_stock_data_by_date(tickers=market.tickers)
+        yield PrimeModel(data_model.load_stock_data())
+
+
+def test_default_backtest_is_an_equally_weighted_portfolio(model):
+    selected = model.select_stocks()
+    result = model.backtest(selected)
+    expected = backtest.portfolio_returns(selected, backtest.allocate(selected, 'equal'))
+    pd.testing.assert_frame_equal(result, expected)
+    np.testing.assert_allclose(result['nav'], (1 + result['return']).cumprod())
+    assert model.calculate_portfolio_return(selected) == result['return'].to_dict()
+
+
+def test_summed_backtest_is_the_legacy_output(model):
+    selected = model.select_stocks()
+    summed = model.backtest(selected, summed=True)
+    assert list(summed.columns) == ['return']
+    pd.testing.assert_frame_equal(summed, backtest.portfolio_returns(selected))
+    # The weights are ignored with summed=True
+    pd.testing.assert_frame_equal(model.backtest(selected, backtest.allocate(selected, 'equal'), summed=True), summed)
+
+
+def test_cli_backtest_prints_the_nav(model, capsys):
+    assert cli.main(['backtest']) == 0
+    assert 'nav' in capsys.readouterr().out.splitlines()[0]
+    assert cli.main(['backtest', '--summed']) == 0
+    assert 'nav' not in capsys.readouterr().out.splitlines()[0]
+    assert cli.main(['backtest', '--walk-forward']) == 0
+    assert all(' nav ' in line for line in capsys.readouterr().out.splitlines())
+
+
+def test_relative_performance_needs_a_nav(model):
+    selected = model.select_stocks()
+    performance = model.relative_performance(model.backtest(selected))
+    assert list(performance.columns) == benchmark_series.PERFORMANCE_COLUMNS
+    assert np.isclose(performance['total_return'].iloc[0], model.backtest(selected)['nav'].iloc[-1] - 1)
+    with pytest.raises(ValueError, match='nav'):
+        model.relative_performance(model.backtest(selected, summed=True))
+
+
+def test_refresh_reselects_the_changed_quarters(model, capsys, monkeypatch):
+    assert cli.main(['select']) == 0
+    before = read_selected_stocks('selected_stocks.csv')
+
+    # The market reports four more quarters
+    market = synthetic.SyntheticMarket(8, 20)
+    stock_utils.alpha_vantage_query = market.alpha_vantage_query
+    price_store.download_history = market.history
+    reselected = []
+    select_stocks = PrimeModel.select_stocks
+
+    def record(self, top_n=3, quarters=None):
+        reselected.append(quarters)
+        return select_stocks(self, top_n, quarters)
+    monkeypatch.setattr(PrimeModel, 'select_stocks', record)
+    assert cli.main(['refresh']) == 0
+    monkeypatch.undo()
+    output = capsys.readouterr().out
+    assert 'Updated selected_stocks.csv' in output
+
+    changed = reselected[0]
+    assert len(changed) > 0 and reselected == [changed]
+    after = read_selected_stocks('selected_stocks.csv')
+    expected = PrimeModel(data_model.load_stock_data()).select_stocks()
+    assert after == {date: stocks for date, stocks in expected.items() if date in after}
+    assert set(after) - set(before) <= set(changed)
+    assert all(after[date] == before[date] for date in before if date not in changed)
@@ -0,0 +1,113 @@
+'''
+Check the expiry, eviction and upgrade of the SQLite cache store.
+'''
+
+import os
+import sqlite3
+
+import pandas as pd
+import pytest
+
+import cache_store
+import stock_utils
+from benchmarks import synthetic
+
+
+class Clock:
+    def __init__(self, now: float = 1_000_000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache_store.time, 'time', clock)
+    return clock
+
+
+def frame(n: int) -> pd.DataFrame:
+    return pd.DataFrame({'date': pd.date_range('2020-01-31', periods=n, freq='ME').strftime('%Y-%m-%d'),
+                         'value': range(n)})
+
+
+def test_entries_expire_after_the_ttl(tmp_path, clock):
+    store = cache_store.CacheStore(str(tmp_path / 'cache.sqlite'))
+    store.set_ttl('eps', 100)
+    store.put_frame('eps', 'A', frame(3))
+    store.put_blob('other', 'A', b'payload')
+    # The first read parses the frame into the in-process LRU
+    pd.testing.assert_frame_equal(store.get_frame('eps', 'A'), frame(3))
+    assert not store.is_stale('eps', 'A')
+
+    clock.now += 101
+    assert store.is_stale('eps', 'A')
+    assert store.get_frame('eps', 'A') is None
+    assert store.get_blob('eps', 'A') is None
+    pd.testing.assert_frame_equal(store.get_frame('eps', 'A', include_stale=True), frame(3))
+    # Datasets without a TTL never expire
+    assert store.get_blob('other', 'A') == b'payload'
+
+    # Writing the entry again makes it fresh
+    store.put_frame('eps', 'A', frame(4))
+    pd.testing.assert_frame_equal(store.get_frame('eps', 'A'), frame(4))
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path, clock):
+    store = cache_store.CacheStore(str(tmp_path / 'cache.sqlite'), max_bytes=10_000)
+    for i in range(8):
+        clock.now += 1
+        store.put_blob('data', f"k{i}", bytes(1000))
+    clock.now += 1
+    store.get_blob('data', 'k0')  # k0 is now the most recently used
+
+    clock.now += 1
+    store.put_blob('data', 'k8', bytes(2500))
+    assert store.total_bytes() <= 10_000 * cache_store.EVICTION_TARGET
+    remaining = store.get_blobs('data', [f"k{i}" for i in range(9)])
+    # 10500 bytes are shrunk to at most 9000 by evicting the two oldest entries
+    assert set(remaining) == {'k0', 'k3', 'k4', 'k5', 'k6', 'k7', 'k8'}
+
+
+def test_upgrade_runs_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs(cache_store.CACHE_DIR)
+    with sqlite3.connect(cache_store.DB_FILE) as conn:
+        # A store of the previous version, without TTLs and with a retired dataset
+        conn.execute("CREATE TABLE entries (dataset TEXT NOT NULL, key TEXT NOT NULL, payload BLOB NOT NULL, "
+                     "size INTEGER NOT NULL, created_at REAL NOT NULL, accessed_at REAL NOT NULL, "
+                     "PRIMARY KEY (dataset, key))")
+        conn.execute("INSERT INTO entries VALUES ('pe_ratio', 'A', x'00', 1, 0, 0)")
+    monkeypatch.setattr(cache_store, '_default_store', None)
+
+    store = cache_store.default_store()
+    assert store.get_blob('pe_ratio', 'A') is None
+    assert store.ttl('eps') == cache_store.REPORT_TTL
+    assert store.ttl('income_statement') == cache_store.REPORT_TTL
+
+    store.set_ttl('eps', None)
+    store.put_blob('pe_ratio', 'B', b'kept')
+    assert not store.upgrade()
+    monkeypatch.setattr(cache_store, '_default_store', None)
+    store = cache_store.default_store()
+    assert store.get_blob('pe_ratio', 'B') == b'kept'
+    assert store.ttl('eps') is None
+
+
+def test_expired_reports_are_fetched_again(tmp_path, clock):
+    market = synthetic.SyntheticMarket(2, 8)
+    with synthetic.install(market, str(tmp_path)):
+        cache = cache_store.default_store()
+        cache.put_frame('eps', 'T0000', frame(2))
+        assert len(stock_utils.get_stock_eps('T0000')) == 2
+
+        clock.now += cache_store.REPORT_TTL + 1
+        assert len(stock_utils.get_stock_eps('T0000')) == 8
+
+        # An expired entry that cannot be fetched again is still used
+        clock.now += cache_store.REPORT_TTL + 1
+        stock_utils.alpha_vantage_query = lambda function, symbol: 1 / 0
+        assert len(stock_utils.get_stock_eps('T0000')) == 8
+        assert stock_utils.get_stock_eps('T0001').empty
@@ -0,0 +1,126 @@
+'''
+Check the vectorized daily NAV against a day-by-day simulation of the holdings.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import daily_backtest
+
+TICKERS = ['A', 'B', 'C', 'D', 'E']
+
+SELECTED = {
+    '2014_q1': ['A', 'B', 'C'],
+    '2014_q2': ['B', 'D', 'E'],  # E is listed after this selection is traded
+    '2014_q3': [],  # held in cash
+    '2014_q4': ['A', 'E'],
+    '2015_q1': ['C', 'D'],
+    '2015_q2': ['A', 'B', 'D'],
+}
+
+WEIGHTS = {
+    '2014_q1': {'A': 0.5, 'B': 0.3, 'C': 0.2},
+    '2014_q2': {'B': 0.2, 'D': 0.3, 'E': 0.3},  # 0.2 left in cash
+    '2014_q4': {'A': 0.7, 'E': 0.3},
+    '2015_q1': {'C': 0.4, 'D': 0.6},
+    '2015_q2': {'A': 0.2, 'B': 0.2, 'D': 0.6},
+}
+
+REBALANCE = {
+    '2014_q1': pd.Timestamp('2014-01-06'),
+    '2014_q2': pd.Timestamp('2014-03-03'),
+    '2014_q3': pd.Timestamp('2014-05-10'),  # a Saturday
+    '2014_q4': pd.Timestamp('2014-07-01'),
+    '2015_q1': pd.Timestamp('2014-08-30'),  # a Saturday, collapses with the next one on Monday
+    '2015_q2': pd.Timestamp('2014-09-01'),
+}
+
+END = pd.Timestamp('2014-11-14')
+
+
+def make_prices(seed: int = 0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range('2013-12-02', '2014-12-31', name='date')
+    close = 20 * np.exp(np.cumsum(rng.normal(0.0005, 0.02, (len(dates), len(TICKERS))), axis=0))
+    prices = pd.DataFrame(close, index=dates, columns=TICKERS)
+    prices.loc[:'2014-04-15', 'E'] = np.nan
+    return prices
+
+
+def reference_nav(selected, prices, weights, rebalance, cost_model, end) -> pd.DataFrame:
+    # Hold shares day by day: rebalance at the close of the first session on or after each date, the last one wins
+    dates = prices.index
+    log_close = np.log(prices[TICKERS].to_numpy())
+    trades = {}
+    for quarter in sorted(rebalance):
+        row = int(np.searchsorted(dates.values, np.datetime64(rebalance[quarter])))
+        trades[row] = quarter
+    first = min(trades)
+
+    shares = np.zeros(len(TICKERS))
+    idle = np.zeros(len(TICKERS))  # weight of tickers bought without a price, kept at their value
+    cash = 1.0
+    records = []
+    for row in range(first, len(dates)):
+        if dates[row] > end:
+            break
+        close = prices.iloc[row].to_numpy()
+        values = np.where(np.isnan(close), 0, shares * np.nan_to_num(close)) + idle
+        nav = values.sum() + cash
+        turnover = cost = 0.0
+        if row in trades:
+            quarter = trades[row]
+            stocks = selected.get(quarter, [])
+            quarter_weights = (weights or {}).get(quarter)
+            target = np.zeros(len(TICKERS))
+            for ticker in stocks:
+                target[TICKERS.index(ticker)] = 1 / len(stocks) if quarter_weights is None else quarter_weights[ticker]
+            traded = np.abs(target - values / nav)
+            turnover = traded.sum()
+            if cost_model is not None:
+                volatility = np.array([np.nanstd(np.diff(log_close[max(row - 20, 0):row + 1, t]), ddof=1)
+                                       if np.isfinite(log_close[max(row - 20, 0):row + 1, t]).sum() > 2 else np.nan
+                                       for t in range(len(TICKERS))])
+                cost = float(cost_model(traded[None], volatility[None])[0])
+            nav *= 1 - cost
+            priced = np.isfinite(close)
+            shares = np.where(priced, nav * target / np.where(priced, close, 1), 0)
+            idle = np.where(priced, 0, nav * target)
+            cash = nav * (1 - target.sum())
+        records.append((dates[row], nav, turnover, cost))
+
+    result = pd.DataFrame(records, columns=['date', 'nav', 'turnover', 'cost']).set_index('date')
+    result['return'] = result['nav'].pct_change().fillna(result['nav'].iloc[0] - 1)
+    return result
+
+
+@pytest.mark.parametrize('weights', [None, WEIGHTS])
+@pytest.mark.parametrize('cost_model', [None, daily_backtest.proportional_costs(5, 10)])
+def test_daily_nav_matches_a_day_by_day_loop(weights, cost_model):
+    prices = make_prices()
+    result = daily_backtest.daily_nav(SELECTED, prices, weights, REBALANCE, cost_model, start_year=2014, end=END)
+    expected = reference_nav(SELECTED, prices, weights, REBALANCE, cost_model, END)
+
+    assert list(result.index) == list(expected.index)
+    for column in ('nav', 'return', 'turnover', 'cost'):
+        np.testing.assert_allclose(result[column].to_numpy(), expected[column].to_numpy(), rtol=1e-10, atol=1e-12)
+    np.testing.assert_allclose(result['drawdown'].to_numpy(), 1 - expected['nav'] / expected['nav'].cummax(),
+                               atol=1e-12)
+    if cost_model is not None:
+        assert (result['cost'] > 0).sum() == 5  # six rebalances, two on the same session
+
+
+def test_volatility_slippage_matches_a_day_by_day_loop():
+    prices = make_prices(1)
+    cost_model = daily_backtest.volatility_slippage(0.2, 3)
+    result = daily_backtest.daily_nav(SELECTED, prices, WEIGHTS, REBALANCE, cost_model, start_year=2014, end=END)
+    expected = reference_nav(SELECTED, prices, WEIGHTS, REBALANCE, cost_model, END)
+    np.testing.assert_allclose(result['nav'].to_numpy(), expected['nav'].to_numpy(), rtol=1e-10)
+    np.testing.assert_allclose(result['cost'].to_numpy(), expected['cost'].to_numpy(), rtol=1e-10, atol=1e-12)
+
+
+def test_empty_selection():
+    result = daily_backtest.daily_nav({}, make_prices())
+    assert result.empty
+    assert list(result.columns) == ['nav', 'return', 'drawdown', 'turnover', 'cost']
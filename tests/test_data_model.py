@@ -0,0 +1,92 @@
+'''
+Build the stock data of a synthetic market serially and on worker pools.
+'''
+
+import os
+import re
+
+import pandas as pd
+import pytest
+
+import data_model
+from benchmarks import synthetic
+
+FAILING = 'T0003'
+
+
+class FailingMarket(synthetic.SyntheticMarket):
+    '''A market whose price history download fails for one ticker.'''
+
+    def history(self, ticker: str, start=None) -> pd.DataFrame:
+        if ticker == FAILING:
+            raise RuntimeError(f"No price history for {ticker}")
+        return super().history(ticker, start)
+
+
+def build(market, directory, workers=1, executor='thread') -> pd.DataFrame:
+    # Every build starts from empty caches in its own directory
+    with synthetic.install(market, str(directory)):
+        return data_model.assemble_stock_data(market.tickers, workers, executor)
+
+
+@pytest.mark.parametrize('workers, executor', [(4, 'thread'), (3, 'process')])
+def test_pools_match_the_serial_build(tmp_path, workers, executor):
+    market = synthetic.SyntheticMarket(8, 12)
+    serial = build(market, tmp_path / 'serial')
+    parallel = build(market, tmp_path / 'parallel', workers, executor)
+    assert not serial.empty
+    assert list(serial['ticker'].unique()) == market.tickers
+    pd.testing.assert_frame_equal(parallel, serial)
+
+
+@pytest.mark.parametrize('workers, executor', [(1, 'thread'), (4, 'thread'), (3, 'process')])
+def test_a_failing_ticker_is_left_out(tmp_path, workers, executor):
+    market = FailingMarket(8, 12)
+    frame = build(market, tmp_path / 'failing', workers, executor)
+    expected = build(synthetic.SyntheticMarket(8, 12), tmp_path / 'complete')
+    assert list(frame['ticker'].unique()) == [ticker for ticker in market.tickers if ticker != FAILING]
+    pd.testing.assert_frame_equal(frame, expected[expected['ticker'] != FAILING].reset_index(drop=True))
+
+
+def test_unknown_executor(tmp_path):
+    with pytest.raises(ValueError):
+        build(synthetic.SyntheticMarket(2, 4), tmp_path, 2, 'fiber')
+
+
+def build_partitions(market, directory, tickers, shards, resume=False) -> tuple:
+    # Partition files of the build and the inode of every file, which changes when it is written again
+    with synthetic.install(market, str(directory)):
+        paths = data_model.build_partitions(tickers, shards, 'partitions', resume=resume)
+        frame = data_model.merge_partitions(paths)
+        files = {name: os.stat(os.path.join('partitions', name)).st_ino for name in os.listdir('partitions')}
+    return [os.path.basename(path) for path in paths], files, frame
+
+
+def test_partitions_match_the_serial_build(tmp_path):
+    market = synthetic.SyntheticMarket(7, 12)
+    names, files, frame = build_partitions(market, tmp_path, market.tickers, 3)
+    assert [name[:len('part-00000-of-00003-')] for name in names] == [f"part-{shard:05d}-of-00003-" for shard in range(3)]
+    assert all(re.fullmatch(r'part-\d{5}-of-\d{5}-[0-9a-f]{16}\.csv', name) for name in names)
+    assert sorted(files) == sorted(names)
+    pd.testing.assert_frame_equal(frame, build(market, tmp_path / 'serial'), check_dtype=False)
+
+
+def test_resume_keeps_only_the_partitions_of_the_same_tickers(tmp_path):
+    market = synthetic.SyntheticMarket(6, 8)
+    names, files, _ = build_partitions(market, tmp_path, market.tickers[:4], 2)
+
+    # The same tickers: nothing is built again
+    resumed, resumed_files, _ = build_partitions(market, tmp_path, market.tickers[:4], 2, resume=True)
+    assert resumed == names and resumed_files == files
+
+    # The second shard changed: it gets another name, is built again and the old file is removed
+    tickers = market.tickers[:3] + [market.tickers[5]]
+    changed, changed_files, frame = build_partitions(market, tmp_path, tickers, 2, resume=True)
+    assert changed[0] == names[0] and changed_files[names[0]] == files[names[0]]
+    assert changed[1] != names[1] and sorted(changed_files) == sorted(changed)
+    assert list(frame['ticker'].unique()) == tickers
+
+    # Another number of shards never reuses a partition
+    _, reshard_files, frame = build_partitions(market, tmp_path, tickers, 3, resume=True)
+    assert len(reshard_files) == 3 and not set(reshard_files) & set(changed_files)
+    assert list(frame['ticker'].unique()) == tickers
@@ -0,0 +1,51 @@
+'''
+Check the previous close of tickers that did not trade on the calendar's session.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import factors
+import price_store
+import trading_calendar
+
+SESSIONS = ['2024-01-02', '2024-01-03', '2024-01-04', '2024-01-05', '2024-01-08']
+
+
+def make_series(ticker: str, dates: list) -> price_store.PriceSeries:
+    closes = np.arange(1, len(dates) + 1, dtype=np.float64)
+    values = np.column_stack([closes, closes, closes, closes, np.ones(len(dates))])
+    return price_store.PriceSeries(ticker, np.array(dates, dtype='datetime64[D]'), values)
+
+
+@pytest.fixture(autouse=True)
+def calendar(monkeypatch):
+    monkeypatch.setattr(price_store, 'load_prices', lambda ticker, until=None: make_series(ticker, SESSIONS))
+    monkeypatch.setattr(trading_calendar, '_calendar', None)
+    monkeypatch.setattr(trading_calendar, '_calendar_until', None)
+
+
+def previous_close(series: price_store.PriceSeries, dates: list) -> np.ndarray:
+    rows = pd.DataFrame({'date': pd.to_datetime(dates)})
+    return factors.FactorInputs({series.ticker: {'rows': rows, 'prices': series}}).previous_close(max_days_back=3)
+
+
+def test_trading_ticker_gets_the_session_close():
+    series = make_series('A', SESSIONS)
+    # Saturday and Sunday take Friday's close
+    np.testing.assert_array_equal(previous_close(series, ['2024-01-03', '2024-01-06', '2024-01-07', '2024-01-08']),
+                                  [2, 4, 4, 5])
+
+
+def test_halted_ticker_falls_back_to_its_own_last_close():
+    # Halted on 2024-01-04 and 2024-01-05
+    series = make_series('B', ['2024-01-02', '2024-01-03', '2024-01-08'])
+    np.testing.assert_array_equal(previous_close(series, ['2024-01-04', '2024-01-05', '2024-01-06', '2024-01-08']),
+                                  [2, 2, 2, 3])
+
+
+def test_fallback_is_bounded_by_max_days_back():
+    series = make_series('C', ['2024-01-02'])
+    closes = previous_close(series, ['2024-01-01', '2024-01-05', '2024-01-06'])
+    assert np.isnan(closes[0]) and closes[1] == 1 and np.isnan(closes[2])
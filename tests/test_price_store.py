@@ -0,0 +1,78 @@
+'''
+Check the vectorized price store lookups against the per-call computations they replaced.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import price_store
+
+
+def make_series(seed: int = 0) -> price_store.PriceSeries:
+    rng = np.random.default_rng(seed)
+    sessions = pd.bdate_range('2018-01-02', '2020-12-31')
+    # A halt of a few weeks, so some windows end on days without a session
+    sessions = sessions[(sessions < '2019-05-06') | (sessions > '2019-05-31')]
+    close = 30 * np.exp(np.cumsum(rng.normal(0.0004, 0.02, len(sessions))))
+    values = np.column_stack([close, close * 1.01, close * 0.99, close, np.full(len(sessions), 1e6)])
+    return price_store.PriceSeries('T', sessions.values.astype('datetime64[D]'), values)
+
+
+def reference_return(series: price_store.PriceSeries, as_of, days: int) -> float:
+    # The per-call path: compound the daily returns of the closes in [as_of - days, as_of)
+    window = series.window(pd.Timestamp(as_of) - pd.Timedelta(days=days), as_of)
+    if window.empty:
+        return np.nan
+    return (1 + window['Close'].pct_change()).prod() - 1
+
+
+AS_OF_DATES = [
+    '2017-06-30',  # before the first price
+    '2018-01-02',  # on the first price, the window ends before it
+    '2018-01-03',  # one close in the window
+    '2018-03-31',  # a Saturday
+    '2018-04-01',  # a Sunday
+    '2019-05-20',  # during the halt
+    '2019-06-03',
+    '2019-07-04',  # a holiday in the real calendar, a session here
+    '2020-12-31',  # on the last price, excluded
+    '2021-01-15',  # after the last price
+]
+
+
+@pytest.mark.parametrize('seed', [0, 1])
+def test_trailing_returns_match_the_per_call_path(seed):
+    series = make_series(seed)
+    windows = [1, 7, 30, 91, 365]
+    rng = np.random.default_rng(seed)
+    as_of_dates = AS_OF_DATES + list(pd.Timestamp('2018-01-01') + pd.to_timedelta(rng.integers(0, 1200, 40), 'D'))
+    result = price_store.trailing_returns(series, as_of_dates, windows)
+    expected = np.array([[reference_return(series, date, days) for days in windows] for date in as_of_dates])
+    assert result.shape == (len(as_of_dates), len(windows))
+    np.testing.assert_allclose(result, expected, rtol=1e-12, atol=1e-14)
+    assert np.isnan(result[0]).all()
+    assert np.isnan(result[1]).all()
+    assert (result[2] == 0).all()
+
+
+def test_trailing_volatility_matches_the_sample_deviation():
+    series = make_series()
+    as_of_dates = ['2018-01-03', '2018-03-31', '2019-05-20', '2019-06-15', '2020-12-31']
+    result = price_store.trailing_volatility(series, as_of_dates, 60)
+    for value, as_of in zip(result, as_of_dates):
+        # The daily returns between the closes of the window
+        closes = series.window(pd.Timestamp(as_of) - pd.Timedelta(days=60), as_of)['Close']
+        returns = np.diff(np.log(closes.to_numpy()))
+        if len(returns) < 2:
+            assert np.isnan(value)
+        else:
+            assert np.isclose(value, np.std(returns, ddof=1), rtol=1e-9)
+
+
+def test_close_on_sessions_only():
+    series = make_series()
+    prices = series.close_on(['2017-12-29', '2018-01-02', '2018-03-31', '2020-12-31', '2021-01-04'])
+    assert np.isnan(prices[[0, 2, 4]]).all()
+    assert prices[1] == series.close[0]
+    assert prices[3] == series.close[-1]
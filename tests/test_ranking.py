@@ -0,0 +1,119 @@
+'''
+Check the vectorized ranking against the original sorted()-based implementation.
+'''
+
+import random
+
+import numpy as np
+import pytest
+
+import ranking
+import robustness
+from main import PrimeModel
+
+METRICS = ['reportedEPS', 'pe_ratio', 'quarterly_return_six_month', 'quarterly_return_one_year', 'yoy_return']
+
+
+def reference_rank_stocks(data: dict) -> dict:
+    # PrimeModel.rank_stocks before vectorization
+    ranked_stocks_by_date = {}
+    for date in data:
+        ranked_stocks = {}
+        for metric in METRICS:
+            if metric == 'pe_ratio':
+                ranked_stocks[metric] = sorted(data[date].items(), key=lambda item: (item[1][metric] == 0, item[1][metric]))
+            else:
+                ranked_stocks[metric] = sorted(data[date].items(), key=lambda item: item[1][metric], reverse=True)
+        ranked_stocks_by_date[date] = ranked_stocks
+    return ranked_stocks_by_date
+
+
+def reference_select_stocks(data: dict, top_n: int = 3) -> dict:
+    # PrimeModel.select_stocks before vectorization
+    selected_stocks = {}
+    for date, ranked_stocks in reference_rank_stocks(data).items():
+        stock_scores = {}
+        for metric, rankings in ranked_stocks.items():
+            num_stocks = len(rankings)
+            for rank, (ticker, _) in enumerate(rankings, start=1):
+                score = num_stocks - rank + 1
+                if metric in ['pe_ratio', 'yoy_return']:
+                    score /= 2
+                if ticker not in stock_scores:
+                    stock_scores[ticker] = 0
+                stock_scores[ticker] += score
+        top_stocks = sorted(stock_scores.items(), key=lambda item: item[1], reverse=True)[:top_n]
+        selected_stocks[date] = [ticker for ticker, _ in top_stocks]
+    return selected_stocks
+
+
+def make_data(seed: int, num_quarters: int = 12, num_tickers: int = 9) -> dict:
+    # Few distinct values so that ties are common, zero P/E ratios, and tickers missing from some quarters
+    rng = random.Random(seed)
+    tickers = [f"T{i}" for i in range(num_tickers)]
+    data = {}
+    for q in range(num_quarters):
+        members = rng.sample(tickers, rng.randint(1, num_tickers))
+        data[f"{2010 + q // 4}_q{q % 4 + 1}"] = {
+            ticker: {
+                'reportedEPS': rng.choice([-0.5, 0.0, 0.5, 1.0]),
+                'pe_ratio': rng.choice([0.0, 0.0, 8.0, 15.0, 40.0]),
+                'quarterly_return_six_month': rng.choice([-0.1, 0.0, 0.1]),
+                'quarterly_return_one_year': rng.choice([-0.2, 0.2]),
+                'yoy_return': rng.choice([-0.3, 0.0, 0.3]),
+            }
+            for ticker in members
+        }
+    return data
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_rank_stocks_matches_sorted(seed):
+    data = make_data(seed)
+    expected = reference_rank_stocks(data)
+    ranked = PrimeModel(data).rank_stocks()
+    for date in data:
+        for metric in METRICS:
+            assert [ticker for ticker, _ in ranked[date][metric]] == \
+                   [ticker for ticker, _ in expected[date][metric]], (date, metric)
+
+
+@pytest.mark.parametrize('seed', range(20))
+@pytest.mark.parametrize('top_n', [1, 3, 20])
+def test_select_stocks_matches_sorted(seed, top_n):
+    data = make_data(seed)
+    assert ranking.select_stocks(data, top_n=top_n) == reference_select_stocks(data, top_n)
+
+
+def test_ties_keep_source_order():
+    row = {metric: 1.0 for metric in METRICS}
+    data = {'2020_q1': {'B': dict(row), 'A': dict(row), 'C': dict(row)}}
+    assert ranking.select_stocks(data, top_n=3) == {'2020_q1': ['B', 'A', 'C']}
+    assert reference_select_stocks(data) == {'2020_q1': ['B', 'A', 'C']}
+
+
+def test_zero_pe_ratio_ranks_last():
+    base = {'reportedEPS': 1.0, 'quarterly_return_six_month': 0.0, 'quarterly_return_one_year': 0.0, 'yoy_return': 0.0}
+    data = {'2020_q1': {'ZERO': {**base, 'pe_ratio': 0.0},
+                        'HIGH': {**base, 'pe_ratio': 50.0},
+                        'LOW': {**base, 'pe_ratio': 5.0}}}
+    ranked = PrimeModel(data).rank_stocks()['2020_q1']['pe_ratio']
+    assert [ticker for ticker, _ in ranked] == ['LOW', 'HIGH', 'ZERO']
+    assert ranked == reference_rank_stocks(data)['2020_q1']['pe_ratio']
+
+
+@pytest.mark.parametrize('seed', range(20))
+def test_robustness_batch_selection_matches_sorted(seed):
+    data = make_data(seed)
+    panel = ranking.build_panel(data, METRICS)
+    order = robustness.source_order(panel)
+    values = np.take_along_axis(panel.values, order[:, :, None], axis=1)
+    present = np.take_along_axis(panel.present, order, axis=1)
+    ascending = np.array([metric in ranking.ASCENDING_METRICS for metric in METRICS])
+    weights = np.array([ranking.METRIC_WEIGHTS.get(metric, 1) for metric in METRICS], dtype=np.float64)
+    holdings = robustness.select_batch(values[None], present, ascending, weights, 3)[0]
+
+    expected = reference_select_stocks(data)
+    for q, date in enumerate(panel.dates):
+        selected = {panel.tickers[order[q, t]] for t in np.flatnonzero(holdings[q])}
+        assert selected == set(expected[date]), date
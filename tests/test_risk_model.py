@@ -0,0 +1,138 @@
+'''
+Check the rolling covariance and the optimizers of the covariance-based allocation schemes.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backtest
+import price_store
+import risk_model
+
+
+def make_series(seed: int, start='2015-01-01', periods=400, gaps=0) -> price_store.PriceSeries:
+    rng = np.random.default_rng(seed)
+    dates = pd.bdate_range(start, periods=periods).values.astype('datetime64[D]')
+    if gaps:
+        # Drop a few sessions, as for a halted ticker
+        dates = np.delete(dates, rng.choice(len(dates), gaps, replace=False))
+    close = 50 * np.exp(np.cumsum(rng.normal(0.0005, 0.02, len(dates))))
+    values = np.column_stack([close, close, close, close, np.ones(len(dates))])
+    return price_store.PriceSeries(f"T{seed}", dates, values)
+
+
+def full_covariance(series: dict, tickers: list, start, end) -> np.ndarray:
+    # np.cov of every pair of tickers over the days in [start, end) both have a return
+    returns = {}
+    for ticker in tickers:
+        s = series[ticker]
+        dates = np.asarray(s.dates)[1:]
+        keep = (dates >= start) & (dates < end)
+        returns[ticker] = dict(zip(dates[keep], np.diff(np.log(s.close))[keep]))
+    covariance = np.full((len(tickers), len(tickers)), np.nan)
+    for i, a in enumerate(tickers):
+        for j, b in enumerate(tickers):
+            days = sorted(returns[a].keys() & returns[b].keys())
+            if len(days) >= 2:
+                covariance[i, j] = np.cov([returns[a][d] for d in days], [returns[b][d] for d in days])[0, 1]
+    return covariance
+
+
+def test_advance_matches_a_full_recompute():
+    series = {s.ticker: s for s in [make_series(0), make_series(1, gaps=30), make_series(2, start='2015-06-01')]}
+    model = risk_model.RollingCovariance(days=90, loader=series.__getitem__)
+    tickers = list(series)
+    ends = pd.date_range('2015-03-01', '2016-06-01', freq='17D')
+    for k, end in enumerate(ends):
+        model.advance(end)
+        # Track one ticker late, while the window is already placed
+        tracked = tickers[:2] if k < 5 else tickers
+        mean, covariance, observations = model.moments(tracked)
+        start = price_store.to_days(end) - np.timedelta64(90, 'D')
+        expected = full_covariance(series, tracked, start, price_store.to_days(end))
+        np.testing.assert_allclose(covariance, expected, rtol=1e-8, atol=1e-12)
+        for t, ticker in enumerate(tracked):
+            dates = np.asarray(series[ticker].dates)[1:]
+            keep = (dates >= start) & (dates < price_store.to_days(end))
+            assert observations[t] == keep.sum()
+
+
+def test_moving_back_recomputes_the_window():
+    series = {s.ticker: s for s in [make_series(3), make_series(4)]}
+    model = risk_model.RollingCovariance(days=120, loader=series.__getitem__)
+    model.advance('2016-01-01')
+    _, forward, _ = model.moments(list(series))
+    model.advance('2016-03-01')
+    model.advance('2016-01-01')
+    _, back, _ = model.moments(list(series))
+    np.testing.assert_allclose(back, forward)
+
+
+@pytest.mark.parametrize('cap', [1.0, 0.4, 0.25, 0.1])
+def test_project_onto_the_capped_simplex(cap):
+    rng = np.random.default_rng(5)
+    for _ in range(50):
+        weights = rng.normal(0, 1, 10)
+        projected = risk_model._project(weights, cap)
+        assert np.isclose(projected.sum(), 1)
+        assert projected.min() >= 0
+        assert projected.max() <= cap + 1e-12
+    feasible = np.full(10, 0.1)
+    np.testing.assert_allclose(risk_model._project(feasible, cap), feasible)
+
+
+def random_covariance(seed: int, size: int) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    factors = rng.normal(0, 0.01, (size, 2))
+    return factors @ factors.T + np.diag(rng.uniform(1e-4, 4e-4, size))
+
+
+def test_min_variance_matches_the_closed_form():
+    # Nearly uncorrelated names, so the unconstrained minimum is long-only
+    covariance = np.diag([1e-4, 2e-4, 3e-4, 4e-4]) + 1e-5
+    inverse = np.linalg.inv(covariance)
+    expected = inverse.sum(axis=1) / inverse.sum()
+    assert (expected > 0).all()
+    np.testing.assert_allclose(risk_model.min_variance_weights(covariance, max_weight=1.0), expected, atol=1e-6)
+
+
+def test_min_variance_respects_the_cap():
+    covariance = np.diag([1e-4, 4e-4, 4e-4, 4e-4])
+    weights = risk_model.min_variance_weights(covariance, max_weight=0.4)
+    assert np.isclose(weights.sum(), 1)
+    assert np.isclose(weights[0], 0.4)
+    np.testing.assert_allclose(weights[1:], 0.2, atol=1e-6)
+
+
+def test_risk_parity_contributions_are_equal():
+    covariance = random_covariance(6, 6)
+    weights = risk_model.risk_parity_weights(covariance)
+    contributions = weights * (covariance @ weights)
+    assert np.isclose(weights.sum(), 1)
+    assert (weights > 0).all()
+    np.testing.assert_allclose(contributions / contributions.sum(), 1 / 6, rtol=1e-6)
+
+
+def test_shrunk_covariance_is_positive_semidefinite():
+    covariance = random_covariance(7, 8)
+    covariance[0, 1] = covariance[1, 0] = np.nan
+    shrunk = risk_model.shrink_covariance(covariance, 30)
+    np.testing.assert_allclose(shrunk, shrunk.T)
+    assert np.linalg.eigvalsh(shrunk).min() >= -1e-12
+
+
+@pytest.mark.parametrize('scheme', sorted(backtest.COVARIANCE_SCHEMES))
+def test_allocate_covariance_schemes(scheme):
+    series = {s.ticker: s for s in [make_series(seed, start='2012-01-01', periods=1200) for seed in range(5)]}
+    model = risk_model.RollingCovariance(loader=series.__getitem__)
+    selected = {'2014_q1': list(series)[:4], '2014_q2': list(series)[1:], '2014_q3': []}
+    allocation = backtest.allocate(selected, scheme, max_weight=0.5, covariance_model=model)
+    assert allocation['2014_q3'] == {}
+    for date in ('2014_q1', '2014_q2'):
+        weights = np.array(list(allocation[date].values()))
+        assert list(allocation[date]) == selected[date]
+        assert np.isclose(weights.sum(), 1)
+        assert weights.min() >= 0
+        if scheme != 'risk_parity':
+            assert weights.max() <= 0.5 + 1e-9
@@ -0,0 +1,29 @@
+'''
+Check the robustness tests against the backtest of the actual selection.
+'''
+
+import numpy as np
+import pandas as pd
+
+import backtest
+import ranking
+import robustness
+from tests.test_ranking import make_data
+
+
+def test_observed_statistics_match_the_backtest():
+    # Tickers appear in a different order in every quarter, unlike the sorted columns of the return matrix
+    data = {f"{2013 + q // 4}_q{q % 4 + 1}": quarter for q, quarter in enumerate(make_data(3, 12).values())}
+    panel = ranking.build_panel(data)
+    holding_quarters = [backtest.next_quarter(date) for date in panel.dates]
+    rng = np.random.default_rng(0)
+    returns = pd.DataFrame(rng.normal(0.02, 0.1, (len(holding_quarters), len(panel.tickers))),
+                           index=holding_quarters, columns=sorted(panel.tickers))
+
+    observed, samples = robustness.simulate(data, tests=['perturbation'], simulations=4, noise=0.0,
+                                            forward_returns=returns)
+    selected = ranking.select_stocks(data)
+    expected = backtest.portfolio_returns(selected, backtest.allocate(selected, 'equal'), returns)
+    assert np.isclose(observed['total_return'], expected['nav'].iloc[-1] - 1)
+    # Without noise every perturbation selects the same stocks
+    assert np.allclose(samples['perturbation'].to_numpy(), observed.to_numpy()[None])
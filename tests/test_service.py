@@ -0,0 +1,109 @@
+'''
+Run the selection service on a synthetic market.
+'''
+
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+import pytest
+
+import backtest
+import data_model
+import price_store
+import service
+from benchmarks import synthetic
+from main import PrimeModel
+
+CLI = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cli.py')
+
+
+@pytest.fixture
+def market(tmp_path):
+    market = synthetic.SyntheticMarket(8, 16)
+    with synthetic.install(market, str(tmp_path)):
+        data_model.compose_stock_data_by_date(tickers=market.tickers)
+        yield market
+
+
+def unix_get(path: str, url: str) -> tuple:
+    with socket.socket(socket.AF_UNIX) as sock:
+        sock.connect(path)
+        sock.sendall(f"GET {url} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n".encode('ascii'))
+        response = b''
+        while chunk := sock.recv(65536):
+            response += chunk
+    head, body = response.split(b'\r\n\r\n', 1)
+    return int(head.split()[1]), json.loads(body)
+
+
+def test_offline_serve_starts(market, tmp_path):
+    path = str(tmp_path / 'service.sock')
+    process = subprocess.Popen([sys.executable, CLI, '--offline', 'serve', '--socket', path],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        deadline = time.monotonic() + 60
+        while not os.path.exists(path):
+            assert process.poll() is None, process.communicate()[1].decode()
+            assert time.monotonic() < deadline
+            time.sleep(0.05)
+        status, health = unix_get(path, '/health')
+        assert status == 200
+        assert health['tickers'] == len(market.tickers)
+        assert unix_get(path, '/backtest')[0] == 200
+    finally:
+        process.terminate()
+        process.wait(10)
+
+
+def test_queries_never_fetch_prices(market, monkeypatch):
+    selection_service = service.SelectionService()
+    # Later on, the stored histories end before the last return window and are due for a refresh
+    for ticker in market.tickers:
+        series = price_store.load_prices(ticker)
+        end = np.searchsorted(series.dates, np.datetime64('2013-09-01'))
+        price_store._write(ticker, np.asarray(series.dates[:end]), np.asarray(series.values[:end]), series.version)
+        with open(price_store._paths(ticker)[2], 'w') as f:
+            json.dump({'refreshed_at': '2000-01-01'}, f)
+    price_store._series.clear()
+
+    # load_prices logs a failed refresh and goes on, so count them
+    refreshed = []
+    monkeypatch.setattr(price_store, 'refresh_prices', refreshed.append)
+    selected = selection_service.handle('/select', {})
+    assert selected == PrimeModel(data_model.load_stock_data()).select_stocks()
+    for scheme in [None, 'equal', 'inverse_volatility', 'min_variance']:
+        params = {} if scheme is None else {'scheme': scheme}
+        result = selection_service.handle('/backtest', params)
+        assert all(('nav' in row) == (scheme is not None) for row in result.values())
+    assert refreshed == []
+
+
+def test_allocations_are_kept_per_state(market, monkeypatch):
+    selection_service = service.SelectionService()
+    calls = []
+    allocate = backtest.allocate
+
+    def record(selected_stocks, scheme='equal', *args, **kwargs):
+        calls.append(scheme)
+        return allocate(selected_stocks, scheme, *args, **kwargs)
+    monkeypatch.setattr(backtest, 'allocate', record)
+
+    first = selection_service.handle('/backtest', {'scheme': 'min_variance'})
+    later = selection_service.handle('/backtest', {'scheme': 'min_variance', 'start_year': 2014})
+    assert calls == ['min_variance']
+    assert later == {quarter: row for quarter, row in first.items() if quarter >= '2014'}
+    selection_service.handle('/backtest', {'scheme': 'min_variance', 'top_n': 2})
+    selection_service.handle('/backtest', {'scheme': 'inverse_volatility', 'start_year': 2014})
+    selection_service.handle('/backtest', {'scheme': 'inverse_volatility'})
+    assert calls == ['min_variance', 'min_variance', 'inverse_volatility']
+    assert selection_service.handle('/health', {})['allocations'] == 3
+
+    # A new state starts without them
+    assert selection_service.reload(force=True)
+    assert selection_service.handle('/backtest', {'scheme': 'min_variance'}) == first
+    assert calls == ['min_variance', 'min_variance', 'inverse_volatility', 'min_variance']
@@ -0,0 +1,84 @@
+'''
+Check the snapshot round trip through JSON, its panel fast path and the atomic rewrite.
+'''
+
+import json
+import os
+
+import numpy as np
+import pytest
+
+import ranking
+import snapshot
+from tests.test_ranking import make_data
+
+
+@pytest.fixture
+def data(tmp_path):
+    data = make_data(0, 16)
+    with open(tmp_path / 'stock_data_by_date.json', 'w') as f:
+        json.dump(data, f, indent=4)
+    return data
+
+
+def test_json_round_trip(tmp_path, data):
+    json_path = str(tmp_path / 'stock_data_by_date.json')
+    path = str(tmp_path / snapshot.SNAPSHOT_DIR)
+    assert snapshot.import_json(json_path, path).to_dict() == data
+
+    exported = str(tmp_path / 'exported.json')
+    snapshot.export_json(path, exported)
+    with open(exported) as f:
+        assert json.load(f) == data
+    # Quarters and the tickers within every quarter keep their order
+    with open(exported) as f, open(json_path) as g:
+        assert f.read() == g.read()
+
+
+def canonical(panel: ranking.FactorPanel, metrics: list) -> dict:
+    # Present tickers of every quarter in their stored order, with their metric values
+    columns = [panel.metrics.index(metric) for metric in metrics]
+    return {date: [(panel.tickers[t], *panel.values[q, t, columns].tolist())
+                   for t in sorted(np.flatnonzero(panel.present[q]), key=lambda t: panel.order[q, t])]
+            for q, date in enumerate(panel.dates)}
+
+
+@pytest.mark.parametrize('metrics, quarters', [
+    (None, None),
+    (['pe_ratio', 'reportedEPS'], None),
+    (None, ['2013_q4', '2010_q2', '2011_q1']),
+])
+def test_to_panel_matches_build_panel(tmp_path, data, metrics, quarters):
+    path = str(tmp_path / snapshot.SNAPSHOT_DIR)
+    snapshot.write_snapshot(data, path)
+    panel = snapshot.Snapshot(path).to_panel(metrics, quarters)
+    expected = ranking.build_panel(data, metrics or ranking.METRICS, quarters)
+    assert panel.dates == expected.dates
+    assert canonical(panel, expected.metrics) == canonical(expected, expected.metrics)
+    assert ranking.select_stocks(panel) == ranking.select_stocks(expected)
+
+def test_rewrite_replaces_the_snapshot_atomically(tmp_path, data, monkeypatch):
+    path = str(tmp_path / snapshot.SNAPSHOT_DIR)
+    snapshot.write_snapshot(data, path)
+    reader = snapshot.Snapshot(path)
+
+    newer = make_data(1, 16)
+    snapshot.write_snapshot(newer, path)
+    # No temporary or replaced directory is left behind
+    assert sorted(os.listdir(tmp_path)) == sorted([snapshot.SNAPSHOT_DIR, 'stock_data_by_date.json'])
+    assert snapshot.Snapshot(path).to_dict() == newer
+    # A reader opened before the rewrite still sees the old arrays
+    assert reader.to_dict() == data
+
+    # A write that fails halfway leaves the current snapshot in place
+    save = np.save
+
+    def failing_save(file, array):
+        if file.endswith('pe_ratio.npy'):
+            raise OSError('disk full')
+        save(file, array)
+    monkeypatch.setattr(snapshot.np, 'save', failing_save)
+    with pytest.raises(OSError):
+        snapshot.write_snapshot(make_data(2, 16), path)
+    monkeypatch.undo()
+    assert snapshot.Snapshot(path).to_dict() == newer
@@ -0,0 +1,56 @@
+'''
+Check the batched sweep evaluation against the selection and backtest of every single configuration.
+'''
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import backtest
+import ranking
+import sweep
+from tests.test_ranking import make_data
+
+WEIGHT_GRID = {'pe_ratio': [0.0, 0.5, 2.0], 'yoy_return': [0.5, 1.0]}
+TOP_NS = [1, 3, 5]
+METRIC_SUBSETS = [ranking.METRICS, ['quarterly_return_one_year', 'reportedEPS', 'pe_ratio']]
+
+
+def make_inputs(seed: int) -> tuple:
+    data = {f"{2012 + q // 4}_q{q % 4 + 1}": quarter for q, quarter in enumerate(make_data(seed, 16).values())}
+    tickers = sorted({ticker for stocks in data.values() for ticker in stocks})
+    holding_quarters = [backtest.next_quarter(date) for date in data]
+    rng = np.random.default_rng(seed)
+    returns = pd.DataFrame(rng.normal(0.02, 0.1, (len(holding_quarters), len(tickers))),
+                           index=holding_quarters, columns=tickers)
+    return data, returns
+
+
+def expected_statistics(data: dict, returns: pd.DataFrame, config: dict) -> list:
+    # The selection and equal-weighted backtest of one configuration, one quarter at a time
+    selected = ranking.select_stocks(data, config['top_n'], config['metrics'], config['weights'])
+    weights = backtest.allocate(selected, 'equal')
+    result = backtest.portfolio_returns(selected, weights, returns)
+    nav = result['nav'].to_numpy()
+    drawdown = (1 - nav / np.maximum.accumulate(np.concatenate([[1.0], nav]))[1:]).max()
+
+    held = [weights.get(backtest.previous_quarter(quarter), {}) for quarter in result.index]
+    turnover = [sum(abs(after.get(ticker, 0) - before.get(ticker, 0)) for ticker in before.keys() | after.keys()) / 2
+                for before, after in zip(held[:-1], held[1:])]
+    return [nav[-1] - 1, result['return'].std(ddof=1) * 2, drawdown, np.mean(turnover)]
+
+
+@pytest.mark.parametrize('seed', range(3))
+@pytest.mark.parametrize('workers', [1, 2])
+def test_sweep_matches_the_single_config_backtest(seed, workers):
+    data, returns = make_inputs(seed)
+    results = sweep.sweep(data, WEIGHT_GRID, TOP_NS, METRIC_SUBSETS, forward_returns=returns, workers=workers,
+                          batch_size=5)
+    configs = sweep.build_configs(ranking.METRICS, WEIGHT_GRID, TOP_NS, METRIC_SUBSETS)
+    assert len(results) == len(configs)
+    for _, row in results.iterrows():
+        config = {'metrics': row['metrics'], 'weights': row['weights'], 'top_n': row['top_n']}
+        assert config in configs
+        np.testing.assert_allclose(row[sweep.RESULT_COLUMNS].to_numpy(dtype=float),
+                                   expected_statistics(data, returns, config), rtol=1e-10, atol=1e-12)
+    assert results['total_return'].is_monotonic_decreasing
@@ -0,0 +1,56 @@
+'''
+Check when the shared trading calendar is loaded again.
+'''
+
+import numpy as np
+import pytest
+
+import price_store
+import trading_calendar
+
+
+class Series:
+    def __init__(self, dates):
+        self.dates = np.array(dates, dtype='datetime64[D]')
+
+
+@pytest.fixture
+def loads(monkeypatch):
+    calls = []
+    sessions = {'dates': ['2024-01-04', '2024-01-05']}
+
+    def load_prices(ticker, until=None):
+        calls.append(until)
+        return Series(sessions['dates'])
+
+    monkeypatch.setattr(price_store, 'load_prices', load_prices)
+    monkeypatch.setattr(trading_calendar, '_calendar', None)
+    monkeypatch.setattr(trading_calendar, '_calendar_until', None)
+    return calls, sessions
+
+
+def test_weekend_and_covered_dates_reuse_the_calendar(loads):
+    calls, _ = loads
+    for until in ['2024-01-03', '2024-01-05', '2024-01-06', '2024-01-07']:
+        trading_calendar.get_calendar(until)
+    assert len(calls) == 1
+
+
+def test_next_session_reloads_once(loads):
+    calls, _ = loads
+    trading_calendar.get_calendar('2024-01-05')
+    trading_calendar.get_calendar('2024-01-08')
+    trading_calendar.get_calendar('2024-01-08')
+    # Still no session on the 8th, e.g. a holiday, so the next day looks again
+    trading_calendar.get_calendar('2024-01-09')
+    assert len(calls) == 3
+
+
+def test_empty_calendar(loads):
+    calls, sessions = loads
+    sessions['dates'] = []
+    calendar = trading_calendar.get_calendar('2024-01-05')
+    assert np.isnat(calendar.previous_session('2024-01-05'))
+    assert np.isnat(calendar.previous_session(['2024-01-04', '2024-01-05'])).all()
+    trading_calendar.get_calendar('2024-01-05')
+    assert len(calls) == 1
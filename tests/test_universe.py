@@ -0,0 +1,80 @@
+'''
+Check the universe file formats and the quarterly membership mask.
+'''
+
+import numpy as np
+import pytest
+
+import universe
+
+
+def write(directory, name: str, text: str) -> str:
+    path = directory / name
+    path.write_text(text)
+    return str(path)
+
+
+def test_ticker_list(tmp_path):
+    write(tmp_path, 'static.txt', "AAPL\n  MSFT  # comment\n\n# only a comment\nAAPL\nNVDA\n")
+    members = universe.load_universe('static', str(tmp_path))
+    assert members.name == 'static'
+    assert members.tickers == ['AAPL', 'MSFT', 'NVDA']
+    assert members.members_on('1990-01-01') == members.members_on('2030-06-30') == members.tickers
+
+
+def test_intervals(tmp_path):
+    write(tmp_path, 'intervals.csv', "ticker,start,end\n"
+                                     "AAPL,,\n"
+                                     "MSFT,2012-03-15,2013-06-30\n"
+                                     "NVDA,,2012-12-31\n"
+                                     "MSFT,2014-01-01,\n")
+    members = universe.load_universe(str(tmp_path / 'intervals.csv'))
+    assert members.tickers == ['AAPL', 'MSFT', 'NVDA']
+    assert members.members_on('2012-03-14') == ['AAPL', 'NVDA']
+    # Both bounds are included
+    assert members.members_on('2012-03-15') == ['AAPL', 'MSFT', 'NVDA']
+    assert members.members_on('2012-12-31') == ['AAPL', 'MSFT', 'NVDA']
+    assert members.members_on('2013-06-30') == ['AAPL', 'MSFT']
+    # MSFT left and joined again
+    assert members.members_on('2013-07-01') == ['AAPL']
+    assert members.members_on('2020-01-01') == ['AAPL', 'MSFT']
+
+
+def test_constituent_lists(tmp_path):
+    write(tmp_path, 'lists.csv', "date,ticker\n"
+                                 "2012-01-01,AAPL\n"
+                                 "2012-01-01,MSFT\n"
+                                 "2013-01-01,AAPL\n"
+                                 "2013-01-01,NVDA\n"
+                                 "2014-01-01,MSFT\n")
+    members = universe.load_universe('lists', str(tmp_path))
+    assert members.tickers == ['AAPL', 'MSFT', 'NVDA']
+    assert members.members_on('2011-12-31') == []
+    assert members.members_on('2012-12-31') == ['AAPL', 'MSFT']
+    assert members.members_on('2013-01-01') == ['AAPL', 'NVDA']
+    # The last list holds from then on
+    assert members.members_on('2030-01-01') == ['MSFT']
+
+
+def test_unknown_universe_and_columns(tmp_path):
+    with pytest.raises(FileNotFoundError):
+        universe.load_universe('missing', str(tmp_path))
+    write(tmp_path, 'bad.csv', "ticker,weight\nAAPL,1\n")
+    with pytest.raises(ValueError):
+        universe.load_universe('bad', str(tmp_path))
+
+
+def test_membership_mask_uses_the_last_day_of_every_quarter(tmp_path):
+    write(tmp_path, 'intervals.csv', "ticker,start,end\n"
+                                     "AAPL,,\n"
+                                     "MSFT,2012-03-31,2012-06-29\n"
+                                     "NVDA,2012-07-01,\n")
+    members = universe.load_universe('intervals', str(tmp_path))
+    quarters = ['2012_q1', '2012_q2', '2012_q3', '2013_q4']
+    # Tickers in another order, and one that was never a member
+    mask = members.membership_mask(quarters, ['NVDA', 'TSLA', 'MSFT', 'AAPL'])
+    np.testing.assert_array_equal(mask, [[False, False, True, True],
+                                         [False, False, False, True],
+                                         [True, False, False, True],
+                                         [True, False, False, True]])
+    assert members.membership_mask([], ['AAPL']).shape == (0, 1)
@@ -0,0 +1,108 @@
+'''
+This module contains the shared trading-calendar index.
+
+The calendar is the sorted list of trading sessions of a reference index,
+taken from the local price store. It answers "which trading day was the last
+one on or before this date" for whole arrays of dates at once.
+'''
+
+from __future__ import annotations
+
+import threading
+from datetime import datetime
+from typing import Optional
+
+import numpy as np
+
+import price_store
+
+# The sessions of the NASDAQ 100 index are the sessions of the stocks it tracks
+REFERENCE_TICKER = "^NDX"
+
+
+class TradingCalendar:
+    '''
+    Sorted index of trading sessions.
+
+    Attributes
+    ----------
+    sessions : np.ndarray
+        Sorted ``datetime64[D]`` trading dates.
+    '''
+
+    def __init__(self, sessions: np.ndarray):
+        self.sessions = np.asarray(sessions, dtype='datetime64[D]')
+
+    def __contains__(self, date) -> bool:
+        day = price_store.to_days(date)
+        i = np.searchsorted(self.sessions, day, side='left')
+        return i < len(self.sessions) and self.sessions[i] == day
+
+    def previous_session(self, dates, max_days_back: Optional[int] = None) -> np.ndarray:
+        '''
+        Return the last trading session on or before each date.
+
+        Parameters
+        ----------
+        dates : date or array of dates
+            The dates to look up.
+        max_days_back : int, optional
+            If given, sessions more than this many calendar days before the date
+            are not accepted and NaT is returned instead.
+
+        Returns
+        -------
+        np.ndarray or np.datetime64
+            ``datetime64[D]`` sessions with the shape of ``dates``, NaT where
+            there is no session.
+        '''
+        days = price_store.to_days(dates)
+        if not len(self.sessions):
+            sessions = np.full(np.shape(days), np.datetime64('NaT', 'D'))
+            return sessions[()] if np.ndim(dates) == 0 else sessions
+        i = np.searchsorted(self.sessions, days, side='right') - 1
+        sessions = np.where(i >= 0, self.sessions[np.maximum(i, 0)], np.datetime64('NaT', 'D'))
+        if max_days_back is not None:
+            too_old = (days - sessions) > np.timedelta64(max_days_back, 'D')
+            sessions = np.where(too_old, np.datetime64('NaT', 'D'), sessions)
+        return sessions[()] if np.ndim(dates) == 0 else sessions
+
+    def next_expected_session(self) -> Optional[np.datetime64]:
+        '''Return the weekday after the last session, None if there are no sessions.'''
+        if not len(self.sessions):
+            return None
+        return np.busday_offset(self.sessions[-1], 1, roll='forward')
+
+
+_calendar = None
+# The last day the shared calendar was loaded up to, None if it was loaded without a date
+_calendar_until = None
+_calendar_lock = threading.Lock()
+
+
+def get_calendar(until=None) -> TradingCalendar:
+    '''
+    Return the shared trading calendar, covering at least up to ``until`` if given.
+
+    The calendar is only loaded again when ``until`` reaches a session it may
+    be missing: one on or after the weekday following its last session, up to
+    today, and not already looked for. Weekends, future dates and dates
+    already covered reuse it.
+    '''
+    global _calendar, _calendar_until
+    with _calendar_lock:
+        today = np.datetime64(datetime.now().date(), 'D')
+        if _calendar is None:
+            stale = True
+        elif until is None:
+            stale = False
+        else:
+            needed = min(price_store.to_days(until), today)
+            expected = _calendar.next_expected_session()
+            stale = (_calendar_until is None or needed > _calendar_until) and (expected is None or needed >= expected)
+        if stale:
+            series = price_store.load_prices(REFERENCE_TICKER, until=until)
+            _calendar = TradingCalendar(series.dates)
+            _calendar_until = None if until is None else min(price_store.to_days(until), today)
+        return _calendar
+
@@ -0,0 +1,154 @@
+'''
+This module contains the stock universes the model is run over.
+
+A universe is loaded from a local file in the universes directory, looked up
+by name (``universes/<name>.csv`` or ``universes/<name>.txt``) or by path:
+
+- a ``.txt`` file lists one ticker per line, members at all times;
+- a CSV file with ``ticker``, ``start`` and ``end`` columns gives the
+  membership intervals of every ticker, an empty bound being open;
+- a CSV file with ``date`` and ``ticker`` columns gives point-in-time
+  constituent lists: the list of a date holds until the next list, and no
+  ticker is a member before the first one.
+
+A ticker takes part in the ranking of a quarter if it is a member on the last
+day of that quarter, see ``Universe.membership_mask``.
+'''
+
+from __future__ import annotations
+
+import os
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+import backtest
+
+UNIVERSE_DIR = "universes"
+
+# The far end of an open membership interval
+_OPEN_END = np.datetime64('9999-12-31', 'D')
+_OPEN_START = np.datetime64('1900-01-01', 'D')
+
+
+class Universe:
+    '''
+    Tickers of a universe and the dates they were members on.
+
+    Attributes
+    ----------
+    name : str
+        Name of the universe.
+    tickers : list of str
+        Every ticker that was ever a member, in the order of the source file.
+    starts, ends : np.ndarray
+        ``datetime64[D]`` bounds of every membership interval, both included.
+    members : np.ndarray
+        Index into ``tickers`` of the ticker of every interval.
+    '''
+
+    def __init__(self, name: str, tickers: list, starts: Optional[np.ndarray] = None,
+                 ends: Optional[np.ndarray] = None, members: Optional[np.ndarray] = None):
+        self.name = name
+        self.tickers = list(tickers)
+        if members is None:
+            # Static universe, every ticker is a member at all times
+            members = np.arange(len(self.tickers))
+            starts = np.full(len(self.tickers), _OPEN_START)
+            ends = np.full(len(self.tickers), _OPEN_END)
+        self.starts = starts
+        self.ends = ends
+        self.members = members
+
+    def __repr__(self) -> str:
+        return f"Universe({self.name!r}, {len(self.tickers)} tickers)"
+
+    def members_on(self, date) -> list:
+        '''Return the members on a date, in the order of ``tickers``.'''
+        return [ticker for ticker, member in zip(self.tickers, self.membership_on([date])[0]) if member]
+
+    def membership_on(self, dates) -> np.ndarray:
+        '''Return the boolean (date, ticker) mask of the members on every date.'''
+        days = np.atleast_1d(pd.to_datetime(np.asarray(dates)).values.astype('datetime64[D]'))
+        active = (self.starts[None, :] <= days[:, None]) & (days[:, None] <= self.ends[None, :])
+        mask = np.zeros((len(days), len(self.tickers)), dtype=bool)
+        rows, intervals = np.nonzero(active)
+        mask[rows, self.members[intervals]] = True
+        return mask
+
+    def membership_mask(self, quarters: list, tickers: list) -> np.ndarray:
+        '''
+        Return the boolean (quarter, ticker) mask of the given tickers that are
+        members on the last day of every quarter, e.g. to restrict a FactorPanel.
+        Tickers that were never members are False throughout.
+        '''
+        ends = [pd.Timestamp(year=year, month=3 * q, day=1) + pd.offsets.MonthEnd(0)
+                for year, q in map(backtest.quarter_key, quarters)]
+        mask = self.membership_on(ends) if quarters else np.zeros((0, len(self.tickers)), dtype=bool)
+        column = {ticker: t for t, ticker in enumerate(self.tickers)}
+        index = np.array([column.get(ticker, -1) for ticker in tickers], dtype=np.int64)
+        return np.where(index[None, :] >= 0, mask[:, np.maximum(index, 0)], False)
+
+
+def _from_intervals(name: str, frame: pd.DataFrame) -> Universe:
+    tickers = list(pd.unique(frame['ticker']))
+    members = pd.Index(tickers).get_indexer(frame['ticker'])
+    starts = pd.to_datetime(frame['start']).values.astype('datetime64[D]')
+    ends = pd.to_datetime(frame['end']).values.astype('datetime64[D]')
+    starts = np.where(np.isnat(starts), _OPEN_START, starts)
+    ends = np.where(np.isnat(ends), _OPEN_END, ends)
+    return Universe(name, tickers, starts, ends, members)
+
+
+def _from_constituent_lists(name: str, frame: pd.DataFrame) -> Universe:
+    # The list of each date holds until the day before the next list
+    dates = np.sort(pd.unique(pd.to_datetime(frame['date']).values.astype('datetime64[D]')))
+    list_ends = np.append(dates[1:] - np.timedelta64(1, 'D'), _OPEN_END)
+    frame_dates = pd.to_datetime(frame['date']).values.astype('datetime64[D]')
+    intervals = pd.DataFrame({'ticker': frame['ticker'].to_numpy(), 'start': frame_dates,
+                              'end': list_ends[np.searchsorted(dates, frame_dates)]})
+    return _from_intervals(name, intervals)
+
+
+def path_of(name: str, directory: str = UNIVERSE_DIR) -> str:
+    '''Return the file of a universe name, or the name itself if it is a path.'''
+    if os.path.exists(name):
+        return name
+    for extension in ('.csv', '.txt'):
+        path = os.path.join(directory, name + extension)
+        if os.path.exists(path):
+            return path
+    raise FileNotFoundError(f"No universe '{name}' in {directory}")
+
+
+def load_universe(name: str, directory: str = UNIVERSE_DIR) -> Universe:
+    '''
+    Load a universe by name or path, see the module docstring for the file formats.
+
+    Raises
+    ------
+    FileNotFoundError
+        If there is no such universe.
+    ValueError
+        If a CSV file has neither ``start``/``end`` nor ``date`` columns.
+    '''
+    path = path_of(name, directory)
+    name = os.path.splitext(os.path.basename(path))[0]
+    if path.endswith('.txt'):
+        with open(path, 'r') as f:
+            tickers = [line.split('#')[0].strip() for line in f]
+        return Universe(name, list(dict.fromkeys(ticker for ticker in tickers if ticker)))
+
+    frame = pd.read_csv(path, dtype={'ticker': str})
+    frame['ticker'] = frame['ticker'].str.strip()
+    if 'date' in frame.columns:
+        return _from_constituent_lists(name, frame)
+    if 'start' in frame.columns or 'end' in frame.columns:
+        for column in ('start', 'end'):
+            if column not in frame.columns:
+                frame[column] = None
+        return _from_intervals(name, frame)
+    if list(frame.columns) == ['ticker']:
+        return Universe(name, list(pd.unique(frame['ticker'])))
+    raise ValueError(f"Universe file {path} needs a 'ticker' column with 'start'/'end' or 'date' columns")
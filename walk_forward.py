@@ -0,0 +1,148 @@
+'''
+This module contains the streaming walk-forward backtest.
+
+Quarters are processed one at a time in chronological order: the factors of a
+quarter are loaded, ranked and selected, and the stocks selected in the
+previous quarter realize their return over it. Only the previous selection is
+carried from one quarter to the next, so memory does not grow with the length
+of the history, and every result is available as soon as its quarter is done.
+
+Progress can be saved to a checkpoint file after every quarter. A run that is
+resumed from it skips the quarters already processed, which also makes it
+cheap to extend a finished run with newly reported quarters.
+'''
+
+from __future__ import annotations
+
+import json
+import os
+from typing import Iterator, Mapping, Optional
+
+import numpy as np
+import pandas as pd
+
+import backtest
+import ranking
+import risk_model
+
+CHECKPOINT_VERSION = 1
+
+
+def _load_checkpoint(path: str, config: dict) -> Optional[dict]:
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        state = json.load(f)
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(f"Unsupported checkpoint version {state.get('version')} in {path}")
+    if state['config'] != config:
+        raise ValueError(f"Checkpoint {path} was written with {state['config']}, not {config}")
+    return state
+
+
+def _save_checkpoint(path: str, state: dict) -> None:
+    # Write to a temporary file first so that an interrupted run never leaves half a checkpoint
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def _panel(data: Mapping, quarter: str, metrics: Optional[list], universe) -> ranking.FactorPanel:
+    if isinstance(data, ranking.FactorPanel):
+        panel = data.subset([quarter])
+    else:
+        panel = ranking.build_panel(data, metrics, [quarter])
+    if universe is None:
+        return panel
+    return panel.restrict(universe.membership_mask(panel.dates, panel.tickers))
+
+
+def walk_forward(data: Mapping, top_n: int = ranking.DEFAULT_TOP_N, scheme: Optional[str] = None,
+                 metrics: Optional[list] = None, start_year: int = backtest.START_YEAR,
+                 checkpoint: Optional[str] = None, universe=None) -> Iterator[dict]:
+    '''
+    Backtest the stock selection one quarter at a time.
+
+    The stocks selected in a quarter are held over the next one, as in
+    ``PrimeModel.calculate_portfolio_return``: the return of a quarter comes
+    from the selection of the quarter before it, and is 0 if that quarter has
+    no data.
+
+    Parameters
+    ----------
+    data : Mapping
+        The ``date -> ticker -> metric`` stock data, a snapshot or a FactorPanel.
+        A snapshot only reads the quarter being processed.
+    top_n : int
+        Number of stocks selected every quarter.
+    scheme : str, optional
+        Allocation scheme of ``backtest.allocate``. Without one, the returns of
+        the held stocks are summed like ``calculate_portfolio_return`` does.
+    metrics : list, optional
+        Metrics ranked, ``ranking.METRICS`` by default.
+    start_year : int
+        Quarters before this year are selected but not backtested.
+    checkpoint : str, optional
+        JSON file the progress is saved to once a quarter's result has been
+        consumed. If it exists, the run resumes after the last saved quarter.
+    universe : universe.Universe, optional
+        Only the tickers that were members at the end of a quarter are ranked in it.
+
+    Yields
+    ------
+    dict
+        For every backtested quarter in chronological order: 'quarter', the
+        'held' stocks and their 'weights' (None without a scheme), the
+        portfolio 'return', the cumulative 'nav' (None without a scheme, the
+        summed returns are not those of an invested portfolio) and the stocks
+        'selected' in that quarter to be held over the next one.
+    '''
+    config = {'top_n': top_n, 'scheme': scheme, 'metrics': None if metrics is None else list(metrics),
+              'start_year': start_year}
+    if universe is not None:
+        config['universe'] = universe.name
+    state = _load_checkpoint(checkpoint, config) or {
+        'version': CHECKPOINT_VERSION, 'config': config, 'quarter': None, 'selected': [], 'weights': None, 'nav': 1.0}
+
+    # Moved forward one quarter at a time, so its window sums are updated instead of recomputed
+    covariance_model = risk_model.RollingCovariance() if scheme in backtest.COVARIANCE_SCHEMES else None
+
+    quarters = sorted(data.dates if isinstance(data, ranking.FactorPanel) else data, key=backtest.quarter_key)
+    if state['quarter'] is not None:
+        quarters = [quarter for quarter in quarters if backtest.quarter_key(quarter) > backtest.quarter_key(state['quarter'])]
+
+    for quarter in quarters:
+        panel = _panel(data, quarter, metrics, universe)
+        positions = ranking.rank_positions(panel)
+        scores = ranking.score_panel(panel, positions)
+        selected = ranking.select_top(panel, scores, positions, top_n)[quarter]
+        weights = None
+        if scheme is not None:
+            score_frame = pd.DataFrame(scores, index=[quarter], columns=panel.tickers) if scheme == 'score' else None
+            weights = backtest.allocate({quarter: selected}, scheme, score_frame,
+                                        covariance_model=covariance_model)[quarter]
+
+        # The stocks selected in the previous quarter, if it has data, are held over this one
+        holding = state['quarter'] == backtest.previous_quarter(quarter)
+        held = state['selected'] if holding else []
+        held_weights = state['weights'] if holding else None
+
+        record = None
+        if backtest.quarter_key(quarter)[0] >= start_year:
+            returns = backtest.forward_return_matrix([quarter], held).iloc[0].to_numpy()
+            position_weights = np.array([1.0 if held_weights is None else held_weights.get(ticker, 0) for ticker in held])
+            # Stocks without a price over the quarter do not contribute
+            portfolio_return = float((position_weights * np.nan_to_num(returns)).sum())
+            if scheme is not None:
+                state['nav'] *= 1 + portfolio_return
+            record = {'quarter': quarter, 'held': list(held), 'weights': held_weights,
+                      'return': portfolio_return, 'nav': state['nav'] if scheme is not None else None,
+                      'selected': selected}
+
+        state.update({'quarter': quarter, 'selected': selected, 'weights': weights})
+        if record is not None:
+            yield record
+        if checkpoint is not None:
+            _save_checkpoint(checkpoint, state)
+